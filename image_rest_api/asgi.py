@@ -0,0 +1,7 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '.', '..')))
+from website.async_app import create_async_app
+
+
+app = create_async_app()
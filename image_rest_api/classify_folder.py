@@ -0,0 +1,230 @@
+"""
+Classify every image of a directory, or of a manifest listing image paths, into a JSONL file.
+Images go through the same validation, result cache and classifier as the API, in the batch priority lane.
+The output file is also the checkpoint: a run with the same output skips the images it already classified
+or found invalid, so a crashed run resumes where it stopped. Images whose classification failed are tried
+again, the last record of an image is the one that counts.
+
+usage: python classify_folder.py uploads/ results.jsonl --concurrency 16
+       python classify_folder.py images.txt results.jsonl --manifest
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Set
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '.', '..')))
+from shared.limiter import OverloadedError, BATCH
+from website.ingestion import IngestedImage, InvalidImageError
+from website.image_api import classify_image_data, decode_pool, monitor
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# Upper bounds in seconds of the latency buckets, about 10% apart from 1ms to 10 minutes
+LATENCY_BUCKETS = np.geomspace(0.001, 600, 140)
+
+
+def walk_directory(directory: str) -> Iterator[str]:
+    """
+    :param directory: root directory
+    :return: the paths of the image files under the directory, in a stable order
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+def read_manifest(manifest: str) -> Iterator[str]:
+    """
+    :param manifest: text file with one image path per line, relative paths being relative to the manifest
+    :return: the image paths
+    """
+    base = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as file:
+        for line in file:
+            path = line.strip()
+            if path and not path.startswith('#'):
+                yield path if os.path.isabs(path) else os.path.join(base, path)
+
+
+def load_checkpoint(output: str) -> Set[str]:
+    """
+    Read the images already classified by a previous run, and drop the partial line a crash may have left.
+    :param output: the JSONL output file
+    :return: the paths of the images already classified, or invalid, in the output
+    """
+    done: Set[str] = set()
+    if not os.path.exists(output):
+        return done
+    valid_bytes = 0
+    with open(output, 'rb') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record.get('status') != 'failed':
+                done.add(record['path'])
+            valid_bytes += len(line)
+    with open(output, 'rb+') as file:
+        file.truncate(valid_bytes)
+    return done
+
+
+def bucket_percentiles(counts: np.ndarray, percents: List[float]) -> List[float]:
+    """
+    :param counts: latency counts per bucket of LATENCY_BUCKETS, the last one counting the higher latencies
+    :param percents: percentiles to compute, between 0 and 100
+    :return: the upper bound in seconds of the bucket of every percentile
+    """
+    buckets = np.searchsorted(np.cumsum(counts), np.array(percents) / 100 * counts.sum())
+    return [float(bound) for bound in LATENCY_BUCKETS[np.minimum(buckets, len(LATENCY_BUCKETS) - 1)]]
+
+
+class Progress:
+    """
+    Throughput and latency percentiles of a run, reported periodically on stderr.
+    Latencies are counted in the fixed LATENCY_BUCKETS, so that neither the memory nor the cost of a report
+    grows with the number of images of the run. A percentile is reported as the upper bound of its bucket.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.skipped = 0
+        self.statuses: Counter = Counter()
+        # The last bucket counts the latencies above the highest bound
+        self.latency_counts = np.zeros(len(LATENCY_BUCKETS) + 1, dtype=np.int64)
+        self._lock = threading.Lock()
+
+
+    def record(self, status: str, latency: float) -> None:
+        bucket = int(np.searchsorted(LATENCY_BUCKETS, latency))
+        with self._lock:
+            self.statuses[status] += 1
+            self.latency_counts[bucket] += 1
+
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = self.latency_counts.copy()
+            statuses = dict(self.statuses)
+        elapsed = time.perf_counter() - self.start
+        recorded = int(counts.sum())
+        summary = {'completed': 0, 'failed': 0, 'invalid': 0, **statuses, 'skipped': self.skipped,
+                   'images_per_second': round(recorded / elapsed, 2) if elapsed else 0}
+        if recorded:
+            p50, p90, p99 = (seconds * 1000 for seconds in bucket_percentiles(counts, [50, 90, 99]))
+            summary.update({'p50_ms': round(p50, 1), 'p90_ms': round(p90, 1), 'p99_ms': round(p99, 1)})
+        return summary
+
+
+    def report(self) -> None:
+        print(json.dumps(self.summary()), file=sys.stderr, flush=True)
+
+
+def classify_file(path: str) -> Dict[str, Any]:
+    """
+    :param path: path of an image file
+    :return: the output record of the image
+    """
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as file:
+            upload = IngestedImage(file)
+            while True:
+                try:
+                    classification_result = classify_image_data(upload, BATCH)
+                    break
+                except OverloadedError as e:
+                    # The model sheds the calls of a run going faster than the rate limits allow
+                    time.sleep(e.retry_after)
+    except InvalidImageError as e:
+        record: Dict[str, Any] = {'path': path, 'status': 'invalid', 'error': str(e)}
+    except OSError as e:
+        record = {'path': path, 'status': 'failed', 'error': str(e)}
+    else:
+        if classification_result is None:
+            record = {'path': path, 'status': 'failed', 'error': 'Classification failed'}
+        else:
+            record = {'path': path, 'status': 'completed', **classification_result}
+    record['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return record
+
+
+def run(paths: Iterator[str], output: str, concurrency: int, report_seconds: float) -> Dict[str, Any]:
+    """
+    Classify images with at most concurrency of them in flight, appending their records to the output.
+    :param paths: the image paths
+    :param output: the JSONL output file, also read as the checkpoint
+    :param concurrency: number of images classified at the same time
+    :param report_seconds: interval between two progress reports
+    :return: the final summary of the run
+    """
+    done = load_checkpoint(output)
+    progress = Progress()
+    slots = threading.BoundedSemaphore(concurrency)
+    output_lock = threading.Lock()
+    stop = threading.Event()
+
+    def report_forever() -> None:
+        while not stop.wait(report_seconds):
+            progress.report()
+
+    with open(output, 'a') as out, ThreadPoolExecutor(concurrency) as executor:
+        def classify_and_write(path: str) -> None:
+            try:
+                record = classify_file(path)
+                with output_lock:
+                    out.write(json.dumps(record) + '\n')
+                    out.flush()
+                progress.record(record['status'], record['latency_ms'] / 1000)
+            except Exception as e:
+                # Not written to the output, so the next run tries the image again
+                print(f"{path}: {e}", file=sys.stderr, flush=True)
+            finally:
+                slots.release()
+
+        reporter = threading.Thread(target=report_forever, daemon=True)
+        reporter.start()
+        for path in paths:
+            if path in done:
+                progress.skipped += 1
+                continue
+            # Paths are read lazily, only concurrency images are waiting or running at any time
+            slots.acquire()
+            executor.submit(classify_and_write, path)
+    stop.set()
+    return progress.summary()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Classify a directory of images into a JSONL file.')
+    parser.add_argument('source', help='directory walked recursively for PNG and JPEG files')
+    parser.add_argument('output', help='JSONL output file, resumed if it exists')
+    parser.add_argument('--manifest', action='store_true',
+                        help='the source is a text file listing one image path per line')
+    parser.add_argument('--concurrency', type=int, default=16, help='images classified at the same time')
+    parser.add_argument('--report-seconds', type=float, default=10, help='interval between two progress reports')
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    paths = read_manifest(args.source) if args.manifest else walk_directory(args.source)
+    # A run is not a worker of the API, its classifications are not counted in /status
+    monitor.detach()
+    decode_pool.start()
+    summary = run(paths, args.output, args.concurrency, args.report_seconds)
+    print(json.dumps(summary), file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    main()
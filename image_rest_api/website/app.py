@@ -1,7 +1,10 @@
-import time
 from flask import Flask
-from .image_api import image_api
-from shared.constants import MONGO_CLIENT
+from .image_api import (image_api, result_cache, perceptual_index, monitor, job_queue, decode_pool, idempotency,
+                        ensure_request_indexes)
+from .ingestion import SpoolingRequest
+from shared.constants import MAX_UPLOAD_BYTES
+from shared.metrics import init_metrics
+from shared.deadline import init_deadlines
 
 
 def create_app() -> Flask:
@@ -15,21 +18,21 @@ def create_app() -> Flask:
     app = Flask(__name__)
     app.config['SECRET_KEY'] = 'secret key'
     app.config['process_dict'] = {}
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+    app.request_class = SpoolingRequest
 
-    db = MONGO_CLIENT['image_rest_api']
-    monitor_collection = db['monitor_health']
-    request_collection = db['request_track']
-    request_collection.delete_many({})
-    monitor_collection.delete_many({})
-    initial_info = {
-                'success': 0,
-                'fail': 0,     
-                'running': 0,
-                'queued': 0,
-                'start_time': time.time()
-            }
-    monitor_collection.insert_one(initial_info)
+    ensure_request_indexes()
+    monitor.ensure_indexes()
+    result_cache.ensure_indexes()
+    perceptual_index.ensure_indexes()
+    idempotency.ensure_indexes()
+    perceptual_index.start_background_load()
+    decode_pool.start()
+    job_queue.ensure_indexes()
+    job_queue.start()
 
     app.register_blueprint(image_api, url_prefix='/')
+    init_metrics(app, 'image_rest_api')
+    init_deadlines(app)
 
     return app
\ No newline at end of file
@@ -0,0 +1,419 @@
+import json
+import asyncio
+from typing import IO, Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from bson import ObjectId
+from quart import Blueprint, Response, request
+from motor.motor_asyncio import AsyncIOMotorClient
+from shared.constants import (MONGO_URL, MAX_UPLOAD_BYTES, RESULT_MAX_WAIT_SECONDS,
+                              ASGI_JOB_WORKERS, ASYNC_RETRY_AFTER_SECONDS, JOB_QUEUE_MAX_DEPTH, JOB_LEASE_SECONDS,
+                              JOB_HEARTBEAT_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETRY_BACKOFF_SECONDS, JOB_POLL_SECONDS,
+                              JOB_INLINE_IMAGE_BYTES, IDEMPOTENCY_POLL_SECONDS,
+                              MICRO_BATCH_MAX_IMAGES, MICRO_BATCH_MAX_WINDOW_SECONDS, WEBHOOK_ALLOWED_HOSTS)
+from shared.limiter import OverloadedError, INTERACTIVE, BATCH
+from shared.deadline import (DeadlineExceededError, begin_request, check_deadline, current_cancellation,
+                             current_deadline, deadline_exceeded_body)
+from shared.metrics import track_latency
+from shared.utils import get_logger, update_monitor_status, increment_monitor_counters
+from .ingestion import IngestedImage, InvalidImageError
+from .job_queue import JobQueue, QueueFullError
+from .micro_batching import AsyncMicroBatcher
+from .idempotency import IdempotencyConflictError, IdempotencyInProgressError
+from .result_cache import FAILED
+from .singleflight import MISSING
+from .webhooks import is_valid_callback_url
+from .image_api import (classifier, fallback_classifier, model_limiter, monitor, result_cache, perceptual_index,
+                        decode_pool, idempotency, ingest_image_file, record_preprocess_stats, request_expiry,
+                        build_result, is_pending, link_to_pending_request, request_result_fields, publish_result,
+                        status_data, parse_request_ids, build_results, get_idempotency_key, record_micro_batch,
+                        cancel_request, result_notifier, RESULT_PROJECTION)
+from .image_api import request_collection as sync_request_collection
+
+logger = get_logger()
+
+# Async serving mode of the image_api routes, for an ASGI server
+async_image_api = Blueprint('async_image_api', __name__)
+
+request_collection = AsyncIOMotorClient(MONGO_URL)['image_rest_api']['request_track']
+
+# Classifications in flight in this process, by content hash
+in_flight: Dict[str, asyncio.Future] = {}
+# Event loop of the app, on which the job queue threads run their classifications
+event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def json_response(data: Any, status_code: int, headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Creates a JSON response with a specified status code, like create_json_response does for Flask.
+    :param data: the data to be included in the JSON response
+    :param status_code: the HTTP status code for the response
+    :param headers: additional response headers
+    :return: the Quart response object
+    """
+    return Response(json.dumps(data), status=status_code, headers=headers, content_type='application/json')
+
+
+def error_response(code: int, message: str) -> Response:
+    return json_response({'error': {'code': code, 'message': message}}, code)
+
+
+async def classify_image_async(img: Any, lane: str = INTERACTIVE) -> Optional[Dict]:
+    """
+    Classify a preprocessed image with the async client of the classifier backend.
+    :param img: the image, in any format accepted by the backend
+    :param lane: the priority lane of the model call
+    :return: the classification result, or None if classification fails
+    :raises OverloadedError: if the call is shed and there is no fallback backend
+    :raises DeadlineExceededError: if the deadline of the request passed before the call answered
+    """
+    try:
+        try:
+            async with model_limiter.call_async(lane):
+                with track_latency('model'):
+                    return await classifier.classify_async(img)
+        except OverloadedError:
+            if fallback_classifier is None:
+                raise
+        increment_monitor_counters(monitor, fallback_calls=1)
+        with track_latency('model'):
+            return await fallback_classifier.classify_async(img)
+    except (OverloadedError, DeadlineExceededError):
+        raise
+    except Exception as e:
+        # Like call_classifier, a call cut at the deadline is not a failure of the image
+        check_deadline()
+        return None
+
+
+async def classify_images_async(imgs: List[Any], lane: str = INTERACTIVE) -> List[Optional[Dict]]:
+    """
+    Classify preprocessed images in one call of the async client, like classify_images does.
+    If the batch call fails, every image is classified on its own.
+    :param imgs: the images, in any format accepted by the backend
+    :param lane: the priority lane of the model call
+    :return: the classification results in the order of the images, None where classification failed
+    :raises OverloadedError: if the call is shed and there is no fallback backend
+    :raises DeadlineExceededError: if the deadline of the request passed before the call answered
+    """
+    if len(imgs) == 1:
+        return [await classify_image_async(imgs[0], lane)]
+    try:
+        try:
+            async with model_limiter.call_async(lane):
+                with track_latency('model'):
+                    return await classifier.classify_batch_async(imgs)
+        except OverloadedError:
+            if fallback_classifier is None:
+                raise
+        increment_monitor_counters(monitor, fallback_calls=1)
+        with track_latency('model'):
+            return await fallback_classifier.classify_batch_async(imgs)
+    except (OverloadedError, DeadlineExceededError):
+        raise
+    except Exception as e:
+        check_deadline()
+        return list(await asyncio.gather(*[classify_image_async(img, lane) for img in imgs]))
+
+
+micro_batcher = AsyncMicroBatcher(classify_images_async, MICRO_BATCH_MAX_IMAGES, MICRO_BATCH_MAX_WINDOW_SECONDS,
+                                  on_batch=record_micro_batch)
+
+
+async def classify_image_data_async(upload: IngestedImage, lane: str = INTERACTIVE) -> Optional[Dict]:
+    """
+    Classify an uploaded image, going through the result cache and the perceptual hash index like
+    classify_images_data does. Identical images classified at the same moment in this process share
+    a single model call. Images are decoded by the decode pool, and cache reads from Mongo run in threads.
+    :param upload: the validated upload
+    :param lane: the priority lane of the model call
+    :return: the classification result, or None if classification fails
+    """
+    key = upload.digest
+    cached = await asyncio.to_thread(result_cache.get, key)
+    if cached is not None:
+        increment_monitor_counters(monitor, cache_hits=1)
+        return None if cached == FAILED else cached
+
+    flight = in_flight.get(key)
+    if flight is not None:
+        classification_result = await asyncio.shield(flight)
+        if classification_result is not MISSING:
+            increment_monitor_counters(monitor, coalesced=1)
+            return classification_result
+
+    try:
+        model_input, image_hash, preprocess_stats = await decode_pool.decode_async(upload)
+    except (InvalidImageError, OSError):
+        await asyncio.to_thread(result_cache.set, key, None)
+        return None
+    record_preprocess_stats(preprocess_stats)
+    classification_result = await asyncio.to_thread(perceptual_index.lookup, image_hash)
+    if classification_result is not None:
+        increment_monitor_counters(monitor, near_duplicate_hits=1)
+        await asyncio.to_thread(result_cache.set, key, classification_result)
+        return classification_result
+
+    flight = asyncio.get_running_loop().create_future()
+    in_flight[key] = flight
+    classification_result = MISSING
+    try:
+        increment_monitor_counters(monitor, cache_misses=1)
+        if MICRO_BATCH_MAX_IMAGES > 1:
+            # Images of concurrent requests share a model call
+            classification_result = await micro_batcher.classify(model_input, lane)
+        else:
+            classification_result = await classify_image_async(model_input, lane)
+        await asyncio.to_thread(result_cache.set, key, classification_result)
+        if classification_result is not None:
+            await asyncio.to_thread(perceptual_index.add, image_hash, key, classification_result)
+        return classification_result
+    finally:
+        if in_flight.get(key) is flight:
+            del in_flight[key]
+        flight.set_result(classification_result)
+
+
+def monitor_status_async(func):
+    """
+    Same as monitor_status, for the async views.
+    """
+    async def wrapper(*args, **kwargs):
+        update_monitor_status(monitor, running_inc=1)
+        try:
+            response = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            # The client disconnected, the server cancelled the request and with it its pending work
+            increment_monitor_counters(monitor, **{'deadlines.client_disconnects': 1})
+            update_monitor_status(monitor, fail_inc=1, running_inc=-1)
+            raise
+        except Exception:
+            update_monitor_status(monitor, fail_inc=1, running_inc=-1)
+            raise
+        if response.status_code >= 400:
+            update_monitor_status(monitor, fail_inc=1, running_inc=-1)
+        else:
+            update_monitor_status(monitor, success_inc=1, running_inc=-1)
+        return response
+
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+async def ingest_request_image() -> Tuple[Optional[IngestedImage], Optional[Response]]:
+    """
+    :return: the validated upload of the 'image' form field, or None and the error response
+    """
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return None, error_response(413, f'The upload is larger than {MAX_UPLOAD_BYTES} bytes')
+    files = await request.files
+    if 'image' not in files:
+        return None, error_response(400, 'No image found in request')
+    upload, error = await asyncio.to_thread(ingest_image_file, files['image'])
+    if error is not None:
+        return None, error_response(400, error)
+    return upload, None
+
+
+async def idempotent_response(scope: str, fingerprint: str, respond: Callable[[], Awaitable[Response]]) -> Response:
+    """
+    Same as the idempotent_response of the WSGI mode, a retry waits for its running request without holding a thread.
+    :param scope: the name of the endpoint
+    :param fingerprint: the content hash of the uploaded image
+    :param respond: runs the request
+    :return: the response of the request, or of the first request of its key
+    """
+    try:
+        key = get_idempotency_key(request.headers)
+    except ValueError as e:
+        return error_response(400, str(e))
+    if key is None:
+        return await respond()
+    try:
+        stored = await idempotency.begin_async(scope, key, fingerprint)
+    except IdempotencyConflictError as e:
+        return error_response(422, str(e))
+    except IdempotencyInProgressError as e:
+        return json_response({'error': {'code': 409, 'message': str(e)}}, 409,
+                             {'Retry-After': str(max(1, int(round(IDEMPOTENCY_POLL_SECONDS))))})
+    if stored is not None:
+        increment_monitor_counters(monitor, idempotent_replays=1)
+        return json_response(stored['body'], stored['code'], {'Idempotent-Replayed': 'true'})
+
+    try:
+        response = await respond()
+    except BaseException:
+        # Also when the request is cancelled, e.g. because the client disconnected
+        await asyncio.to_thread(idempotency.release, scope, key)
+        raise
+    if response.status_code < 300:
+        await asyncio.to_thread(idempotency.finish, scope, key, await response.get_json(), response.status_code)
+    else:
+        await asyncio.to_thread(idempotency.release, scope, key)
+    return response
+
+
+@async_image_api.errorhandler(OverloadedError)
+async def model_overloaded(e: OverloadedError) -> Response:
+    return json_response({'error': {'code': 503, 'message': str(e)}}, 503,
+                         {'Retry-After': str(max(1, int(round(e.retry_after))))})
+
+
+@async_image_api.errorhandler(DeadlineExceededError)
+async def deadline_exceeded(e: DeadlineExceededError) -> Response:
+    increment_monitor_counters(monitor, **{'deadlines.exceeded': 1})
+    return json_response(deadline_exceeded_body(e), 504)
+
+
+async def read_deadline() -> None:
+    """
+    Serve the request under the deadline of its deadline header, registered on the app by create_async_app.
+    A coroutine, so that the deadline is set in the task of the request rather than in a thread.
+    """
+    begin_request(request.headers)
+
+
+@async_image_api.route('/status', methods=['GET'])
+async def status() -> Response:
+    """
+    :return: A JSON response with the status of the API.
+    """
+    data = await asyncio.to_thread(status_data)
+    data['serving_mode'] = 'asgi'
+    data['micro_batching'].update(micro_batcher.window.state())
+    data['lanes'][BATCH]['jobs_running'] = job_queue.running
+    data['jobs']['running_here'] = job_queue.running
+    return json_response({'status': data}, 200)
+
+
+@async_image_api.route('/upload_image', methods=['POST'])
+@monitor_status_async
+async def upload_image() -> Response:
+    """
+    Handle sync image upload and classification, without holding a thread while the model answers.
+    :return: A JSON response with the classification result or an error message.
+    """
+    upload, error = await ingest_request_image()
+    if error is not None:
+        return error
+
+    async def classify() -> Response:
+        classification_result = await classify_image_data_async(upload)
+        if classification_result is None:
+            return error_response(400, 'Classification failed')
+        return json_response(classification_result, 200)
+
+    return await idempotent_response('upload_image', upload.digest, classify)
+
+
+def run_job(image: IO[bytes]) -> Optional[Dict]:
+    """
+    Classify the image of a queued job on the event loop, from a thread of the job queue.
+    :param image: file of the uploaded image
+    :return: classification result
+    """
+    future = asyncio.run_coroutine_threadsafe(classify_image_data_async(IngestedImage(image), BATCH), event_loop)
+    cancellation = current_cancellation()
+    if cancellation is not None:
+        # A cancelled job stops at once, in the middle of its model call too
+        cancellation.add_callback(future.cancel)
+    return future.result()
+
+
+# The job threads mostly wait for the event loop, so there are many more of them than in the WSGI mode
+job_queue = JobQueue(sync_request_collection, ASGI_JOB_WORKERS, JOB_QUEUE_MAX_DEPTH, JOB_LEASE_SECONDS,
+                     JOB_HEARTBEAT_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETRY_BACKOFF_SECONDS, JOB_POLL_SECONDS,
+                     JOB_INLINE_IMAGE_BYTES, handler=run_job, result_fields=request_result_fields,
+                     on_done=publish_result)
+
+
+def start_job_queue(loop: asyncio.AbstractEventLoop) -> None:
+    """
+    :param loop: the event loop serving the app
+    """
+    global event_loop
+    event_loop = loop
+    job_queue.ensure_indexes()
+    job_queue.start()
+
+
+@async_image_api.route('/async_upload', methods=['POST'])
+@monitor_status_async
+async def async_upload() -> Response:
+    """
+    Handle async image upload: the job is queued in request_track for any worker to run.
+    :return: A 202 JSON response with the request id, or an error message.
+    """
+    form = await request.form
+    callback_url = form.get('callback_url')
+    # The host of the URL is resolved, off the event loop
+    if callback_url is not None and not await asyncio.to_thread(is_valid_callback_url, callback_url,
+                                                                WEBHOOK_ALLOWED_HOSTS):
+        return error_response(400, 'callback_url must be a public http(s) URL')
+    upload, error = await ingest_request_image()
+    if error is not None:
+        return error
+
+    async def queue_job() -> Response:
+        request_id = str(ObjectId())
+        if await asyncio.to_thread(link_to_pending_request, request_id, upload.digest, callback_url):
+            increment_monitor_counters(monitor, coalesced=1)
+            return json_response({'request_id': request_id}, 202)
+
+        try:
+            job = await asyncio.to_thread(job_queue.job_fields, upload, current_deadline())
+        except QueueFullError:
+            return json_response({'error': {'code': 503, 'message': 'Too many pending jobs, try again later'}}, 503,
+                                 {'Retry-After': str(ASYNC_RETRY_AFTER_SECONDS)})
+        # Written before the job is accepted, so that it runs even if this worker dies
+        await request_collection.insert_one(
+            {'request_id': request_id, 'status': 'pending', 'digest': upload.digest,
+             'expires_at': request_expiry(pending=True), **({'callback_url': callback_url} if callback_url else {}),
+             **job},
+        )
+        job_queue.notify()
+        return json_response({'request_id': request_id}, 202)
+
+    return await idempotent_response('async_upload', upload.digest, queue_job)
+
+
+@async_image_api.route('/result/<request_id>', methods=['DELETE'])
+async def delete_result_with_id(request_id: str) -> Response:
+    """
+    Cancel an async request, so that its job stops using a worker and the model.
+    :param request_id: The ID of the request to cancel.
+    :return: A JSON response with the request id and its cancelled status, or an error message.
+    """
+    return json_response(*await asyncio.to_thread(cancel_request, request_id, job_queue))
+
+
+@async_image_api.route('/result/<request_id>', methods=['GET'])
+async def get_result_with_id(request_id: str) -> Response:
+    """
+    Retrieve the result for a specific request ID, long-polling up to ?wait=<seconds> while it runs.
+    :param request_id: The ID of the request to retrieve the result for.
+    :return: A JSON response with the classification result or the current status.
+    """
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), RESULT_MAX_WAIT_SECONDS)
+    except ValueError:
+        wait = 0
+    fetch = lambda: request_collection.find_one({'request_id': request_id}, RESULT_PROJECTION)
+    if wait > 0:
+        # The job may run in any worker, the notifier follows the jobs of all of them
+        request_data = await result_notifier.wait_async(request_id, fetch, is_pending, wait)
+    else:
+        request_data = await fetch()
+    return json_response(*build_result(request_data))
+
+
+@async_image_api.route('/results', methods=['GET', 'POST'])
+async def get_results() -> Response:
+    """
+    Retrieve the results of many request IDs in one response, like the WSGI /results.
+    :return: A JSON response with the results in the order of the ids, or an error message.
+    """
+    if request.method == 'POST':
+        body = await request.get_json(silent=True) or {}
+        ids = body.get('ids') if isinstance(body, dict) else None
+    else:
+        ids = ','.join(request.args.getlist('ids'))
+    return json_response(*await asyncio.to_thread(build_results, parse_request_ids(ids)))
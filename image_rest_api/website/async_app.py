@@ -0,0 +1,54 @@
+import asyncio
+from quart import Quart, Request
+from quart.formparser import FormDataParser
+from .ingestion import spool_upload
+from .async_api import async_image_api, start_job_queue, read_deadline
+from .image_api import (result_cache, perceptual_index, monitor, writer, decode_pool, idempotency,
+                        ensure_request_indexes)
+from shared.constants import MAX_UPLOAD_BYTES
+from shared.metrics import init_async_metrics
+
+
+class SpoolingAsyncRequest(Request):
+    """
+    Request of the async serving mode whose uploaded files are stored by spool_upload, like SpoolingRequest.
+    """
+    def make_form_data_parser(self) -> FormDataParser:
+        parser = super().make_form_data_parser()
+        parser.stream_factory = spool_upload
+        return parser
+
+
+def create_async_app() -> Quart:
+    """
+    Create and configure the Quart application of the async serving mode.
+    It serves the same /status, /metrics, /upload_image, /async_upload and /result/<request_id> contract as
+    create_app(), with the model and Mongo calls awaited on an event loop instead of holding a thread each.
+    Returns:
+        Quart: The configured Quart application instance.
+    """
+    app = Quart(__name__)
+    app.config['SECRET_KEY'] = 'secret key'
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+    app.request_class = SpoolingAsyncRequest
+
+    @app.before_serving
+    async def ensure_indexes() -> None:
+        ensure_request_indexes()
+        monitor.ensure_indexes()
+        result_cache.ensure_indexes()
+        perceptual_index.ensure_indexes()
+        idempotency.ensure_indexes()
+        perceptual_index.start_background_load()
+        decode_pool.start()
+        start_job_queue(asyncio.get_running_loop())
+
+    @app.after_serving
+    async def flush_writes() -> None:
+        await asyncio.to_thread(writer.flush)
+
+    init_async_metrics(app, 'image_rest_api')
+    app.before_request(read_deadline)
+    app.register_blueprint(async_image_api, url_prefix='/')
+
+    return app
@@ -0,0 +1,284 @@
+import io
+import os
+import json
+import asyncio
+import time
+import random
+import hashlib
+import threading
+import numpy as np
+import PIL.Image
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+from shared.utils import get_LLM_model
+from shared.deadline import DeadlineExceededError, check_deadline, model_request_options, remaining_seconds
+from shared.constants import (LOCAL_MODEL_PATH, LOCAL_LABELS_PATH, LOCAL_TOP_K, FAKE_LATENCY_SECONDS,
+                              FAKE_LATENCY_JITTER_SECONDS, FAKE_ERROR_RATE, FAKE_SEED)
+
+SINGLE_PROMPT = "What is the main object in the photo? answer just in one word- the main object"
+FAKE_LABELS = ['dog', 'cat', 'car', 'tree', 'house', 'bird', 'flower', 'person', 'boat', 'chair']
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def to_pil_image(img: Any) -> PIL.Image.Image:
+    """
+    :param img: a model input, either a PIL image or a {'mime_type', 'data'} blob
+    :return: the decoded RGB image
+    """
+    if isinstance(img, dict):
+        img = PIL.Image.open(io.BytesIO(img['data']))
+    return img.convert('RGB')
+
+
+def to_bytes(img: Any) -> bytes:
+    """
+    :param img: a model input, either a PIL image or a {'mime_type', 'data'} blob
+    :return: bytes identifying the image content
+    """
+    if isinstance(img, dict):
+        return img['data']
+    return img.tobytes()
+
+
+def batch_prompt(count: int) -> str:
+    """
+    :param count: number of images sent with the prompt
+    :return: the prompt asking the model for a JSON list of one word per image
+    """
+    return (f"There are {count} photos. For each photo, in the given order, what is the main object in the photo? "
+            f"Answer just in one word per photo- the main object. Return a JSON list of {count} strings.")
+
+
+def parse_batch_answer(text: str, count: int) -> List[Optional[Dict]]:
+    """
+    :param text: answer of the model to batch_prompt()
+    :param count: number of images sent with the prompt
+    :return: the classification results in the order of the images
+    :raises ValueError: if the answer does not match the images
+    """
+    classifications = json.loads(text)
+    if not isinstance(classifications, list) or len(classifications) != count:
+        raise ValueError(f"Expected {count} classifications, got: {text}")
+    return [single_match(classification) for classification in classifications]
+
+
+def single_match(name: Optional[str]) -> Optional[Dict]:
+    """
+    :param name: the main object of an image, as answered by a model
+    :return: the classification result, None if the model had no answer
+    """
+    return {'matches': [{'name': str(name), 'score': 0.9}]} if name else None
+
+
+class ClassifierBackend(ABC):
+    """
+    A model classifying the main object of images.
+    Backends return results in the API format, {'matches': [{'name', 'score'}...]}, or None when the
+    image could not be classified, and raise when the model itself fails.
+    Calls made under the deadline of a request do not outlive it.
+    """
+    name = 'base'
+
+    @abstractmethod
+    def classify(self, img: Any) -> Optional[Dict]:
+        """
+        :param img: a PIL image or a {'mime_type', 'data'} blob
+        :return: the classification result, or None
+        """
+
+
+    def classify_batch(self, imgs: List[Any]) -> List[Optional[Dict]]:
+        """
+        Classify several images in one model call when the backend supports it.
+        :param imgs: PIL images or {'mime_type', 'data'} blobs
+        :return: the classification results in the order of the images
+        :raises ValueError: if the answer of the model does not match the images
+        """
+        return [self.classify(img) for img in imgs]
+
+
+    async def classify_async(self, img: Any) -> Optional[Dict]:
+        """
+        Same as classify(), for the async serving mode. Backends without an async client run in a thread.
+        """
+        return await asyncio.to_thread(self.classify, img)
+
+
+    async def classify_batch_async(self, imgs: List[Any]) -> List[Optional[Dict]]:
+        """
+        Same as classify_batch(), for the async serving mode.
+        """
+        return await asyncio.to_thread(self.classify_batch, imgs)
+
+
+class GeminiClassifier(ClassifierBackend):
+    """
+    Classification by the Gemini API.
+    """
+    name = 'gemini'
+
+    def __init__(self):
+        self.model = get_LLM_model()
+
+
+    def classify(self, img: Any) -> Optional[Dict]:
+        response = self.model.generate_content([SINGLE_PROMPT, img], stream=True, **model_request_options())
+        response.resolve()
+        return single_match(response.text)
+
+
+    def classify_batch(self, imgs: List[Any]) -> List[Optional[Dict]]:
+        if len(imgs) == 1:
+            return [self.classify(imgs[0])]
+        response = self.model.generate_content([batch_prompt(len(imgs))] + imgs,
+                                               generation_config={'response_mime_type': 'application/json'},
+                                               **model_request_options())
+        return parse_batch_answer(response.text, len(imgs))
+
+
+    async def classify_async(self, img: Any) -> Optional[Dict]:
+        response = await self.model.generate_content_async([SINGLE_PROMPT, img], **model_request_options())
+        return single_match(response.text)
+
+
+    async def classify_batch_async(self, imgs: List[Any]) -> List[Optional[Dict]]:
+        if len(imgs) == 1:
+            return [await self.classify_async(imgs[0])]
+        response = await self.model.generate_content_async([batch_prompt(len(imgs))] + imgs,
+                                                           generation_config={'response_mime_type': 'application/json'},
+                                                           **model_request_options())
+        return parse_batch_answer(response.text, len(imgs))
+
+
+class LocalClassifier(ClassifierBackend):
+    """
+    Classification on the CPU by an ImageNet ONNX model (e.g. MobileNetV2) with onnxruntime.
+    The model takes a 1x3x224x224 normalized float input; LOCAL_LABELS_PATH holds one class name per line.
+    """
+    name = 'local'
+
+    def __init__(self, model_path: str = LOCAL_MODEL_PATH, labels_path: str = LOCAL_LABELS_PATH,
+                 top_k: int = LOCAL_TOP_K):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The local classifier backend requires the onnxruntime package")
+        for path in (model_path, labels_path):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"The local classifier backend is missing {path}, the image api dockerfile "
+                                        f"downloads it")
+        self.session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        with open(labels_path, 'r') as file:
+            self.labels = [line.strip() for line in file if line.strip()]
+        self.top_k = top_k
+
+
+    def _tensor(self, img: Any) -> np.ndarray:
+        image = to_pil_image(img).resize((224, 224), PIL.Image.Resampling.BILINEAR)
+        pixels = (np.asarray(image, dtype=np.float32) / 255 - IMAGENET_MEAN) / IMAGENET_STD
+        return pixels.transpose(2, 0, 1)
+
+
+    def classify(self, img: Any) -> Optional[Dict]:
+        return self.classify_batch([img])[0]
+
+
+    def classify_batch(self, imgs: List[Any]) -> List[Optional[Dict]]:
+        # Inference cannot be interrupted, it is only skipped once the deadline passed
+        check_deadline()
+        batch = np.stack([self._tensor(img) for img in imgs])
+        # Models exported with a fixed batch size of 1 are run one image at a time
+        logits = np.concatenate([self.session.run(None, {self.input_name: tensor[None]})[0] for tensor in batch])
+        scores = np.exp(logits - logits.max(axis=1, keepdims=True))
+        scores /= scores.sum(axis=1, keepdims=True)
+        results = []
+        for image_scores in scores:
+            top = np.argsort(image_scores)[::-1][:self.top_k]
+            results.append({'matches': [{'name': self.labels[index], 'score': round(float(image_scores[index]), 4)}
+                                        for index in top]})
+        return results
+
+
+class FakeClassifier(ClassifierBackend):
+    """
+    Deterministic classifier for benchmarks and load tests, without any model.
+    The label is derived from the image content, the latency and the failures from a seeded random sequence.
+    A failure is a ConnectionError, so that it counts against the circuit breaker of the model limiter.
+    """
+    name = 'fake'
+
+    def __init__(self, latency: float = FAKE_LATENCY_SECONDS, jitter: float = FAKE_LATENCY_JITTER_SECONDS,
+                 error_rate: float = FAKE_ERROR_RATE, seed: int = FAKE_SEED):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+
+    def _label(self, img: Any) -> str:
+        digest = hashlib.sha256(to_bytes(img)).digest()
+        return FAKE_LABELS[digest[0] % len(FAKE_LABELS)]
+
+
+    def _draw(self) -> Tuple[float, bool]:
+        with self._lock:
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            failed = self._random.random() < self.error_rate
+        return delay, failed
+
+
+    def _timeout(self, delay: float) -> Optional[float]:
+        """
+        :param delay: latency of the call
+        :return: seconds after which the call times out like a model call cut at its deadline, None if it does not
+        """
+        remaining = remaining_seconds()
+        return max(remaining, 0.0) if remaining is not None and remaining < delay else None
+
+
+    def _answer(self, imgs: List[Any], failed: bool) -> List[Optional[Dict]]:
+        if failed:
+            raise ConnectionError('Fake classifier error')
+        return [single_match(self._label(img)) for img in imgs]
+
+
+    def classify(self, img: Any) -> Optional[Dict]:
+        return self.classify_batch([img])[0]
+
+
+    def classify_batch(self, imgs: List[Any]) -> List[Optional[Dict]]:
+        delay, failed = self._draw()
+        timeout = self._timeout(delay)
+        time.sleep(delay if timeout is None else timeout)
+        if timeout is not None:
+            raise DeadlineExceededError('The fake model call timed out')
+        return self._answer(imgs, failed)
+
+
+    async def classify_async(self, img: Any) -> Optional[Dict]:
+        return (await self.classify_batch_async([img]))[0]
+
+
+    async def classify_batch_async(self, imgs: List[Any]) -> List[Optional[Dict]]:
+        delay, failed = self._draw()
+        timeout = self._timeout(delay)
+        await asyncio.sleep(delay if timeout is None else timeout)
+        if timeout is not None:
+            raise DeadlineExceededError('The fake model call timed out')
+        return self._answer(imgs, failed)
+
+
+BACKENDS = {backend.name: backend for backend in (GeminiClassifier, LocalClassifier, FakeClassifier)}
+
+
+def create_classifier(name: str) -> ClassifierBackend:
+    """
+    :param name: 'gemini', 'local' or 'fake'
+    :return: a new classifier backend
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown classifier backend '{name}', expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name]()
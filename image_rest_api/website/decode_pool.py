@@ -0,0 +1,209 @@
+import os
+import time
+import asyncio
+import threading
+import multiprocessing
+import PIL.Image
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Optional, Tuple, Union
+from shared.utils import get_logger
+from shared.deadline import DeadlineExceededError, current_deadline
+from .ingestion import IngestedImage
+from .perceptual_index import HASH_FUNCTIONS
+from .preprocessing import preprocess_image, MIME_TYPES
+
+logger = get_logger()
+
+# Model input, perceptual hash and preprocessing stats of a decoded image
+Decoded = Tuple[Any, int, Dict[str, float]]
+
+
+def available_cores() -> int:
+    """
+    :return: number of cores this process may run on
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_workers() -> int:
+    """
+    :return: the cores shared evenly by the server worker processes, WEB_CONCURRENCY of gunicorn and uvicorn
+    """
+    server_workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+    return max(1, available_cores() // server_workers)
+
+
+def decode_upload(upload: IngestedImage, algorithm: str) -> Decoded:
+    """
+    Decode, shrink and hash an uploaded image.
+    :param upload: the validated upload
+    :param algorithm: perceptual hash algorithm, 'dhash' or 'phash'
+    :return: the model input, the perceptual hash and the preprocessing stats
+    """
+    model_input, image, stats = preprocess_image(upload)
+    image_hash = HASH_FUNCTIONS[algorithm](image)
+    if isinstance(model_input, PIL.Image.Image):
+        # Preprocessing is disabled: the upload is sent as is rather than pickling the decoded pixels back
+        model_input = {'mime_type': MIME_TYPES[upload.format], 'data': upload.read()}
+    return model_input, image_hash, stats
+
+
+def decode_image(source: Union[str, bytes, IngestedImage], algorithm: str, submitted_at: float,
+                 deadline: Optional[float] = None) -> Decoded:
+    """
+    Decode, check, shrink and hash an uploaded image, in a process of the pool.
+    :param source: path of the file of the uploaded image, its content if it is only in memory, or the upload
+                   itself when decoding in the calling thread
+    :param algorithm: perceptual hash algorithm, 'dhash' or 'phash'
+    :param submitted_at: time at which the image was submitted to the pool
+    :param deadline: deadline of the request of the image, None if it has none
+    :return: the model input, the perceptual hash and the preprocessing stats, with the time spent in the pool queue
+    :raises DeadlineExceededError: if the deadline passed while the image waited in the pool queue
+    """
+    now = time.time()
+    if deadline is not None and now >= deadline:
+        raise DeadlineExceededError('The deadline of the request passed before its image was decoded')
+    queue_ms = max(0.0, (now - submitted_at) * 1000)
+    if isinstance(source, str):
+        with open(source, 'rb') as file:
+            model_input, image_hash, stats = decode_upload(IngestedImage(file), algorithm)
+    elif isinstance(source, bytes):
+        model_input, image_hash, stats = decode_upload(IngestedImage.from_bytes(source), algorithm)
+    else:
+        model_input, image_hash, stats = decode_upload(source, algorithm)
+    stats['queue_ms'] = queue_ms
+    return model_input, image_hash, stats
+
+
+class DecodePool:
+    """
+    Process pool decoding the uploaded images, so that PIL decoding, resizing and re-encoding do not hold
+    the GIL of the threads and the event loop serving the requests.
+    An upload spooled to a file is handed to the pool as its path, only the small uploads kept in memory as bytes,
+    so that the memory of a server worker does not grow with the size of the uploads. Images come back as the
+    small re-encoded model input.
+    An image whose request deadline passed while it waited in the pool queue is dropped without decoding.
+    With 0 workers, images are decoded in the calling thread.
+    """
+    def __init__(self, workers: int, algorithm: str):
+        """
+        :param workers: number of decoding processes of this server worker, 0 to decode in the calling thread
+        :param algorithm: perceptual hash algorithm, 'dhash' or 'phash'
+        """
+        self.workers = workers
+        self.algorithm = algorithm
+        self.decoded = 0
+        self._pending = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+
+    def start(self) -> None:
+        """
+        Create the process pool of this server worker.
+        Called from the app factory, so that the pool belongs to the gunicorn worker, not to the master process.
+        """
+        with self._lock:
+            if self._executor is None and self.workers > 0:
+                # Processes are spawned, forking a process running Mongo and limiter threads could copy held locks
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                # Spawned and imported now rather than in the queue time of the first images
+                for _ in range(self.workers):
+                    self._executor.submit(available_cores)
+
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._pending -= 1
+            self.decoded += 1
+
+
+    def submit(self, upload: IngestedImage) -> Future:
+        """
+        Start decoding an image.
+        :param upload: the validated upload, whose file must stay open until it is decoded
+        :return: a future of the model input, the perceptual hash and the preprocessing stats
+        """
+        deadline = current_deadline()
+        if self.workers <= 0:
+            future = Future()
+            try:
+                future.set_result(decode_image(upload, self.algorithm, time.time(), deadline))
+            except Exception as e:
+                future.set_exception(e)
+            with self._lock:
+                self.decoded += 1
+            return future
+        self.start()
+        executor = self._executor
+        source = upload.path if upload.path is not None else upload.read()
+        try:
+            future = executor.submit(decode_image, source, self.algorithm, time.time(), deadline)
+        except BrokenProcessPool:
+            self._restart(executor)
+            return self.submit(upload)
+        with self._lock:
+            self._pending += 1
+        # Kept to restart this very pool if it breaks while decoding the image
+        future.executor = executor
+        future.add_done_callback(self._done)
+        return future
+
+
+    def _restart(self, executor: ProcessPoolExecutor) -> None:
+        """
+        Replace a pool whose process died, e.g. killed while decoding a hostile image.
+        :param executor: the broken pool, left alone if another thread already replaced it
+        """
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        logger.warning('A decoding process died, restarting the decode pool')
+        executor.shutdown(wait=False)
+
+
+    def result(self, future: Future, upload: IngestedImage) -> Decoded:
+        """
+        :param future: future returned by submit
+        :param upload: the upload, decoded again if the pool broke while decoding it
+        :return: the model input, the perceptual hash and the preprocessing stats
+        :raises OSError: if the image cannot be decoded
+        """
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self._restart(future.executor)
+            return self.submit(upload).result()
+
+
+    def decode(self, upload: IngestedImage) -> Decoded:
+        """
+        :param upload: the validated upload
+        :return: the model input, the perceptual hash and the preprocessing stats
+        :raises OSError: if the image cannot be decoded
+        """
+        return self.result(self.submit(upload), upload)
+
+
+    async def decode_async(self, upload: IngestedImage) -> Decoded:
+        """
+        Same as decode, awaited without holding a thread of the event loop.
+        """
+        future = self.submit(upload)
+        try:
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            self._restart(future.executor)
+            return await asyncio.wrap_future(self.submit(upload))
+
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: the decoding processes, and the images waiting for or being decoded, and decoded, for /status
+        """
+        return {'workers': self.workers, 'pending': self._pending, 'decoded': self.decoded}
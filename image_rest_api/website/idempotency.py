@@ -0,0 +1,183 @@
+import os
+import time
+import socket
+import asyncio
+import datetime
+from typing import Any, Dict, Optional
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+from shared.deadline import check_deadline, remaining_seconds
+from shared.utils import get_logger
+
+logger = get_logger()
+
+RUNNING = 'running'
+DONE = 'done'
+
+
+class IdempotencyConflictError(Exception):
+    """
+    Raised when an idempotency key is reused with another image than the one of its first request.
+    """
+
+
+class IdempotencyInProgressError(Exception):
+    """
+    Raised when the first request of an idempotency key is still running after the wait of a retry.
+    """
+
+
+class IdempotencyStore:
+    """
+    Responses of the requests sent with an Idempotency-Key header, so that a retry of a request gets its
+    original response instead of classifying the image again.
+    The first request of a key inserts a 'running' document holding a lease, runs, then stores its response
+    in the document until the TTL index removes it. A retry that finds the response replays it; a retry
+    that arrives while the first request runs waits for its response, or runs itself if the lease expires,
+    e.g. because the worker of the first request died. A retry never waits past its own deadline.
+    """
+    def __init__(self, collection: Collection, ttl_seconds: float, lease_seconds: float, poll_seconds: float,
+                 wait_seconds: float):
+        """
+        :param collection: Mongo collection of the idempotency keys
+        :param ttl_seconds: seconds a response is kept for the retries
+        :param lease_seconds: seconds after which the request of a dead worker can be run again
+        :param poll_seconds: initial interval between two checks of a running request
+        :param wait_seconds: maximum seconds a retry waits for a running request
+        """
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.wait_seconds = wait_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+
+    def ensure_indexes(self) -> None:
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+
+    def _key_id(self, scope: str, key: str) -> str:
+        return f"{scope}:{key}"
+
+
+    def _try_begin(self, scope: str, key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """
+        :return: None if the caller now runs the request, otherwise the document of the key,
+                 done or running under the lease of another request
+        :raises IdempotencyConflictError: if the key was used for another image
+        """
+        now = datetime.datetime.utcnow()
+        lease_expires = now + datetime.timedelta(seconds=self.lease_seconds)
+        running = {'state': RUNNING, 'fingerprint': fingerprint, 'owner': self.owner, 'lease_expires': lease_expires,
+                   'expires_at': lease_expires + datetime.timedelta(seconds=self.ttl_seconds)}
+        try:
+            self.collection.insert_one({'_id': self._key_id(scope, key), **running})
+            return None
+        except DuplicateKeyError:
+            pass
+        document = self.collection.find_one({'_id': self._key_id(scope, key)})
+        if document is None:
+            # Removed by the TTL index, or released by a failed request, in the meantime
+            return self._try_begin(scope, key, fingerprint)
+        if document['fingerprint'] != fingerprint:
+            raise IdempotencyConflictError('The Idempotency-Key was already used with another image')
+        if document['state'] == RUNNING and document['lease_expires'] < now:
+            taken_over = self.collection.find_one_and_update(
+                {'_id': document['_id'], 'state': RUNNING, 'lease_expires': document['lease_expires']},
+                {'$set': running},
+            )
+            if taken_over is not None:
+                logger.warning(f"Lease of idempotency key {key} expired, running its request again")
+                return None
+            return self._try_begin(scope, key, fingerprint)
+        return document
+
+
+    def _wait_until(self) -> float:
+        """
+        :return: the time until which a retry waits for the first request, wait_seconds from now at most,
+                 and no later than the deadline of the retry
+        """
+        remaining = remaining_seconds()
+        return time.time() + (self.wait_seconds if remaining is None else min(self.wait_seconds, max(remaining, 0)))
+
+
+    def _check_wait(self, wait_until: float) -> None:
+        """
+        :raises DeadlineExceededError: if the deadline of the retry passed
+        :raises IdempotencyInProgressError: if the retry waited wait_seconds
+        """
+        if time.time() >= wait_until:
+            check_deadline()
+            raise IdempotencyInProgressError('A request with this Idempotency-Key is still running')
+
+
+    def begin(self, scope: str, key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """
+        Start the request of an idempotency key, or get its response.
+        :param scope: name of the endpoint, keys of different endpoints do not collide
+        :param key: the Idempotency-Key header
+        :param fingerprint: content hash of the uploaded image
+        :return: None if the caller has to run the request and then call finish() or release(),
+                 otherwise the stored response, with its 'body' and 'code'
+        :raises IdempotencyConflictError: if the key was used for another image
+        :raises IdempotencyInProgressError: if the first request of the key is still running after wait_seconds
+        :raises DeadlineExceededError: if the deadline of the retry passes while the first request runs
+        """
+        wait_until = self._wait_until()
+        interval = self.poll_seconds
+        while True:
+            document = self._try_begin(scope, key, fingerprint)
+            if document is None:
+                return None
+            if document['state'] == DONE:
+                return document['response']
+            self._check_wait(wait_until)
+            time.sleep(min(interval, wait_until - time.time()))
+            interval = min(interval * 2, 2.0)
+
+
+    async def begin_async(self, scope: str, key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """
+        Same as begin, waiting for a running request without holding a thread.
+        """
+        wait_until = self._wait_until()
+        interval = self.poll_seconds
+        while True:
+            document = await asyncio.to_thread(self._try_begin, scope, key, fingerprint)
+            if document is None:
+                return None
+            if document['state'] == DONE:
+                return document['response']
+            self._check_wait(wait_until)
+            await asyncio.sleep(min(interval, wait_until - time.time()))
+            interval = min(interval * 2, 2.0)
+
+
+    def finish(self, scope: str, key: str, body: Any, code: int) -> None:
+        """
+        Store the response of a request, for its retries.
+        :param scope: name of the endpoint
+        :param key: the Idempotency-Key header
+        :param body: JSON body of the response
+        :param code: HTTP status code of the response
+        """
+        self.collection.update_one(
+            {'_id': self._key_id(scope, key), 'owner': self.owner},
+            {'$set': {'state': DONE, 'response': {'body': body, 'code': code},
+                      'expires_at': datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl_seconds)},
+             '$unset': {'lease_expires': ''}},
+        )
+
+
+    def release(self, scope: str, key: str) -> None:
+        """
+        Forget a request that failed without a response worth replaying, so that a retry runs it again.
+        :param scope: name of the endpoint
+        :param key: the Idempotency-Key header
+        """
+        try:
+            self.collection.delete_one({'_id': self._key_id(scope, key), 'state': RUNNING, 'owner': self.owner})
+        except Exception as e:
+            logger.warning(f"Idempotency key release failed: {e}")
@@ -1,82 +1,549 @@
 import os 
 import sys
+import json
 import time
-import random
+import datetime
 import PIL.Image
-from io import BytesIO
-import concurrent.futures
-from typing import Union, Optional, Dict, Any
-from flask import Blueprint, request, redirect, url_for, Response, current_app
+from typing import IO, Union, Optional, Dict, Any, List, Tuple, Callable
+from flask import Blueprint, request, redirect, url_for, Response, current_app, stream_with_context
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 from shared.utils import *
-from shared.constants import MONGO_CLIENT
+from shared.constants import *
+from shared.monitor import MonitorCounters
+from shared.metrics import track_latency, observe_latency, observe_micro_batch
+from shared.limiter import OverloadedError, INTERACTIVE, BATCH
+from shared.deadline import DeadlineExceededError, check_deadline, current_deadline, deadline_exceeded_body
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+from pymongo.write_concern import WriteConcern
+from werkzeug.exceptions import RequestEntityTooLarge
+from .result_cache import ClassificationCache, FAILED
+from .ingestion import IngestedImage, InvalidImageError
+from .perceptual_index import PerceptualIndex
+from .job_queue import JobQueue, QueueFullError
+from .idempotency import IdempotencyStore, IdempotencyConflictError, IdempotencyInProgressError
+from .singleflight import SingleFlight, Flight, LEADER, FOLLOWER, MISSING
+from .decode_pool import DecodePool, default_workers
+from .micro_batching import MicroBatcher
+from .result_notifier import ResultNotifier
+from .webhooks import WebhookDispatcher, Delivery, is_valid_callback_url
+from .write_behind import WriteBehindWriter
+from .classifiers import ClassifierBackend, create_classifier
 
-model = get_LLM_model()
+logger = get_logger()
+
+
+def create_fallback_classifier(name: str) -> Optional[ClassifierBackend]:
+    """
+    A fallback backend that cannot be loaded, e.g. without its model file, disables the failover instead of
+    failing the startup: the service still runs on its main backend.
+    Args:
+        name (str): The fallback backend, empty for none.
+    Returns:
+        Optional[ClassifierBackend]: The loaded fallback backend, None if there is none.
+    """
+    if not name:
+        return None
+    try:
+        fallback = create_classifier(name)
+    except Exception as e:
+        logger.error(f"The fallback classifier backend '{name}' could not be loaded, failover is disabled: {e}")
+        return None
+    logger.info(f"Calls shed by the main classifier backend fail over to the '{name}' backend")
+    return fallback
+
+
+classifier = create_classifier(CLASSIFIER_BACKEND)
+fallback_classifier = create_fallback_classifier(CLASSIFIER_FALLBACK_BACKEND)
+model_limiter = get_model_limiter(classifier.name)
 
 # Define Blueprint
 image_api = Blueprint('image_api', __name__)
 
 db = MONGO_CLIENT['image_rest_api']
-monitor_collection = db['monitor_health']
+monitor = MonitorCounters(db['monitor_health'], MONITOR_FLUSH_SECONDS, MONITOR_STALE_SECONDS)
 request_collection = db['request_track']
+result_cache = ClassificationCache(db['classification_cache'], CACHE_MAX_ENTRIES,
+                                   CACHE_TTL_SECONDS, CACHE_NEGATIVE_TTL_SECONDS)
+perceptual_index = PerceptualIndex(db['image_hashes'], PHASH_ALGORITHM, PHASH_MAX_DISTANCE, PHASH_REFRESH_SECONDS)
+singleflight = SingleFlight(request_collection, SINGLEFLIGHT_LEASE_SECONDS, SINGLEFLIGHT_POLL_SECONDS,
+                            SINGLEFLIGHT_WAIT_SECONDS)
+result_notifier = ResultNotifier(request_collection, RESULT_WAIT_RECHECK_SECONDS)
+idempotency = IdempotencyStore(db['idempotency_keys'], IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_LEASE_SECONDS,
+                               IDEMPOTENCY_POLL_SECONDS, IDEMPOTENCY_WAIT_SECONDS)
+decode_pool = DecodePool(DECODE_POOL_WORKERS if DECODE_POOL_WORKERS >= 0 else default_workers(), PHASH_ALGORITHM)
+
+# Fields of a request_track document needed to answer /result
+RESULT_PROJECTION = {'_id': 0, 'status': 1, 'classification_result': 1, 'linked_to': 1}
+# Only writes that can be lost with the worker are written behind, e.g. webhook outcomes
+writer = WriteBehindWriter(request_collection, WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_MAX_DELAY_SECONDS,
+                           WriteConcern(w=REQUEST_WRITE_CONCERN_W, j=REQUEST_WRITE_CONCERN_J))
+
+
+def request_expiry(pending: bool = False) -> datetime.datetime:
+    """
+    :param pending: True for a job that has not finished yet
+    :return: the time at which the TTL index of request_track removes the job
+    """
+    ttl = REQUEST_PENDING_TTL_SECONDS if pending else REQUEST_TTL_SECONDS
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+
+
+def ensure_request_indexes() -> None:
+    """
+    Create the indexes of request_track: unique job ids, pending jobs by content hash, and expiry of old jobs.
+    """
+    try:
+        request_collection.create_index('request_id', unique=True)
+    except OperationFailure as e:
+        # Jobs of the former random ids may collide, they expire with the TTL index below
+        logger.warning(f"Unique request_id index not created: {e}")
+    request_collection.create_index('digest')
+    request_collection.create_index('expires_at', expireAfterSeconds=0)
+    # Jobs written before the TTL index existed would otherwise never expire
+    request_collection.update_many({'expires_at': {'$exists': False}}, {'$set': {'expires_at': request_expiry()}})
+
+
+def record_webhook_outcome(delivery: Delivery, delivered: bool) -> None:
+    """
+    Record the outcome of a webhook delivery on its request and in the monitor status.
+    :param delivery: the finished delivery
+    :param delivered: True if the receiver accepted it
+    """
+    outcome = 'delivered' if delivered else 'failed'
+    writer.update({'request_id': delivery.request_id}, {'webhook': {'status': outcome, 'attempts': delivery.attempts}})
+    increment_monitor_counters(monitor, **{f'webhooks.{outcome}': 1})
+
+
+webhooks = WebhookDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_DEPTH, WEBHOOK_MAX_ATTEMPTS, WEBHOOK_BACKOFF_SECONDS,
+                             WEBHOOK_MAX_BACKOFF_SECONDS, WEBHOOK_TIMEOUT_SECONDS, WEBHOOK_ALLOWED_HOSTS,
+                             on_done=record_webhook_outcome)
+job_queue = JobQueue(request_collection, ASYNC_WORKERS, JOB_QUEUE_MAX_DEPTH, JOB_LEASE_SECONDS, JOB_HEARTBEAT_SECONDS,
+                     JOB_MAX_ATTEMPTS, JOB_RETRY_BACKOFF_SECONDS, JOB_POLL_SECONDS, JOB_INLINE_IMAGE_BYTES,
+                     handler=lambda image: execute_async_upload_image(image),
+                     result_fields=lambda result: request_result_fields(result),
+                     on_done=lambda request_id: publish_result(request_id))
+
+
+def call_classifier(call: Callable[[ClassifierBackend], Any], lane: str = INTERACTIVE) -> Any:
+    """
+    Call the configured classifier backend within the model concurrency limit.
+    When the call is shed and a fallback backend is configured, the fallback answers instead.
+    :param call: function calling a backend
+    :param lane: INTERACTIVE for calls a user waits on, BATCH for async jobs
+    :return: the result of the call
+    :raises OverloadedError: if the call is shed and there is no fallback backend
+    :raises DeadlineExceededError: if the deadline of the request passed before the call answered
+    """
+    try:
+        try:
+            # Timed within the limiter, the time queued for a slot is not latency of the model
+            with model_limiter.call(lane), track_latency('model'):
+                return call(classifier)
+        except OverloadedError:
+            if fallback_classifier is None:
+                raise
+        increment_monitor_counters(monitor, fallback_calls=1)
+        with track_latency('model'):
+            return call(fallback_classifier)
+    except (OverloadedError, DeadlineExceededError):
+        raise
+    except Exception:
+        # A model call cut at the deadline is not a failure of the image, it must not be negatively cached
+        check_deadline()
+        raise
 
 
-def classify_image(img: str) -> Optional[Dict]:
+def classify_image(img: Any, lane: str = INTERACTIVE) -> Optional[Dict]:
     """
     Classify an uploaded image.
-    This function uses the Gemini API to classify the main object in an image.
+    This function uses the configured classifier backend to classify the main object in an image.
     Args:
-        image_path (str): The path to the image file.
+        img (Any): The image, in any format accepted by the backend.
+        lane (str): The priority lane of the model call.
     Returns:
-        Optional[str]: The classification result, or None if classification fails.
+        Optional[Dict]: The classification result, or None if classification fails.
     """
     try:
-        response = model.generate_content(["What is the main object in the photo? answer just in one word- the main object", img], stream=True)
-        response.resolve()
-        classification = response.text
-
-
-        if classification:
-            return {'matches': [{'name': classification, 'score': 0.9}]}
-        else:
-            return None
+        return call_classifier(lambda backend: backend.classify(img), lane)
+    except (OverloadedError, DeadlineExceededError):
+        raise
     except Exception as e:
         return None
 
 
-@image_api.route('/', methods=['GET'])
-def home() -> Response:
+def classify_images(imgs: List[Any], lane: str = INTERACTIVE) -> List[Optional[Dict]]:
     """
-    Redirect to the login page.
-    This view function redirects to the login page if accessed.
+    Classify several images, packing up to BATCH_MAX_IMAGES of them in a single model call.
+    If the backend fails or its answer cannot be matched to the images, each image of that chunk
+    is classified on its own instead.
+    Args:
+        imgs (List[Any]): The images to classify, in any format accepted by the backend.
+        lane (str): The priority lane of the model calls.
     Returns:
-        Response: A redirect response to the login page.
+        List[Optional[Dict]]: The classification results in the order of the images, None where classification failed.
     """
-    return redirect(url_for('views.upload_image'))
+    if len(imgs) == 1:
+        return [classify_image(imgs[0], lane)]
+    results = []
+    for start in range(0, len(imgs), BATCH_MAX_IMAGES):
+        chunk = imgs[start:start + BATCH_MAX_IMAGES]
+        try:
+            results.extend(call_classifier(lambda backend: backend.classify_batch(chunk), lane))
+        except (OverloadedError, DeadlineExceededError):
+            raise
+        except Exception as e:
+            results.extend(classify_image(img, lane) for img in chunk)
+    return results
 
 
-@image_api.route('/status', methods=['GET'])
-def status() -> Response:
+def record_micro_batch(lane: str, size: int, waits: List[float]) -> None:
     """
-    :return: A JSON response with the status of the API.
+    Record the size of a micro-batch and the time its images waited for it, in the monitor status and the metrics.
+    :param lane: priority lane of the batch
+    :param size: number of images of the batch
+    :param waits: seconds every image waited
     """
-    montor_dict = monitor_collection.find_one()
+    increment_monitor_counters(monitor, **{'micro_batch.batches': 1, 'micro_batch.images': size,
+                                           'micro_batch.wait_ms': sum(waits) * 1000, f'micro_batch.sizes.{size}': 1})
+    observe_micro_batch(lane, size, waits)
+
+
+micro_batcher = MicroBatcher(classify_images, MICRO_BATCH_MAX_IMAGES, MICRO_BATCH_MAX_WINDOW_SECONDS,
+                             on_batch=record_micro_batch)
+
+
+def record_preprocess_stats(stats: Dict[str, float]) -> None:
+    """
+    Accumulate the bytes saved and the time spent per preprocessing stage in the monitor status.
+    :param stats: stats returned by the decode pool
+    """
+    increment_monitor_counters(monitor, **{f'preprocess.{name}': value for name, value in stats.items()},
+                               **{'preprocess.images': 1})
+    if 'decode_ms' in stats:
+        observe_latency('decode', stats['decode_ms'] / 1000)
+    observe_latency('decode_queue', stats['queue_ms'] / 1000)
+
+
+def classify_images_data(uploads: List[IngestedImage], lane: str = INTERACTIVE) -> List[Optional[Dict]]:
+    """
+    Classify uploaded images, going through the result cache.
+    Images missing from the cache are decoded and shrunk in parallel by the decode pool.
+    Identical uploads are answered from the cache instead of calling the model again,
+    and images that recently failed classification are not sent to the model until
+    their negative cache entry expires. Re-encoded or resized copies of a known image
+    are found through the perceptual hash index and reuse its classification.
+    An image that is already being classified by another request, in this worker or in
+    another one, waits for that classification instead of calling the model again.
+    The remaining images are classified together, each distinct image once; a single remaining
+    image goes through the micro-batcher, which sends it with those of concurrent requests.
+    Args:
+        uploads (List[IngestedImage]): The validated uploads.
+        lane (str): The priority lane of the model calls, INTERACTIVE or BATCH.
+    Returns:
+        List[Optional[Dict]]: The classification results in the order of the images, None where classification failed.
+    Raises:
+        DeadlineExceededError: If the deadline of the request passed before its images were classified.
+    """
+    results: List[Optional[Dict]] = [None] * len(uploads)
+    to_decode, to_classify, to_wait = [], [], []
+    duplicates: Dict[str, List[int]] = {}
+    for index, upload in enumerate(uploads):
+        key = upload.digest
+        if key in duplicates:
+            duplicates[key].append(index)
+            continue
+        cached = result_cache.get(key)
+        if cached is not None:
+            increment_monitor_counters(monitor, cache_hits=1)
+            results[index] = None if cached == FAILED else cached
+            continue
+        duplicates[key] = []
+        # All the images are decoded in parallel by the decode pool
+        to_decode.append((index, key, upload, decode_pool.submit(upload)))
+
+    # The flights this request started, to its followers it hands over the ones it could not finish
+    flights: List[Tuple[str, Flight]] = []
+    try:
+        for index, key, upload, decoding in to_decode:
+            try:
+                model_input, image_hash, preprocess_stats = decode_pool.result(decoding, upload)
+            except (PIL.UnidentifiedImageError, InvalidImageError, OSError):
+                result_cache.set(key, None)
+                continue
+            record_preprocess_stats(preprocess_stats)
+            classification_result = perceptual_index.lookup(image_hash)
+            if classification_result is not None:
+                increment_monitor_counters(monitor, near_duplicate_hits=1)
+                result_cache.set(key, classification_result)
+                for duplicate_index in [index] + duplicates[key]:
+                    results[duplicate_index] = classification_result
+                continue
+            role, flight = singleflight.begin(key)
+            if role != FOLLOWER:
+                flights.append((key, flight))
+            if role == LEADER:
+                to_classify.append((index, key, model_input, image_hash, flight))
+            else:
+                to_wait.append((index, key, model_input, image_hash, flight, role))
+
+        def classify_and_publish(pending: List[Tuple]) -> None:
+            increment_monitor_counters(monitor, cache_misses=len(pending))
+            classification_results = [MISSING] * len(pending)
+            try:
+                model_inputs = [model_input for _, _, model_input, _, _ in pending]
+                if len(model_inputs) == 1 and MICRO_BATCH_MAX_IMAGES > 1:
+                    # Single images of concurrent requests share a model call
+                    classification_results = [micro_batcher.classify(model_inputs[0], lane)]
+                else:
+                    classification_results = classify_images(model_inputs, lane)
+            finally:
+                for (index, key, _, image_hash, flight), classification_result in zip(pending, classification_results):
+                    if classification_result is not MISSING:
+                        result_cache.set(key, classification_result)
+                        if classification_result is not None:
+                            perceptual_index.add(image_hash, key, classification_result)
+                        for duplicate_index in [index] + duplicates[key]:
+                            results[duplicate_index] = classification_result
+                    if flight is not None:
+                        singleflight.finish(key, flight, classification_result)
+
+        if to_classify:
+            classify_and_publish(to_classify)
+
+        for index, key, model_input, image_hash, flight, role in to_wait:
+            if role == FOLLOWER:
+                classification_result = singleflight.wait(flight)
+                if classification_result is MISSING:
+                    flight = None
+            else:
+                classification_result = singleflight.wait_remote(key, flight, lambda: result_cache.get(key))
+            if classification_result is MISSING:
+                classify_and_publish([(index, key, model_input, image_hash, flight)])
+                continue
+            increment_monitor_counters(monitor, coalesced=1)
+            classification_result = None if classification_result == FAILED else classification_result
+            for duplicate_index in [index] + duplicates[key]:
+                results[duplicate_index] = classification_result
+        return results
+    finally:
+        # e.g. after the deadline passed, the model call failed or was shed
+        for key, flight in flights:
+            if not flight.event.is_set():
+                singleflight.finish(key, flight, MISSING)
+
+
+def classify_image_data(upload: IngestedImage, lane: str = INTERACTIVE) -> Optional[Dict]:
+    """
+    Classify an uploaded image, going through the result cache.
+    Args:
+        upload (IngestedImage): The validated upload.
+        lane (str): The priority lane of the model call.
+    Returns:
+        Optional[Dict]: The classification result, or None if classification fails.
+    """
+    return classify_images_data([upload], lane)[0]
+
+
+def ingest_image_file(image: Any) -> Tuple[Optional[IngestedImage], Optional[str]]:
+    """
+    Validate an uploaded image file from its content rather than its filename.
+    Args:
+        image (FileStorage): The uploaded file.
+    Returns:
+        Tuple[Optional[IngestedImage], Optional[str]]: The validated upload, or None and the validation error message.
+    """
+    try:
+        return IngestedImage(image.stream), None
+    except InvalidImageError as e:
+        return None, str(e)
+
+
+def get_idempotency_key(headers: Any) -> Optional[str]:
+    """
+    :param headers: headers of the request
+    :return: the Idempotency-Key header, None if there is none
+    :raises ValueError: if the key is empty or too long
+    """
+    key = headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ValueError(f'The Idempotency-Key must have 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters')
+    return key
+
+
+def idempotent_response(scope: str, fingerprint: str, respond: Callable[[], Response]) -> Response:
+    """
+    Answer a request once per Idempotency-Key header.
+    The successful response of the first request of a key is stored and replayed to its retries, with an
+    Idempotent-Replayed header; a retry arriving while the first request runs waits for its response.
+    Failed requests are not stored, their retries run again.
+    Args:
+        scope (str): The name of the endpoint.
+        fingerprint (str): The content hash of the uploaded image, a key reused for another image is rejected.
+        respond (Callable[[], Response]): Runs the request.
+    Returns:
+        Response: The response of the request, or of the first request of its key.
+    """
+    try:
+        key = get_idempotency_key(request.headers)
+    except ValueError as e:
+        return create_json_response({'error': {'code': 400, 'message': str(e)}}, 400)
+    if key is None:
+        return respond()
+    try:
+        stored = idempotency.begin(scope, key, fingerprint)
+    except IdempotencyConflictError as e:
+        return create_json_response({'error': {'code': 422, 'message': str(e)}}, 422)
+    except IdempotencyInProgressError as e:
+        response = create_json_response({'error': {'code': 409, 'message': str(e)}}, 409)
+        response.headers['Retry-After'] = str(max(1, int(round(IDEMPOTENCY_POLL_SECONDS))))
+        return response
+    if stored is not None:
+        increment_monitor_counters(monitor, idempotent_replays=1)
+        response = create_json_response(stored['body'], stored['code'])
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    try:
+        response = respond()
+    except Exception:
+        idempotency.release(scope, key)
+        raise
+    if response.status_code < 300:
+        idempotency.finish(scope, key, response.get_json(), response.status_code)
+    else:
+        idempotency.release(scope, key)
+    return response
+
+
+@image_api.before_request
+def reject_oversized_upload() -> Optional[Response]:
+    """
+    Reject a request from its Content-Length before its body is read.
+    Returns:
+        Optional[Response]: A 413 JSON response if the body is too large, None otherwise.
+    """
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return create_json_response({'error': {'code': 413, 'message': f'The upload is larger than {MAX_UPLOAD_BYTES} bytes'}}, 413)
+    return None
+
+
+@image_api.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e: RequestEntityTooLarge) -> Response:
+    """
+    Answer in JSON when a body without Content-Length turns out to be too large while it is read.
+    """
+    return create_json_response({'error': {'code': 413, 'message': f'The upload is larger than {MAX_UPLOAD_BYTES} bytes'}}, 413)
+
+
+@image_api.errorhandler(OverloadedError)
+def model_overloaded(e: OverloadedError) -> Response:
+    """
+    Shed the request with a 503 when the model is too slow or failing, instead of queueing it.
+    """
+    return create_retry_after_response(str(e), e.retry_after)
+
+
+@image_api.errorhandler(DeadlineExceededError)
+def deadline_exceeded(e: DeadlineExceededError) -> Response:
+    """
+    Answer with a 504 once the deadline of the request passed, its client stopped waiting for the classification.
+    """
+    increment_monitor_counters(monitor, **{'deadlines.exceeded': 1})
+    return create_json_response(deadline_exceeded_body(e), 504)
+
+
+def preprocess_summary(totals: Dict[str, float]) -> Dict[str, float]:
+    """
+    :param totals: accumulated preprocessing stats
+    :return: images preprocessed, bytes saved and average milliseconds per stage
+    """
+    images = totals.get('images', 0)
+    summary = {'images': images, 'bytes_saved': totals.get('bytes_in', 0) - totals.get('bytes_out', 0)}
+    for stage in ['queue', 'decode', 'resize', 'encode']:
+        summary[f'avg_{stage}_ms'] = totals.get(f'{stage}_ms', 0) / images if images else 0
+    return summary
+
+
+def micro_batch_summary(totals: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    :param totals: accumulated micro-batch stats
+    :return: model calls and images of the micro-batches, their average size and wait, and the count of every size
+    """
+    batches, images = totals.get('batches', 0), totals.get('images', 0)
+    return {
+        'batches': batches,
+        'images': images,
+        'avg_batch_size': images / batches if batches else 0,
+        'avg_wait_ms': totals.get('wait_ms', 0) / images if images else 0,
+        'sizes': {size: totals['sizes'][size] for size in sorted(totals.get('sizes', {}), key=int)},
+        **micro_batcher.window.state(),
+    }
+
+
+def status_data() -> Dict[str, Any]:
+    """
+    :return: the status of the API: the counters of all its workers since the monitor collection was created,
+        and the work in progress of the live workers
+    """
+    montor_dict = monitor.snapshot()
+    # Model calls waiting for a slot in this worker, and async jobs waiting in the shared queue
+    limiter_state = model_limiter.state()
+    lanes = limiter_state.pop('lanes')
+    jobs = job_queue.stats()
+    lanes[BATCH].update({'jobs_queued': jobs['queued'], 'jobs_running': jobs['running_here']})
     data = {
         'uptime': time.time() - montor_dict['start_time'],
         'processed': {
             'success': montor_dict['success'],
             'fail': montor_dict['fail'],     
             'running': montor_dict['running'],
-            'queued': 0 
+            'queued': jobs['queued']
+        },
+        'jobs': jobs,
+        'cache': {
+            'hits': montor_dict.get('cache_hits', 0),
+            'near_duplicate_hits': montor_dict.get('near_duplicate_hits', 0),
+            'coalesced': montor_dict.get('coalesced', 0),
+            'idempotent_replays': montor_dict.get('idempotent_replays', 0),
+            'misses': montor_dict.get('cache_misses', 0)
+        },
+        'preprocessing': preprocess_summary(montor_dict.get('preprocess', {})),
+        'decode_pool': decode_pool.stats(),
+        'micro_batching': micro_batch_summary(montor_dict.get('micro_batch', {})),
+        'deadlines': {
+            'exceeded': montor_dict.get('deadlines', {}).get('exceeded', 0),
+            'client_disconnects': montor_dict.get('deadlines', {}).get('client_disconnects', 0)
+        },
+        'webhooks': {
+            'queued': webhooks.queued,
+            'delivered': montor_dict.get('webhooks', {}).get('delivered', 0),
+            'failed': montor_dict.get('webhooks', {}).get('failed', 0)
+        },
+        'write_behind': writer.stats(),
+        'model_limiter': limiter_state,
+        'lanes': lanes,
+        'classifier': {
+            'backend': classifier.name,
+            'fallback_backend': fallback_classifier.name if fallback_classifier is not None else None,
+            'fallback_calls': montor_dict.get('fallback_calls', 0)
         },
         'health': 'ok',
         'api_version': 0.3,
     }
-    return create_json_response({'status': data}, 200)
+    return data
+
+
+@image_api.route('/status', methods=['GET'])
+def status() -> Response:
+    """
+    :return: A JSON response with the status of the API.
+    """
+    return create_json_response({'status': status_data()}, 200)
 
 
 @image_api.route('/upload_image', methods=['POST'])
-@monitor_status(monitor_collection)
+@monitor_status(monitor)
 def upload_image() -> Union[Response, str]:
     """
     Handle sync image upload and classification.
@@ -88,59 +555,141 @@ def upload_image() -> Union[Response, str]:
     """
     if request.method == 'POST': 
         if 'image' in request.files:
-            image = request.files['image']
-            if '.' not in image.filename:
-                return create_json_response({'error': {'code': 400, 'message': "The filename invalid"}},400)
-            if image.filename.split('.')[0] == '':
-                return create_json_response({'error': {'code': 400, 'message': "The filename empty"}},400)
-            if image.filename.split('.')[1].lower() not in ['png', 'jpg', 'jpeg']: # Unsupported file
-                return create_json_response({'error': {'code': 400, 'message': "Support image in format ['png', 'jpg', 'jpeg']"}}, 400)
-            if image.read() == b'':
-                return create_json_response({'error': {'code': 400, 'message': 'The uploaded image is empty'}}, 400)
-            classification_result = classify_image(PIL.Image.open(image))
-            if classification_result is not None:
-                return create_json_response(classification_result, 200)
-            else:
-                return create_json_response({'error': {'code': 400, 'message': 'Classification failed'}}, 400)
+            upload, error = ingest_image_file(request.files['image'])
+            if error is not None:
+                return create_json_response({'error': {'code': 400, 'message': error}}, 400)
+
+            def classify() -> Response:
+                classification_result = classify_image_data(upload)
+                if classification_result is not None:
+                    return create_json_response(classification_result, 200)
+                else:
+                    return create_json_response({'error': {'code': 400, 'message': 'Classification failed'}}, 400)
+
+            return idempotent_response('upload_image', upload.digest, classify)
         else:
             return create_json_response({'error': {'code': 400, 'message': 'No image found in request'}}, 400)
 
 
-def execute_async_upload_image(image_data: bytes) -> Dict[str, Any]:
+@image_api.route('/upload_images', methods=['POST'])
+@monitor_status(monitor)
+def upload_images() -> Response:
+    """
+    Handle sync upload and classification of several images in one request.
+    Every file of the 'images' form field is validated like in /upload_image,
+    and the valid ones are classified together.
+    Returns:
+        Response: A JSON response with one classification result or error per file, in the order of the files.
+    """
+    images = [image for image in request.files.getlist('images') if image.filename]
+    if not images:
+        return create_json_response({'error': {'code': 400, 'message': 'No image found in request'}}, 400)
+    if len(images) > BATCH_MAX_FILES:
+        return create_json_response({'error': {'code': 400, 'message': f'At most {BATCH_MAX_FILES} images per request'}}, 400)
+
+    results: List[Dict] = [{}] * len(images)
+    valid_indices, uploads = [], []
+    for index, image in enumerate(images):
+        upload, error = ingest_image_file(image)
+        if error is not None:
+            results[index] = {'error': {'code': 400, 'message': error}}
+        else:
+            valid_indices.append(index)
+            uploads.append(upload)
+
+    for index, classification_result in zip(valid_indices, classify_images_data(uploads)):
+        if classification_result is not None:
+            results[index] = classification_result
+        else:
+            results[index] = {'error': {'code': 400, 'message': 'Classification failed'}}
+    return create_json_response({'results': results}, 200)
+
+
+def execute_async_upload_image(image: IO[bytes]) -> Optional[Dict[str, Any]]:
     """
     Execute async image upload and classification.
-    :param image_data:
+    :param image: file of the uploaded image
     :return: classification result
+    :raises OverloadedError: if the model sheds the call, so that the job is queued again without using up an attempt
+    :raises DeadlineExceededError: if the deadline of the job passed, so that it is dropped
     """
-    image = PIL.Image.open(BytesIO(image_data))
-    classification_result = classify_image(image)
+    classification_result = classify_image_data(IngestedImage(image), BATCH)
     return classification_result
 
 
-def save_result_to_db(future: Any, request_id: str) -> None:
+def request_result_fields(classification_result: Optional[Dict]) -> Dict[str, Any]:
+    """
+    :param classification_result: the classification of a finished job, None if it failed
+    :return: the fields of its requests, written by the job queue with the end of the job
+    """
+    if classification_result is None:
+        return {'status': 'failed', 'expires_at': request_expiry()}
+    return {'status': 'completed', 'classification_result': classification_result, 'expires_at': request_expiry()}
+
+
+def publish_result(request_id: str) -> None:
+    """
+    Send the webhooks of the requests of a finished job and wake up the requests waiting for it,
+    once the job queue wrote their result.
+    :param request_id: request id of the job
+    """
+    # Requests cancelled while the job ran keep their status
+    send_webhooks({'$or': [{'request_id': request_id}, {'linked_to': request_id}], 'status': {'$ne': 'cancelled'}})
+    result_notifier.notify(request_id)
+
+
+def send_webhooks(requests_filter: Dict) -> None:
     """
-    Save the classification result to the database.
-    :param future: thread
-    :param request_id: request id
+    Queue the completion webhooks of the finished requests that have a callback URL.
+    :param requests_filter: Mongo filter of the finished requests
     """
-    if future.exception() is not None:
-        request_collection.update_one(
-        {'request_id': str(request_id)},
-        {'$set': {'status': 'failed'}},
+    finished = request_collection.find({**requests_filter, 'callback_url': {'$exists': True}},
+                                       {**RESULT_PROJECTION, 'request_id': 1, 'callback_url': 1})
+    for request_data in finished:
+        body, _ = build_result(request_data)
+        if not webhooks.enqueue(request_data['request_id'], request_data['callback_url'],
+                                {'request_id': request_data['request_id'], **body}):
+            record_webhook_outcome(Delivery(request_data['request_id'], request_data['callback_url'], body), False)
+
+
+def link_to_pending_request(request_id: str, key: str, callback_url: Optional[str] = None) -> bool:
+    """
+    Link an async request to a pending request of the same image, so both resolve together
+    without running a second job.
+    :param request_id: id of the new request
+    :param key: content hash of the uploaded image
+    :param callback_url: URL notified when the request finishes
+    :return: True if the request was linked, False if no request of the same image is pending
+    """
+    primary = request_collection.find_one({'digest': key, 'status': 'pending', 'linked_to': {'$exists': False}},
+                                          {'_id': 0, 'request_id': 1})
+    if primary is None:
+        return False
+    request_collection.insert_one(
+        {'request_id': request_id, 'status': 'pending', 'digest': key, 'linked_to': primary['request_id'],
+         'expires_at': request_expiry(pending=True), **({'callback_url': callback_url} if callback_url else {})},
+    )
+    # The primary may have finished before the linked request was inserted
+    primary = request_collection.find_one({'request_id': primary['request_id']},
+                                          {'_id': 0, 'status': 1, 'classification_result': 1})
+    if primary is not None and primary['status'] == 'cancelled':
+        # Its job may be cancelled too, the request runs a job of its own
+        request_collection.delete_one({'request_id': request_id})
+        return False
+    if primary is not None and primary['status'] != 'pending':
+        updated = request_collection.update_one(
+            {'request_id': request_id, 'status': 'pending'},
+            {'$set': {'status': primary['status'], 'classification_result': primary.get('classification_result'),
+                      'expires_at': request_expiry()}},
         )
-    else:
-        try:
-            result = future.result()
-            request_collection.update_one(
-                {'request_id': str(request_id)},
-                {'$set': {'status': 'completed', 'classification_result': result}},
-            )
-        except Exception as e:
-            raise Exception(f"Error processing request {request_id}: {e}")
+        # Otherwise the primary's job already resolved this request and sent its webhook
+        if updated.modified_count:
+            send_webhooks({'request_id': request_id})
+    return True
 
 
 @image_api.route('/async_upload', methods=['POST'])
-@monitor_status(monitor_collection)
+@monitor_status(monitor)
 def async_upload() -> Union[Response, str]:
     """
     Handle async image upload and classification.
@@ -153,52 +702,248 @@ def async_upload() -> Union[Response, str]:
     if 'image' not in request.files:
         return create_json_response({'error': {'code': 400, 'message': 'No image found in request'}}, 400)
     
-    image = request.files['image'] 
-    if '.' not in image.filename or image.filename.split('.')[1].lower() not in ['png', 'jpg', 'jpeg']:
-        return create_json_response({'error': {'code': 400, 'message': "Support image in format ['png', 'jpg', 'jpeg']"}}, 400)
-    image_data = image.read()
-    if image_data == b'':
-        return create_json_response({'error': {'code': 400, 'message': 'The uploaded image is empty'}}, 400)
-
-    request_id = random.randint(10000, 1000000)
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(execute_async_upload_image, image_data)
+    callback_url = request.form.get('callback_url')
+    if callback_url is not None and not is_valid_callback_url(callback_url, WEBHOOK_ALLOWED_HOSTS):
+        return create_json_response({'error': {'code': 400, 'message': 'callback_url must be a public http(s) URL'}},
+                                    400)
+
+    upload, error = ingest_image_file(request.files['image'])
+    if error is not None:
+        return create_json_response({'error': {'code': 400, 'message': error}}, 400)
+
+    def queue_job() -> Response:
+        request_id = str(ObjectId())
+        key = upload.digest
+        if link_to_pending_request(request_id, key, callback_url):
+            increment_monitor_counters(monitor, coalesced=1)
+            return create_json_response({'request_id': request_id}, 202)
+
+        try:
+            job = job_queue.job_fields(upload, current_deadline())
+        except QueueFullError:
+            return create_retry_after_response('Too many pending jobs, try again later', ASYNC_RETRY_AFTER_SECONDS)
+        # Written before the job is accepted, so that it runs even if this worker dies
         request_collection.insert_one(
-            {'request_id': str(request_id), 'status': 'pending'},
+            {'request_id': request_id, 'status': 'pending', 'digest': key, 'expires_at': request_expiry(pending=True),
+             **({'callback_url': callback_url} if callback_url else {}), **job},
         )
-        future.add_done_callback(lambda fut: save_result_to_db(fut, request_id))
-        time.sleep(1)
-    return create_json_response({'request_id': request_id}, 202)
+        job_queue.notify()
+        return create_json_response({'request_id': request_id}, 202)
 
+    return idempotent_response('async_upload', upload.digest, queue_job)
 
-@image_api.route('/result/<request_id>', methods=['GET'])
-def get_result_with_id(request_id: str) -> Response:
+
+def is_pending(request_data: Dict) -> bool:
     """
-    Retrieve the result for a specific request ID.
-    This view returns a 404 error if the specified request ID does not exist.
-    
+    :param request_data: request_track document
+    :return: True while the job has not finished
+    """
+    return request_data.get('status') == 'pending'
+
+
+def fetch_result(request_id: str) -> Optional[Dict]:
+    """
+    Read a job for /result.
     Args:
-        request_id (str): The ID of the request to retrieve the result for.
+        request_id (str): The ID of the job.
     Returns:
-        Response: A JSON response with the classification result or the current status.
+        Optional[Dict]: The fields of RESULT_PROJECTION, None if the job does not exist.
+    """
+    return request_collection.find_one({'request_id': request_id}, RESULT_PROJECTION)
+
+
+def build_result(request_data: Optional[Dict]) -> Tuple[Dict, int]:
+    """
+    Build the /result body of a job.
+    Args:
+        request_data (Optional[Dict]): The request_track document, None if the job does not exist.
+    Returns:
+        Tuple[Dict, int]: The response body and status code.
     """
-    request_data = request_collection.find_one({'request_id': request_id})
-    
     if not request_data:
-        return create_json_response({'error': {'code': 404, 'message': 'ID not found'}}, 404)
+        return {'error': {'code': 404, 'message': 'ID not found'}}, 404
 
     status = request_data.get('status')
 
     if status == 'pending':
-        return create_json_response({'status': 'running'}, 200)
+        return {'status': 'running'}, 200
     
     elif status == 'completed':
         classification_result = request_data['classification_result']
         classification_result.update({'status': "completed"})
-        return create_json_response(classification_result, 200)
+        return classification_result, 200
 
     elif status == 'failed':
-        return create_json_response({'error': {'code': 400, 'message': 'Classification failed'}, 'status': 'error'}, 200)
+        return {'error': {'code': 400, 'message': 'Classification failed'}, 'status': 'error'}, 200
+
+    elif status == 'cancelled':
+        return {'status': 'cancelled'}, 200
 
     else:
-        return create_json_response({'error': {'code': 400, 'message': 'Unknown error or unhandled exception'}}, 400)
\ No newline at end of file
+        return {'error': {'code': 400, 'message': 'Unknown error or unhandled exception'}}, 400
+
+
+def get_wait_seconds(default: float, maximum: float) -> float:
+    """
+    Read the 'wait' query parameter of a result request.
+    :param default: value used when the parameter is missing or invalid
+    :param maximum: upper bound of the value
+    :return: seconds to wait for the job to finish
+    """
+    try:
+        return min(max(float(request.args.get('wait', default)), 0), maximum)
+    except ValueError:
+        return default
+
+
+def cancel_request(request_id: str, jobs: JobQueue) -> Tuple[Dict, int]:
+    """
+    Cancel an async request: its job is removed from the queue, or stopped if it runs.
+    The request is marked cancelled before its job is cancelled, so that no new request links to it; a job
+    shared with requests linked to it keeps running for them.
+    Args:
+        request_id (str): The ID of the request to cancel.
+        jobs (JobQueue): The job queue of the server mode.
+    Returns:
+        Tuple[Dict, int]: The response body and status code, 409 if the request already finished.
+    """
+    request_data = fetch_result(request_id)
+    if not request_data:
+        return {'error': {'code': 404, 'message': 'ID not found'}}, 404
+    if is_pending(request_data):
+        request_collection.update_one({'request_id': request_id, 'status': 'pending'},
+                                      {'$set': {'status': 'cancelled', 'expires_at': request_expiry()}})
+        # The job may have finished in the meantime
+        request_data = fetch_result(request_id)
+    if request_data.get('status') != 'cancelled':
+        return {'error': {'code': 409, 'message': 'The request already finished'}}, 409
+
+    if 'linked_to' not in request_data and request_collection.find_one(
+            {'linked_to': request_id, 'status': 'pending'}, {'_id': 1}) is None:
+        jobs.cancel(request_id)
+    result_notifier.notify(request_id)
+    return {'request_id': request_id, 'status': 'cancelled'}, 200
+
+
+@image_api.route('/result/<request_id>', methods=['DELETE'])
+def delete_result_with_id(request_id: str) -> Response:
+    """
+    Cancel an async request, e.g. one its client no longer waits for, so that its job stops using a worker
+    and the model. Cancelling a cancelled request succeeds again.
+    Args:
+        request_id (str): The ID of the request to cancel.
+    Returns:
+        Response: A JSON response with the request id and its cancelled status, or an error message.
+    """
+    return create_json_response(*cancel_request(request_id, job_queue))
+
+
+@image_api.route('/result/<request_id>', methods=['GET'])
+def get_result_with_id(request_id: str) -> Response:
+    """
+    Retrieve the result for a specific request ID.
+    This view returns a 404 error if the specified request ID does not exist.
+    With ?wait=<seconds>, a running job is long-polled: the response is sent as soon as the job
+    finishes, or after the given seconds if it is still running.
+    
+    Args:
+        request_id (str): The ID of the request to retrieve the result for.
+    Returns:
+        Response: A JSON response with the classification result or the current status.
+    """
+    fetch = lambda: fetch_result(request_id)
+    wait = get_wait_seconds(0, RESULT_MAX_WAIT_SECONDS)
+    if wait > 0:
+        request_data = result_notifier.wait(request_id, fetch, is_pending, wait)
+    else:
+        request_data = fetch()
+    return create_json_response(*build_result(request_data))
+
+
+def parse_request_ids(ids: Any) -> List[str]:
+    """
+    :param ids: request ids, as a list or as a comma-separated string
+    :return: the distinct non-empty request ids, in their first order
+    """
+    if isinstance(ids, str):
+        ids = ids.split(',')
+    if not isinstance(ids, list):
+        return []
+    return list(dict.fromkeys(str(request_id).strip() for request_id in ids if str(request_id).strip()))
+
+
+def build_results(request_ids: List[str]) -> Tuple[Dict, int]:
+    """
+    Build the /results body of many jobs, read with a single query.
+    Args:
+        request_ids (List[str]): The ids of the jobs.
+    Returns:
+        Tuple[Dict, int]: The response body and status code.
+    """
+    if not request_ids:
+        return {'error': {'code': 400, 'message': 'No request ids found in request'}}, 400
+    if len(request_ids) > RESULTS_MAX_IDS:
+        return {'error': {'code': 400, 'message': f'At most {RESULTS_MAX_IDS} request ids per request'}}, 400
+    documents = {request_data['request_id']: request_data for request_data in request_collection.find(
+        {'request_id': {'$in': request_ids}}, {**RESULT_PROJECTION, 'request_id': 1})}
+    results = []
+    for request_id in request_ids:
+        body, _ = build_result(documents.get(request_id))
+        results.append({'request_id': request_id, **body})
+    return {'results': results}, 200
+
+
+@image_api.route('/results', methods=['GET', 'POST'])
+def get_results() -> Response:
+    """
+    Retrieve the results of many request IDs in one response.
+    The ids are given as GET /results?ids=<id>,<id>... or, for long lists, as POST /results with
+    a JSON body {"ids": [<id>...]}. Every result has the body of /result/<request_id>, with its request_id;
+    ids that do not exist get the 404 error body.
+    Returns:
+        Response: A JSON response with the results in the order of the ids, or an error message.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        ids = body.get('ids') if isinstance(body, dict) else None
+    else:
+        ids = ','.join(request.args.getlist('ids'))
+    return create_json_response(*build_results(parse_request_ids(ids)))
+
+
+@image_api.route('/result/<request_id>/events', methods=['GET'])
+def result_events(request_id: str) -> Response:
+    """
+    Stream the status of a job as Server-Sent Events.
+    The current status is sent first, then the final result as soon as the job finishes,
+    after which the stream ends. Keep-alive comments are sent while the job runs.
+    
+    Args:
+        request_id (str): The ID of the request to follow.
+    Returns:
+        Response: A text/event-stream response, or a JSON 404 response if the ID does not exist.
+    """
+    fetch = lambda: fetch_result(request_id)
+    request_data = fetch()
+    if not request_data:
+        return create_json_response(*build_result(request_data))
+
+    def event(document: Optional[Dict]) -> str:
+        body, _ = build_result(document)
+        return f"event: status\ndata: {json.dumps(body)}\n\n"
+
+    def events():
+        yield event(request_data)
+        if not is_pending(request_data):
+            return
+        deadline = time.time() + get_wait_seconds(RESULT_EVENTS_MAX_SECONDS, RESULT_EVENTS_MAX_SECONDS)
+        while time.time() < deadline:
+            current = result_notifier.wait(request_id, fetch, is_pending,
+                                           min(RESULT_EVENTS_KEEPALIVE_SECONDS, deadline - time.time()))
+            if current is None or not is_pending(current):
+                yield event(current)
+                return
+            yield ": keep-alive\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
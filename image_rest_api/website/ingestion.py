@@ -0,0 +1,117 @@
+import hashlib
+import tempfile
+import PIL.Image
+from io import BytesIO
+from flask import Request
+from typing import IO, Optional
+from shared.constants import UPLOAD_SPOOL_BYTES, MAX_IMAGE_PIXELS
+
+CHUNK_SIZE = 64 * 1024
+SNIFF_BYTES = 16
+SUPPORTED_FORMATS_MESSAGE = "Support image in format ['png', 'jpg', 'jpeg']"
+
+
+class InvalidImageError(Exception):
+    """
+    Raised when an uploaded file is not an image the API accepts.
+    """
+
+
+def spool_upload(total_content_length: Optional[int], content_type: Optional[str],
+                 filename: Optional[str] = None, content_length: Optional[int] = None) -> IO[bytes]:
+    """
+    Stream factory of the uploaded files: the files of a request of at most UPLOAD_SPOOL_BYTES stay in memory,
+    any other file is spooled to a named temporary file, which the decode pool reads by its path. A large
+    upload is never buffered whole in a worker.
+    """
+    if total_content_length is not None and total_content_length <= UPLOAD_SPOOL_BYTES:
+        return BytesIO()
+    return tempfile.NamedTemporaryFile(mode='rb+', prefix='upload-')
+
+
+class SpoolingRequest(Request):
+    """
+    Request whose uploaded files are stored by spool_upload.
+    """
+    def _get_file_stream(self, total_content_length: Optional[int], content_type: Optional[str],
+                         filename: Optional[str] = None, content_length: Optional[int] = None) -> IO[bytes]:
+        return spool_upload(total_content_length, content_type, filename, content_length)
+
+
+def sniff_format(header: bytes) -> Optional[str]:
+    """
+    :param header: first bytes of a file
+    :return: 'PNG' or 'JPEG' according to the file signature, None for any other file
+    """
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    return None
+
+
+class IngestedImage:
+    """
+    A validated upload, read from its stream in chunks rather than loaded whole.
+    The content hash is computed while streaming, and the image header is parsed lazily to check the
+    dimensions before anything is decoded. An upload spooled to a file has a path, so that other processes
+    read it from there rather than being handed its content.
+    """
+    def __init__(self, stream: IO[bytes]):
+        """
+        :param stream: seekable binary stream of the uploaded file
+        :raises InvalidImageError: if the file is empty, not a PNG or JPEG, or too large to decode
+        """
+        self.stream = stream
+        stream.seek(0)
+        header = stream.read(SNIFF_BYTES)
+        if not header:
+            raise InvalidImageError('The uploaded image is empty')
+        self.format = sniff_format(header)
+        if self.format is None:
+            raise InvalidImageError(SUPPORTED_FORMATS_MESSAGE)
+
+        sha256 = hashlib.sha256(header)
+        self.size = len(header)
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            self.size += len(chunk)
+        self.digest = sha256.hexdigest()
+
+        try:
+            image = self.open()
+        except (PIL.UnidentifiedImageError, PIL.Image.DecompressionBombError, OSError):
+            raise InvalidImageError('The uploaded image is corrupted')
+        self.width, self.height = image.size
+        if self.width * self.height > MAX_IMAGE_PIXELS:
+            raise InvalidImageError(f'The image has more than {MAX_IMAGE_PIXELS} pixels')
+
+
+    @classmethod
+    def from_bytes(cls, image_data: bytes) -> 'IngestedImage':
+        return cls(BytesIO(image_data))
+
+
+    @property
+    def path(self) -> Optional[str]:
+        """
+        :return: the path of the file of the upload, None if it is only in memory
+        """
+        name = getattr(self.stream, 'name', None)
+        return name if isinstance(name, str) else None
+
+
+    def open(self) -> PIL.Image.Image:
+        """
+        :return: the lazily opened image, only its header is read until it is loaded
+        """
+        self.stream.seek(0)
+        return PIL.Image.open(self.stream, formats=[self.format])
+
+
+    def read(self) -> bytes:
+        """
+        :return: the whole file content
+        """
+        self.stream.seek(0)
+        return self.stream.read()
@@ -0,0 +1,408 @@
+import os
+import time
+import random
+import shutil
+import socket
+import datetime
+import tempfile
+import threading
+import gridfs
+from io import BytesIO
+from typing import IO, Any, Callable, Dict, List, Optional
+from bson import Binary
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.collection import Collection
+from shared.utils import get_logger
+from shared.limiter import OverloadedError
+from shared.deadline import Cancellation, DeadlineExceededError, use_cancellation, use_deadline
+from .ingestion import IngestedImage
+
+logger = get_logger()
+
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+DEAD = 'dead'
+CANCELLED = 'cancelled'
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue already holds max_depth jobs.
+    """
+
+
+class JobQueue:
+    """
+    Durable queue of async classification jobs, kept in the request_track documents themselves.
+    A job carries the uploaded image and a job_state: 'queued' until a worker claims it atomically with
+    find_one_and_update, 'leased' while that worker runs it, then 'done', or 'dead' once it failed
+    max_attempts times. A job whose model call was shed by the model limiter did not fail: it is queued again
+    once the limiter expects to take calls, without using up an attempt. The result of a job is written with its final state, in one update. A running job's
+    lease is extended by a heartbeat; the lease of a worker that died expires and the job is queued again,
+    so any worker of any host can pick it up.
+    Images too large for a document are kept in GridFS until the job is done or dead, streamed in and out of it
+    in chunks; dead jobs keep inline images, for inspection, until request_track expires them.
+    A job submitted with a deadline runs under it, and is dead-lettered without running once it passed.
+    A cancelled job is 'cancelled': at once if it was queued, otherwise once the worker running it notices,
+    which stops its work at its next wait for the model or the decode pool.
+    """
+    def __init__(self, collection: Collection, workers: int, max_depth: int, lease_seconds: float,
+                 heartbeat_seconds: float, max_attempts: int, retry_backoff_seconds: float, poll_seconds: float,
+                 inline_image_bytes: int, handler: Callable[[IO[bytes]], Optional[Dict]],
+                 result_fields: Callable[[Optional[Dict]], Dict[str, Any]], on_done: Callable[[str], None]):
+        """
+        :param collection: Mongo collection of the jobs (request_track)
+        :param workers: number of threads of this process running jobs
+        :param max_depth: maximum number of queued jobs, over all the workers
+        :param lease_seconds: seconds a claimed job stays leased without a heartbeat
+        :param heartbeat_seconds: interval between two lease extensions, and two sweeps of expired leases
+        :param max_attempts: attempts of a job before it is dead-lettered
+        :param retry_backoff_seconds: delay before a failed attempt is retried, doubled at every attempt, and
+                                      largest jitter added to the delay of a shed job
+        :param poll_seconds: interval between two claims of an idle worker
+        :param inline_image_bytes: largest image kept in the job document rather than in GridFS
+        :param handler: classifies the image file of a job, raises to retry it
+        :param result_fields: fields of the request of a finished job, from its classification (None if it failed)
+        :param on_done: called with the request id of a finished job, once its result is written
+        """
+        self.collection = collection
+        self.files = gridfs.GridFS(collection.database, collection='job_images')
+        self.workers = workers
+        self.max_depth = max_depth
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.poll_seconds = poll_seconds
+        self.inline_image_bytes = inline_image_bytes
+        self.handler = handler
+        self.result_fields = result_fields
+        self.on_done = on_done
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._running: Dict[str, float] = {}
+        self._cancellations: Dict[str, Cancellation] = {}
+        self._threads: List[threading.Thread] = []
+        self._wakeup = threading.Condition()
+        self._lock = threading.Lock()
+
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+
+    def ensure_indexes(self) -> None:
+        self.collection.create_index([('job_state', ASCENDING), ('available_at', ASCENDING)])
+        self.collection.create_index([('job_state', ASCENDING), ('lease_expires', ASCENDING)])
+
+
+    def start(self) -> None:
+        """
+        Start the worker threads and the heartbeat of this process.
+        Called from the app factory, so the threads belong to the gunicorn worker.
+        """
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                self._threads.append(threading.Thread(target=self._work, daemon=True, name=f'job-{index}'))
+            self._threads.append(threading.Thread(target=self._heartbeat, daemon=True, name='job-heartbeat'))
+            for thread in self._threads:
+                thread.start()
+
+
+    def job_fields(self, upload: IngestedImage, deadline: Optional[float] = None) -> Dict[str, Any]:
+        """
+        :param upload: the uploaded image
+        :param deadline: Unix time after which nobody waits for the result of the job, None if it has none
+        :return: the fields making a request_track document a queued job
+        :raises QueueFullError: if the queue is full
+        """
+        if self.depth(limit=self.max_depth) >= self.max_depth:
+            raise QueueFullError(f"{self.max_depth} jobs are already queued")
+        now = datetime.datetime.utcnow()
+        fields = {'job_state': QUEUED, 'attempts': 0, 'queued_at': now, 'available_at': now}
+        if deadline is not None:
+            fields['deadline'] = datetime.datetime.utcfromtimestamp(deadline)
+        if upload.size <= self.inline_image_bytes:
+            fields['image_data'] = Binary(upload.read())
+        else:
+            upload.stream.seek(0)
+            fields['image_file_id'] = self.files.put(upload.stream)
+        return fields
+
+
+    def notify(self) -> None:
+        """
+        Wake up an idle worker of this process after a job was queued.
+        """
+        with self._wakeup:
+            self._wakeup.notify()
+
+
+    def depth(self, limit: int = 0) -> int:
+        """
+        :param limit: stop counting at this number of jobs, 0 for no limit
+        :return: number of queued jobs, over all the workers
+        """
+        return self.collection.count_documents({'job_state': QUEUED}, **({'limit': limit} if limit else {}))
+
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: the number of jobs in every state but done, and the jobs running in this process, for /status
+        """
+        counts = {state: self.collection.count_documents({'job_state': state})
+                  for state in (QUEUED, LEASED, DEAD, CANCELLED)}
+        return {'queued': counts[QUEUED], 'leased': counts[LEASED], 'dead_lettered': counts[DEAD],
+                'cancelled': counts[CANCELLED], 'running_here': self.running}
+
+
+    def cancel(self, request_id: str) -> Optional[str]:
+        """
+        Cancel a job: a queued job is removed from the queue, a running job is asked to stop.
+        :param request_id: request id of the job
+        :return: QUEUED if the job was removed before it ran, LEASED if it was running,
+                 None if it already finished or there is no such job
+        """
+        queued = self.collection.find_one_and_update(
+            {'request_id': request_id, 'job_state': QUEUED},
+            {'$set': {'job_state': CANCELLED}, '$unset': {'image_data': '', 'image_file_id': ''}},
+        )
+        if queued is not None:
+            if 'image_file_id' in queued:
+                self.files.delete(queued['image_file_id'])
+            return QUEUED
+        # The worker of the job stops it when it sees the flag, in its heartbeat if it runs in another process
+        running = self.collection.update_one({'request_id': request_id, 'job_state': LEASED},
+                                             {'$set': {'cancel_requested': True}})
+        if not running.matched_count:
+            return None
+        self._stop(request_id)
+        return LEASED
+
+
+    def _stop(self, request_id: str) -> None:
+        with self._lock:
+            cancellation = self._cancellations.get(request_id)
+        if cancellation is not None and not cancellation.cancelled:
+            logger.info(f"Stopping cancelled job {request_id}")
+            cancellation.cancel()
+
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """
+        :return: the oldest available job, now leased by this process, or None if there is none
+        """
+        now = datetime.datetime.utcnow()
+        return self.collection.find_one_and_update(
+            {'job_state': QUEUED, 'available_at': {'$lte': now}},
+            {'$set': {'job_state': LEASED, 'worker': self.worker_id,
+                      'lease_expires': now + datetime.timedelta(seconds=self.lease_seconds)},
+             '$inc': {'attempts': 1}},
+            sort=[('available_at', ASCENDING)],
+            projection={'request_id': 1, 'attempts': 1, 'image_data': 1, 'image_file_id': 1, 'deadline': 1},
+            return_document=ReturnDocument.AFTER,
+        )
+
+
+    def _image(self, job: Dict[str, Any]) -> IO[bytes]:
+        """
+        :return: the image file of a job, an image kept in GridFS being copied in chunks to a temporary file
+        """
+        if 'image_file_id' not in job:
+            return BytesIO(job['image_data'])
+        image = tempfile.NamedTemporaryFile(mode='rb+', prefix='job-')
+        try:
+            shutil.copyfileobj(self.files.get(job['image_file_id']), image)
+        except BaseException:
+            image.close()
+            raise
+        image.seek(0)
+        return image
+
+
+    def _end(self, request_id: str, job_filter: Dict[str, Any], job_fields: Dict[str, Any],
+             classification_result: Optional[Dict], unset: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """
+        End a job and write the result of its request in the same update: a worker dying right after neither
+        loses the result nor leaves the job to run again.
+        Requests linked to the job get the result before the job ends, and once more after it for those linked
+        meanwhile. A request cancelled while its job ran on for the requests linked to it keeps its status.
+        :return: the job before it ended, None if it no longer matches job_filter
+        """
+        fields = self.result_fields(classification_result)
+        linked = {'linked_to': request_id, 'status': 'pending'}
+        self.collection.update_many(linked, {'$set': fields})
+        ended = self.collection.find_one_and_update(
+            {**job_filter, 'status': {'$ne': 'cancelled'}}, {'$set': {**job_fields, **fields}, '$unset': unset},
+        )
+        if ended is None:
+            ended = self.collection.find_one_and_update(job_filter, {'$set': job_fields, '$unset': unset})
+        if ended is not None:
+            self.collection.update_many(linked, {'$set': fields})
+        return ended
+
+
+    def _finish(self, job: Dict[str, Any], classification_result: Optional[Dict]) -> None:
+        # Only the holder of the lease finishes the job, a worker whose lease expired meanwhile does not
+        finished = self._end(job['request_id'], {**self._leased(job), 'cancel_requested': {'$ne': True}},
+                             {'job_state': DONE}, classification_result,
+                             {'image_data': '', 'image_file_id': '', 'lease_expires': ''})
+        if finished is None:
+            if not self._cancelled(job):
+                logger.warning(f"Lease of job {job['request_id']} was lost before it finished")
+            return
+        if 'image_file_id' in job:
+            self.files.delete(job['image_file_id'])
+        self.on_done(job['request_id'])
+
+
+    def _dead_letter(self, request_id: str, job_filter: Dict[str, Any], error: str) -> None:
+        dead = self._end(request_id, job_filter, {'job_state': DEAD, 'error': error}, None, {'lease_expires': ''})
+        if dead is not None:
+            logger.warning(f"Job {request_id} dead-lettered after {dead.get('attempts')} attempts: {error}")
+            if 'image_file_id' in dead:
+                self.files.delete(dead['image_file_id'])
+            self.on_done(request_id)
+
+
+    def _leased(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        return {'request_id': job['request_id'], 'job_state': LEASED, 'worker': self.worker_id}
+
+
+    def _cancelled(self, job: Dict[str, Any]) -> bool:
+        """
+        End a running job whose cancellation was requested, without on_done: its request is already cancelled.
+        :return: True if the job was cancelled
+        """
+        return self._end_cancelled(job['request_id'], self._leased(job))
+
+
+    def _end_cancelled(self, request_id: str, job_filter: Dict[str, Any]) -> bool:
+        cancelled = self.collection.find_one_and_update(
+            {**job_filter, 'cancel_requested': True},
+            {'$set': {'job_state': CANCELLED}, '$unset': {'image_data': '', 'image_file_id': '', 'lease_expires': ''}},
+        )
+        if cancelled is None:
+            return False
+        if 'image_file_id' in cancelled:
+            self.files.delete(cancelled['image_file_id'])
+        logger.info(f"Job {request_id} cancelled while running")
+        return True
+
+
+    def _retry(self, job: Dict[str, Any], error: Exception) -> None:
+        job_filter = self._leased(job)
+        if job['attempts'] >= self.max_attempts:
+            self._dead_letter(job['request_id'], job_filter, str(error))
+            return
+        backoff = self.retry_backoff_seconds * 2 ** (job['attempts'] - 1)
+        self.collection.update_one(
+            job_filter,
+            {'$set': {'job_state': QUEUED, 'error': str(error),
+                      'available_at': datetime.datetime.utcnow() + datetime.timedelta(seconds=backoff)},
+             '$unset': {'worker': '', 'lease_expires': ''}},
+        )
+
+
+    def _defer(self, job: Dict[str, Any], error: OverloadedError) -> None:
+        # The jitter spreads the jobs shed together, so that they do not all come back at once
+        delay = error.retry_after + random.uniform(0, self.retry_backoff_seconds)
+        deferred = self.collection.update_one(
+            self._leased(job),
+            {'$set': {'job_state': QUEUED, 'error': str(error),
+                      'available_at': datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)},
+             '$unset': {'worker': '', 'lease_expires': ''}, '$inc': {'attempts': -1, 'sheds': 1}},
+        )
+        if deferred.modified_count:
+            logger.info(f"Job {job['request_id']} shed by the model, queued again in {delay:.1f}s")
+
+
+    def _run(self, job: Dict[str, Any]) -> None:
+        deadline = job.get('deadline')
+        if deadline is not None:
+            deadline = deadline.replace(tzinfo=datetime.timezone.utc).timestamp()
+            if deadline <= time.time():
+                # Nobody waits for its result anymore
+                self._dead_letter(job['request_id'], self._leased(job), 'Deadline exceeded before the job started')
+                return
+        cancellation = Cancellation()
+        with self._lock:
+            self._running[job['request_id']] = time.time()
+            self._cancellations[job['request_id']] = cancellation
+        try:
+            with use_deadline(deadline), use_cancellation(cancellation), self._image(job) as image:
+                classification_result = self.handler(image)
+        except Exception as e:
+            if self._cancelled(job):
+                return
+            if isinstance(e, DeadlineExceededError):
+                self._dead_letter(job['request_id'], self._leased(job), str(e))
+                return
+            if isinstance(e, OverloadedError):
+                self._defer(job, e)
+                return
+            logger.warning(f"Attempt {job['attempts']} of job {job['request_id']} failed: {e}")
+            self._retry(job, e)
+            return
+        finally:
+            with self._lock:
+                self._running.pop(job['request_id'], None)
+                self._cancellations.pop(job['request_id'], None)
+        self._finish(job, classification_result)
+
+
+    def _work(self) -> None:
+        while True:
+            try:
+                job = self.claim()
+                if job is not None:
+                    self._run(job)
+                    continue
+            except Exception as e:
+                logger.warning(f"Job worker failed: {e}")
+            with self._wakeup:
+                self._wakeup.wait(self.poll_seconds)
+
+
+    def _requeue_expired(self) -> None:
+        """
+        Queue the jobs whose lease expired again, and dead-letter those out of attempts.
+        """
+        now = datetime.datetime.utcnow()
+        expired = {'job_state': LEASED, 'lease_expires': {'$lt': now}}
+        # A cancelled job of a dead worker is not run again
+        for job in self.collection.find({**expired, 'cancel_requested': True}, {'request_id': 1}):
+            self._end_cancelled(job['request_id'], {**expired, 'request_id': job['request_id']})
+        requeued = self.collection.update_many(
+            {**expired, 'attempts': {'$lt': self.max_attempts}},
+            {'$set': {'job_state': QUEUED, 'available_at': now}, '$unset': {'worker': '', 'lease_expires': ''}},
+        )
+        if requeued.modified_count:
+            logger.warning(f"Queued {requeued.modified_count} jobs of dead workers again")
+            self.notify()
+        for job in self.collection.find({**expired, 'attempts': {'$gte': self.max_attempts}}, {'request_id': 1}):
+            self._dead_letter(job['request_id'], {**expired, 'request_id': job['request_id']}, 'Lease expired')
+
+
+    def _heartbeat(self) -> None:
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            try:
+                with self._lock:
+                    running = list(self._running)
+                if running:
+                    running_filter = {'request_id': {'$in': running}, 'job_state': LEASED, 'worker': self.worker_id}
+                    self.collection.update_many(
+                        running_filter,
+                        {'$set': {'lease_expires': datetime.datetime.utcnow()
+                                  + datetime.timedelta(seconds=self.lease_seconds)}},
+                    )
+                    # Jobs cancelled through another worker
+                    for job in self.collection.find({**running_filter, 'cancel_requested': True}, {'request_id': 1}):
+                        self._stop(job['request_id'])
+                self._requeue_expired()
+            except Exception as e:
+                logger.warning(f"Job heartbeat failed: {e}")
@@ -0,0 +1,300 @@
+import time
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from shared.deadline import (Cancellation, DeadlineExceededError, check_cancelled, current_cancellation,
+                             current_deadline, use_cancellation, use_deadline)
+from .singleflight import MISSING
+
+# Called after every model call of a batch, with its lane, its size and the seconds each image waited for it
+BatchCallback = Callable[[str, int, List[float]], None]
+
+EXPIRED_MESSAGE = 'The deadline of the request passed before its batch was sent'
+
+
+class AdaptiveWindow:
+    """
+    Time a batch stays open for more images, adjusted to the arrival rate.
+    The gap between two arrivals is smoothed exponentially; the window is the time the missing images of a
+    batch are expected to take to arrive, capped by max_seconds. When images arrive further apart than
+    max_seconds, waiting would not gather a second one and batches are sent at once.
+    """
+    def __init__(self, max_seconds: float, max_batch: int, smoothing: float = 0.2):
+        """
+        :param max_seconds: longest time a batch stays open
+        :param max_batch: number of images of a full batch
+        :param smoothing: weight of the latest gap in the smoothed gap
+        """
+        self.max_seconds = max_seconds
+        self.max_batch = max_batch
+        self.smoothing = smoothing
+        self.gap = max_seconds
+        self._last_arrival: Optional[float] = None
+
+
+    def arrival(self, now: float) -> None:
+        if self._last_arrival is not None:
+            self.gap += self.smoothing * (min(now - self._last_arrival, 10 * self.max_seconds) - self.gap)
+        self._last_arrival = now
+
+
+    def seconds(self, batch_size: int) -> float:
+        """
+        :param batch_size: images already in the batch
+        :return: seconds the batch stays open after its first image
+        """
+        if self.gap >= self.max_seconds:
+            return 0.0
+        return min(self.max_seconds, self.gap * (self.max_batch - batch_size))
+
+
+    def state(self) -> Dict[str, float]:
+        return {'window_ms': self.seconds(1) * 1000, 'arrival_gap_ms': self.gap * 1000}
+
+
+def batch_deadline(deadlines: List[Optional[float]]) -> Optional[float]:
+    """
+    :param deadlines: deadlines of the requests of the images of a batch, None for a request without deadline
+    :return: the deadline of the model call, the last one since the call is useful until its last request gives up
+    """
+    return None if any(deadline is None for deadline in deadlines) else max(deadlines)
+
+
+def expired(deadline: Optional[float], now: float) -> bool:
+    return deadline is not None and deadline <= now
+
+
+def batch_cancellation(cancellations: List[Optional[Cancellation]]) -> Cancellation:
+    """
+    :param cancellations: cancellations of the requests of the images of a batch, None for a request that cannot
+                          be cancelled
+    :return: the cancellation of the model call, cancelled once all its requests are
+    """
+    cancellation = Cancellation()
+    if any(request is None for request in cancellations):
+        return cancellation
+
+    def cancel_if_all_cancelled() -> None:
+        if all(request.cancelled for request in cancellations):
+            cancellation.cancel()
+
+    for request in cancellations:
+        request.add_callback(cancel_if_all_cancelled)
+    return cancellation
+
+
+class _Item:
+    def __init__(self, model_input: Any, queued_at: float, deadline: Optional[float],
+                 cancellation: Optional[Cancellation]):
+        self.model_input = model_input
+        self.queued_at = queued_at
+        self.deadline = deadline
+        self.cancellation = cancellation
+        self.event = threading.Event()
+        self.result: Any = MISSING
+        self.error: Optional[BaseException] = None
+
+
+class _Batch:
+    def __init__(self):
+        self.items: List[_Item] = []
+        self.full = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Gather the single images classified at the same moment by independent requests of this worker into
+    one multi-image model call.
+    The first image of a lane opens a batch and its thread becomes the leader: it waits for the window of
+    the batch, or until max_batch images joined it, then makes the model call for all of them and hands
+    every waiting thread its result. Images of different lanes are never batched together.
+    Images whose request deadline passed while the batch was open are dropped from it before the call, as are
+    images of cancelled requests. The model call is not cancelled with the request of the leader, only once
+    the requests of all its images are.
+    """
+    def __init__(self, classify_batch: Callable[[List[Any], str], List[Optional[Dict]]], max_batch: int,
+                 max_window_seconds: float, on_batch: Optional[BatchCallback] = None):
+        """
+        :param classify_batch: classifies model inputs in one call, in a priority lane
+        :param max_batch: maximum number of images of a model call
+        :param max_window_seconds: longest time a batch waits for more images
+        :param on_batch: called after every model call
+        """
+        self.classify_batch = classify_batch
+        self.max_batch = max_batch
+        self.window = AdaptiveWindow(max_window_seconds, max_batch)
+        self.on_batch = on_batch
+        self._open: Dict[str, _Batch] = {}
+        self._lock = threading.Lock()
+
+
+    def classify(self, model_input: Any, lane: str) -> Optional[Dict]:
+        """
+        :param model_input: the image, in any format accepted by the backend
+        :param lane: the priority lane of the model call
+        :return: the classification result, or None if classification fails
+        :raises OverloadedError: if the model call of the batch is shed
+        :raises DeadlineExceededError: if the deadline of the request passes before the model call
+        """
+        now = time.perf_counter()
+        item = _Item(model_input, now, current_deadline(), current_cancellation())
+        with self._lock:
+            self.window.arrival(now)
+            batch = self._open.get(lane)
+            leader = batch is None
+            if leader:
+                batch = self._open[lane] = _Batch()
+            batch.items.append(item)
+            if len(batch.items) >= self.max_batch:
+                del self._open[lane]
+                batch.full.set()
+            window = self.window.seconds(len(batch.items))
+        if not leader:
+            if item.cancellation is not None:
+                # A cancelled request does not wait for the model call of the others
+                item.cancellation.add_callback(item.event.set)
+            item.event.wait()
+            check_cancelled(item.cancellation)
+            if item.error is not None:
+                raise item.error
+            return item.result
+
+        if window > 0:
+            batch.full.wait(window)
+        with self._lock:
+            if self._open.get(lane) is batch:
+                del self._open[lane]
+        self._run(batch.items, lane)
+        check_cancelled(item.cancellation)
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+
+    def _run(self, items: List[_Item], lane: str) -> None:
+        now = time.time()
+        for item in items:
+            if expired(item.deadline, now):
+                item.error = DeadlineExceededError(EXPIRED_MESSAGE)
+                item.event.set()
+            elif item.cancellation is not None and item.cancellation.cancelled:
+                item.event.set()
+        items = [item for item in items if not item.event.is_set()]
+        if not items:
+            return
+        sent_at = time.perf_counter()
+        try:
+            # The call runs on the thread of the leader, but for the requests of all the images
+            with use_deadline(batch_deadline([item.deadline for item in items])), \
+                    use_cancellation(batch_cancellation([item.cancellation for item in items])):
+                results = self.classify_batch([item.model_input for item in items], lane)
+            for item, result in zip(items, results):
+                item.result = result
+        except BaseException as e:
+            for item in items:
+                item.error = e
+        finally:
+            for item in items:
+                item.event.set()
+        if self.on_batch is not None:
+            self.on_batch(lane, len(items), [sent_at - item.queued_at for item in items])
+
+
+class _AsyncBatch:
+    def __init__(self):
+        # Model input, arrival time, request deadline and future of the result of every image
+        self.items: List[Tuple[Any, float, Optional[float], asyncio.Future]] = []
+        self.full = asyncio.Event()
+
+
+class AsyncMicroBatcher:
+    """
+    Same as MicroBatcher for the coroutines of an event loop.
+    The batch is sent by a task of its own, so a request cancelled while it waits does not hold up the others,
+    and its image is left out of the batch if it was not sent yet.
+    """
+    def __init__(self, classify_batch: Callable[[List[Any], str], Awaitable[List[Optional[Dict]]]], max_batch: int,
+                 max_window_seconds: float, on_batch: Optional[BatchCallback] = None):
+        """
+        :param classify_batch: classifies model inputs in one call, in a priority lane
+        :param max_batch: maximum number of images of a model call
+        :param max_window_seconds: longest time a batch waits for more images
+        :param on_batch: called after every model call
+        """
+        self.classify_batch = classify_batch
+        self.max_batch = max_batch
+        self.window = AdaptiveWindow(max_window_seconds, max_batch)
+        self.on_batch = on_batch
+        self._open: Dict[str, _AsyncBatch] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+
+    async def classify(self, model_input: Any, lane: str) -> Optional[Dict]:
+        """
+        :param model_input: the image, in any format accepted by the backend
+        :param lane: the priority lane of the model call
+        :return: the classification result, or None if classification fails
+        :raises OverloadedError: if the model call of the batch is shed
+        :raises DeadlineExceededError: if the deadline of the request passes before the model call
+        """
+        now = time.perf_counter()
+        self.window.arrival(now)
+        future = asyncio.get_running_loop().create_future()
+        batch = self._open.get(lane)
+        if batch is None:
+            batch = self._open[lane] = _AsyncBatch()
+            task = asyncio.ensure_future(self._send(lane, batch, self.window.seconds(1)))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        batch.items.append((model_input, now, current_deadline(), future))
+        if len(batch.items) >= self.max_batch:
+            del self._open[lane]
+            batch.full.set()
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+
+    async def _send(self, lane: str, batch: _AsyncBatch, window: float) -> None:
+        if window > 0:
+            try:
+                await asyncio.wait_for(batch.full.wait(), window)
+            except asyncio.TimeoutError:
+                pass
+        if self._open.get(lane) is batch:
+            del self._open[lane]
+        now = time.time()
+        for _, _, deadline, future in batch.items:
+            if expired(deadline, now) and not future.done():
+                future.set_exception(DeadlineExceededError(EXPIRED_MESSAGE))
+        # Images of cancelled or expired requests are not sent
+        items = [item for item in batch.items if not item[3].done()]
+        if not items:
+            return
+        # The task runs in the context of the request that opened the batch, but the call is for all the requests:
+        # it is cancelled once they all are
+        cancellation = Cancellation()
+        futures = [future for _, _, _, future in items]
+
+        def cancel_if_all_done(_: asyncio.Future) -> None:
+            if all(future.done() for future in futures):
+                cancellation.cancel()
+
+        for future in futures:
+            future.add_done_callback(cancel_if_all_done)
+        sent_at = time.perf_counter()
+        try:
+            with use_deadline(batch_deadline([deadline for _, _, deadline, _ in items])), \
+                    use_cancellation(cancellation):
+                results = await self.classify_batch([model_input for model_input, _, _, _ in items], lane)
+            for (_, _, _, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+        if self.on_batch is not None:
+            self.on_batch(lane, len(items), [sent_at - queued_at for _, queued_at, _, _ in items])
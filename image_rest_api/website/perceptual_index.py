@@ -0,0 +1,281 @@
+import time
+import datetime
+import itertools
+import threading
+import PIL.Image
+import numpy as np
+from bson import ObjectId
+from typing import Optional, Dict, List, Tuple
+from pymongo.collection import Collection
+from shared.utils import get_logger
+
+logger = get_logger()
+
+HASH_BITS = 64
+HASH_SIZE = 8
+# Three chunks of ~21 bits keep the buckets nearly empty at a million stored hashes
+N_CHUNKS = 3
+CHUNK_KEY_BITS = 32
+LOAD_BATCH_SIZE = 10000
+# Hashes added since the last sort are scanned linearly, until there are this many of them
+MERGE_THRESHOLD = 4096
+# Documents inserted by other workers may carry an ObjectId slightly older than the newest one
+# already loaded, so every refresh re-reads this window and skips the hashes it already knows.
+REFRESH_OVERLAP_SECONDS = 10
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT_32 = _dct_matrix(HASH_SIZE * 4)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), 'big')
+
+
+def dhash(image: PIL.Image.Image) -> int:
+    """
+    Difference hash: one bit per horizontally adjacent pixel pair of a 9x8 grayscale thumbnail.
+    :param image: decoded PIL image
+    :return: 64 bit perceptual hash
+    """
+    pixels = np.asarray(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), PIL.Image.Resampling.LANCZOS),
+                        dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image: PIL.Image.Image) -> int:
+    """
+    DCT hash: one bit per low frequency coefficient of a 32x32 grayscale thumbnail, compared to the median.
+    :param image: decoded PIL image
+    :return: 64 bit perceptual hash
+    """
+    size = HASH_SIZE * 4
+    pixels = np.asarray(image.convert('L').resize((size, size), PIL.Image.Resampling.LANCZOS), dtype=np.float64)
+    low_freq = (_DCT_32 @ pixels @ _DCT_32.T)[:HASH_SIZE, :HASH_SIZE]
+    return _bits_to_int(low_freq > np.median(low_freq))
+
+
+HASH_FUNCTIONS = {'dhash': dhash, 'phash': phash}
+
+
+def hamming_distances(hashes: np.ndarray, image_hash: int) -> np.ndarray:
+    """
+    :param hashes: uint64 array of hashes
+    :param image_hash: hash to compare to
+    :return: Hamming distance of every hash in the array to image_hash
+    """
+    xor = np.bitwise_xor(hashes, np.uint64(image_hash))
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _to_signed(value: int) -> int:
+    # Mongo stores 64 bit integers as signed values
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+class PerceptualIndex:
+    """
+    Near-duplicate index of perceptual hashes of already classified images.
+    Lookups use multi-index hashing: the 64 bit hash is split into N_CHUNKS chunks, and by the pigeonhole
+    principle every hash within max_distance of the query has at least one chunk within
+    max_distance // N_CHUNKS bits of the matching query chunk. Each chunk is kept as a sorted array, so a
+    lookup is a handful of binary searches followed by an exact distance check of the few candidates,
+    which stays well under a millisecond with a million stored hashes.
+    The hashes are persisted in Mongo and loaded incrementally, so every worker sees the images
+    classified by the others.
+    """
+    def __init__(self, collection: Collection, algorithm: str, max_distance: int, refresh_interval: float):
+        """
+        :param collection: Mongo collection holding the hashes and their classification
+        :param algorithm: 'dhash' or 'phash'
+        :param max_distance: maximum Hamming distance for two images to be considered the same
+        :param refresh_interval: minimum seconds between two loads of hashes stored by other workers
+        """
+        self.collection = collection
+        self.algorithm = algorithm
+        self.hash_function = HASH_FUNCTIONS[algorithm]
+        self.max_distance = max_distance
+        self.refresh_interval = refresh_interval
+        bounds = [HASH_BITS * i // N_CHUNKS for i in range(N_CHUNKS + 1)]
+        radius = max_distance // N_CHUNKS
+        # All chunks live in one sorted array, the chunk number is stored above the chunk bits
+        self._chunks = []
+        probe_base, probe_shift, probe_mask = [], [], []
+        for chunk, (start, end) in enumerate(zip(bounds, bounds[1:])):
+            width = end - start
+            self._chunks.append((np.uint64(start), np.uint64((1 << width) - 1), np.uint64(chunk << CHUNK_KEY_BITS)))
+            for r in range(radius + 1):
+                for bits in itertools.combinations(range(width), r):
+                    probe_base.append((chunk << CHUNK_KEY_BITS) | sum(1 << bit for bit in bits))
+                    probe_shift.append(start)
+                    probe_mask.append((1 << width) - 1)
+        self._probe_base = np.array(probe_base, dtype=np.uint64)
+        self._probe_shift = np.array(probe_shift, dtype=np.uint64)
+        self._probe_mask = np.array(probe_mask, dtype=np.uint64)
+        self._hashes = np.zeros(LOAD_BATCH_SIZE, dtype=np.uint64)
+        self._doc_ids: List[ObjectId] = []
+        self._sorted_keys = np.zeros(0, dtype=np.uint64)
+        self._sorted_positions = np.zeros(0, dtype=np.uint32)
+        self._n_sorted = 0
+        self._loaded_until: Optional[datetime.datetime] = None
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+
+    def ensure_indexes(self) -> None:
+        self.collection.create_index([('algorithm', 1), ('_id', 1)])
+
+
+    def compute_hash(self, image: PIL.Image.Image) -> int:
+        return self.hash_function(image)
+
+
+    def _append(self, hashes: List[int], doc_ids: List[ObjectId]) -> None:
+        size = len(self._doc_ids)
+        if size + len(hashes) > len(self._hashes):
+            grown = np.zeros(max(2 * len(self._hashes), size + len(hashes)), dtype=np.uint64)
+            grown[:size] = self._hashes[:size]
+            self._hashes = grown
+        self._hashes[size:size + len(hashes)] = np.array(hashes, dtype=np.uint64)
+        self._doc_ids.extend(doc_ids)
+
+
+    def _merge(self, force: bool = False) -> None:
+        """
+        Move the hashes of the linear scan buffer into the sorted chunk array.
+        """
+        start, size = self._n_sorted, len(self._doc_ids)
+        if size == start or (not force and size - start < MERGE_THRESHOLD):
+            return
+        hashes = self._hashes[start:size]
+        keys = np.concatenate([np.bitwise_or(np.bitwise_and(np.right_shift(hashes, shift), mask), prefix)
+                               for shift, mask, prefix in self._chunks])
+        positions = np.tile(np.arange(start, size, dtype=np.uint32), len(self._chunks))
+        order = np.argsort(keys, kind='stable')
+        keys, positions = keys[order], positions[order]
+        insert_at = np.searchsorted(self._sorted_keys, keys, 'right')
+        self._sorted_keys = np.insert(self._sorted_keys, insert_at, keys)
+        self._sorted_positions = np.insert(self._sorted_positions, insert_at, positions)
+        self._n_sorted = size
+
+
+    def _find(self, image_hash: int, max_distance: int) -> Optional[Tuple[int, int]]:
+        query_chunks = np.bitwise_and(np.right_shift(np.uint64(image_hash), self._probe_shift), self._probe_mask)
+        probes = np.bitwise_xor(self._probe_base, query_chunks)
+        starts = np.searchsorted(self._sorted_keys, probes, 'left')
+        lengths = np.searchsorted(self._sorted_keys, probes, 'right') - starts
+        total = int(lengths.sum())
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(total)
+        candidates = np.concatenate([self._sorted_positions[offsets],
+                                     np.arange(self._n_sorted, len(self._doc_ids), dtype=np.uint32)])
+        if len(candidates) == 0:
+            return None
+        distances = hamming_distances(self._hashes[candidates], image_hash)
+        best = int(np.argmin(distances))
+        if distances[best] > max_distance:
+            return None
+        return int(candidates[best]), int(distances[best])
+
+
+    def refresh(self, force: bool = False) -> int:
+        """
+        Load the hashes stored since the last refresh, in batches.
+        :param force: refresh even if the refresh interval did not pass yet
+        :return: number of hashes added to the index
+        """
+        if not force and time.time() - self._last_refresh < self.refresh_interval:
+            return 0
+        self._last_refresh = time.time()
+        query = {'algorithm': self.algorithm}
+        overlapping = self._loaded_until is not None
+        if overlapping:
+            since = self._loaded_until - datetime.timedelta(seconds=REFRESH_OVERLAP_SECONDS)
+            query['_id'] = {'$gt': ObjectId.from_datetime(since)}
+        added = 0
+        try:
+            while True:
+                docs = list(self.collection.find(query, {'phash': 1}).sort('_id', 1).limit(LOAD_BATCH_SIZE))
+                with self._lock:
+                    hashes, doc_ids = [], []
+                    for doc in docs:
+                        image_hash = _to_unsigned(doc['phash'])
+                        if overlapping and self._find(image_hash, 0) is not None:
+                            continue
+                        hashes.append(image_hash)
+                        doc_ids.append(doc['_id'])
+                    self._append(hashes, doc_ids)
+                    added += len(hashes)
+                if docs:
+                    newest = docs[-1]['_id'].generation_time
+                    self._loaded_until = max(self._loaded_until or newest, newest)
+                if len(docs) < LOAD_BATCH_SIZE:
+                    break
+                query['_id'] = {'$gt': docs[-1]['_id']}
+        except Exception as e:
+            logger.warning(f"Perceptual index refresh failed: {e}")
+        with self._lock:
+            self._merge()
+        return added
+
+
+    def start_background_load(self) -> None:
+        """
+        Rebuild the index from Mongo without blocking the worker start.
+        """
+        threading.Thread(target=self.refresh, kwargs={'force': True}, daemon=True).start()
+
+
+    def lookup(self, image_hash: int) -> Optional[Dict]:
+        """
+        Find the classification of a known image within max_distance of the given hash.
+        :param image_hash: perceptual hash of the new image
+        :return: the stored classification result, or None if no near duplicate is known
+        """
+        self.refresh()
+        with self._lock:
+            match = self._find(image_hash, self.max_distance)
+            doc_id = self._doc_ids[match[0]] if match is not None else None
+        if doc_id is None:
+            return None
+        try:
+            doc = self.collection.find_one({'_id': doc_id}, {'classification_result': 1})
+        except Exception as e:
+            logger.warning(f"Perceptual index lookup failed: {e}")
+            return None
+        return doc['classification_result'] if doc else None
+
+
+    def add(self, image_hash: int, key: str, classification_result: Dict) -> None:
+        """
+        Store the hash of a newly classified image.
+        :param image_hash: perceptual hash of the image
+        :param key: content hash of the image
+        :param classification_result: classification to reuse for near duplicates
+        """
+        doc_id = ObjectId()
+        try:
+            self.collection.insert_one({'_id': doc_id, 'algorithm': self.algorithm, 'phash': _to_signed(image_hash),
+                                        'key': key, 'classification_result': classification_result})
+        except Exception as e:
+            logger.warning(f"Perceptual index store failed: {e}")
+            return
+        with self._lock:
+            if self._find(image_hash, 0) is None:
+                self._append([image_hash], [doc_id])
+                self._merge()
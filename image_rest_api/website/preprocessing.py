@@ -0,0 +1,89 @@
+import time
+import PIL.Image
+import PIL.ImageOps
+from io import BytesIO
+from typing import Any, Dict, Tuple
+from .ingestion import IngestedImage
+from shared.constants import (PREPROCESS_ENABLED, PREPROCESS_MAX_EDGE, PREPROCESS_TARGET_BYTES,
+                              PREPROCESS_JPEG_QUALITY)
+
+MIN_JPEG_QUALITY = 40
+JPEG_QUALITY_STEP = 10
+MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+
+
+def _elapsed_ms(start: float) -> float:
+    return (time.perf_counter() - start) * 1000
+
+
+def normalize_mode(image: PIL.Image.Image) -> PIL.Image.Image:
+    """
+    Convert an image to RGB, flattening transparency on a white background.
+    :param image: decoded PIL image
+    :return: RGB image
+    """
+    if image.mode == 'RGB':
+        return image
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    if image.mode in ('RGBA', 'LA'):
+        background = PIL.Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def encode_jpeg(image: PIL.Image.Image, target_bytes: int, quality: int) -> bytes:
+    """
+    Encode an image as JPEG, lowering the quality until it fits the byte budget.
+    :param image: RGB image
+    :param target_bytes: byte budget of the encoded image
+    :param quality: initial JPEG quality
+    :return: the encoded image
+    """
+    while True:
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        if buffer.tell() <= target_bytes or quality <= MIN_JPEG_QUALITY:
+            return buffer.getvalue()
+        quality = max(MIN_JPEG_QUALITY, quality - JPEG_QUALITY_STEP)
+
+
+def preprocess_image(upload: IngestedImage) -> Tuple[Any, PIL.Image.Image, Dict[str, float]]:
+    """
+    Shrink an uploaded image before it is sent to the model.
+    JPEG files are decoded in draft mode, directly at the smallest DCT scale that is still larger than
+    PREPROCESS_MAX_EDGE, then the image is downscaled to PREPROCESS_MAX_EDGE, converted to RGB and
+    re-encoded as a JPEG of at most PREPROCESS_TARGET_BYTES when possible.
+    Args:
+        upload (IngestedImage): The validated upload.
+    Returns:
+        Tuple[Any, PIL.Image.Image, Dict[str, float]]: The image to send to the model, the decoded image,
+        and the byte counts and milliseconds spent per stage.
+    """
+    start = time.perf_counter()
+    image = upload.open()
+    original_size = image.size
+    if not PREPROCESS_ENABLED:
+        return image, image, {'bytes_in': upload.size, 'bytes_out': upload.size}
+
+    if image.format == 'JPEG':
+        image.draft('RGB', (PREPROCESS_MAX_EDGE, PREPROCESS_MAX_EDGE))
+    image.load()
+    stats = {'bytes_in': upload.size, 'decode_ms': _elapsed_ms(start)}
+
+    start = time.perf_counter()
+    image = PIL.ImageOps.exif_transpose(image)
+    image.thumbnail((PREPROCESS_MAX_EDGE, PREPROCESS_MAX_EDGE), PIL.Image.Resampling.LANCZOS)
+    image = normalize_mode(image)
+    stats['resize_ms'] = _elapsed_ms(start)
+
+    start = time.perf_counter()
+    encoded = encode_jpeg(image, PREPROCESS_TARGET_BYTES, PREPROCESS_JPEG_QUALITY)
+    stats['encode_ms'] = _elapsed_ms(start)
+    if len(encoded) >= upload.size and image.size == original_size:
+        # Small images are often smaller as uploaded than re-encoded
+        stats['bytes_out'] = upload.size
+        return {'mime_type': MIME_TYPES[upload.format], 'data': upload.read()}, image, stats
+    stats['bytes_out'] = len(encoded)
+    return {'mime_type': 'image/jpeg', 'data': encoded}, image, stats
@@ -0,0 +1,117 @@
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple, Any
+from pymongo.collection import Collection
+from shared.utils import get_logger
+
+logger = get_logger()
+
+# Sentinel stored for images whose classification failed (negative cache entries)
+FAILED = 'failed'
+
+
+def content_hash(image_data: bytes) -> str:
+    """
+    Compute the content address of an uploaded image.
+    :param image_data: raw bytes of the uploaded file
+    :return: hex encoded sha256 digest of the bytes
+    """
+    return hashlib.sha256(image_data).hexdigest()
+
+
+class ClassificationCache:
+    """
+    Two tier cache of classification results keyed by the content hash of the uploaded image.
+    The first tier is an in-process LRU with size and TTL eviction, the second tier is a Mongo
+    collection shared by all the gunicorn workers. Failed classifications are kept for a shorter
+    TTL (negative cache) so a broken image does not hit the model on every retry.
+    """
+    def __init__(self, collection: Collection, max_entries: int, ttl: float, negative_ttl: float):
+        """
+        :param collection: Mongo collection used as the persistent tier
+        :param max_entries: maximum number of entries kept in the in-process tier
+        :param ttl: seconds a successful classification is kept
+        :param negative_ttl: seconds a failed classification is kept
+        """
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def ensure_indexes(self) -> None:
+        """
+        Let Mongo expire persistent entries on their own.
+        """
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+
+    def _get_local(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+
+    def _set_local(self, key: str, value: Any, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up a cached classification.
+        :param key: content hash of the image
+        :return: the cached classification dict, FAILED for a negative entry, or None on a miss
+        """
+        value = self._get_local(key)
+        if value is not None:
+            return value
+        try:
+            doc = self.collection.find_one(
+                {'_id': key, 'expires_at': {'$gt': datetime.datetime.utcnow()}},
+                {'result': 1, 'expires_at': 1},
+            )
+        except Exception as e:
+            logger.warning(f"Classification cache lookup failed: {e}")
+            return None
+        if doc is None:
+            return None
+        value = doc['result'] if doc['result'] is not None else FAILED
+        expires_at = doc['expires_at'].replace(tzinfo=datetime.timezone.utc).timestamp()
+        self._set_local(key, value, expires_at)
+        return value
+
+
+    def set(self, key: str, result: Optional[Dict]) -> None:
+        """
+        Store a classification in both tiers.
+        :param key: content hash of the image
+        :param result: classification dict, or None when the classification failed
+        """
+        ttl = self.ttl if result is not None else self.negative_ttl
+        expires_at = time.time() + ttl
+        self._set_local(key, result if result is not None else FAILED, expires_at)
+        try:
+            self.collection.update_one(
+                {'_id': key},
+                {'$set': {'result': result,
+                          'expires_at': datetime.datetime.utcfromtimestamp(expires_at)}},
+                upsert=True,
+            )
+        except Exception as e:
+            logger.warning(f"Classification cache store failed: {e}")
@@ -0,0 +1,174 @@
+import time
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+from shared.utils import get_logger
+
+logger = get_logger()
+
+# Error code of $changeStream on a standalone server (no replica set)
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+
+class ResultNotifier:
+    """
+    Wake up requests waiting for an async job to finish.
+    Jobs finished by this worker are notified directly by notify(). Jobs finished by other workers are
+    detected through a Mongo change stream on request_track. When the server does not support change
+    streams (standalone Mongo), waiters fall back to re-reading the job every recheck_seconds.
+    Only the changes of the status of a request are followed, not every write to the job.
+    Waiters are threads blocked in wait(), or coroutines awaiting wait_async() on the event loop.
+    """
+    def __init__(self, collection: Collection, recheck_seconds: float):
+        """
+        :param collection: Mongo collection of the jobs (request_track)
+        :param recheck_seconds: interval between two reads of a job when change streams are not available
+        """
+        self.collection = collection
+        self.recheck_seconds = recheck_seconds
+        self.change_stream_active = False
+        self._waiters: Dict[str, List[Callable[[], None]]] = {}
+        self._lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+
+
+    def _ensure_watcher(self) -> None:
+        # Started lazily so the thread belongs to the gunicorn worker, not to the master process
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, daemon=True)
+                self._watcher.start()
+
+
+    def _watch(self) -> None:
+        pipeline = [
+            {'$match': {'$or': [{'operationType': 'replace'},
+                                {'operationType': 'update', 'updateDescription.updatedFields.status': {'$exists': True}}]}},
+            {'$project': {'fullDocument.request_id': 1, 'fullDocument.linked_to': 1}},
+        ]
+        backoff = 1.0
+        while True:
+            try:
+                with self.collection.watch(pipeline, full_document='updateLookup') as stream:
+                    self.change_stream_active = True
+                    backoff = 1.0
+                    for change in stream:
+                        document = change.get('fullDocument') or {}
+                        for request_id in (document.get('request_id'), document.get('linked_to')):
+                            if request_id is not None:
+                                self.notify(request_id)
+            except OperationFailure as e:
+                self.change_stream_active = False
+                if e.code == CHANGE_STREAM_NOT_SUPPORTED:
+                    logger.info("Change streams are not supported, result waiters will re-read their jobs")
+                    return
+                logger.warning(f"Result change stream failed: {e}")
+            except Exception as e:
+                self.change_stream_active = False
+                logger.warning(f"Result change stream failed: {e}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+
+
+    def _subscribe(self, request_id: str, wake: Callable[[], None]) -> None:
+        with self._lock:
+            self._waiters.setdefault(request_id, []).append(wake)
+
+
+    def _unsubscribe(self, request_id: str, wake: Callable[[], None]) -> None:
+        with self._lock:
+            waiters = self._waiters.get(request_id, [])
+            if wake in waiters:
+                waiters.remove(wake)
+            if not waiters:
+                self._waiters.pop(request_id, None)
+
+
+    def _wait_seconds(self, remaining: float) -> float:
+        return remaining if self.change_stream_active else min(remaining, self.recheck_seconds)
+
+
+    def notify(self, request_id: str) -> None:
+        """
+        Wake up the requests waiting for a job.
+        :param request_id: id of the job that changed
+        """
+        with self._lock:
+            waiters = list(self._waiters.get(str(request_id), []))
+        for wake in waiters:
+            wake()
+
+
+    def wait(self, request_id: str, fetch: Callable[[], Optional[Dict]], is_pending: Callable[[Dict], bool],
+             timeout: float) -> Optional[Dict]:
+        """
+        Wait until a job is no longer pending.
+        :param request_id: id of the job
+        :param fetch: reads the job document
+        :param is_pending: tells whether a job document is still pending
+        :param timeout: maximum seconds to wait
+        :return: the last read job document, None if the job does not exist
+        """
+        self._ensure_watcher()
+        event = threading.Event()
+        wake = event.set
+        subscribed = [request_id]
+        self._subscribe(request_id, wake)
+        deadline = time.time() + timeout
+        try:
+            while True:
+                document = fetch()
+                if document is None or not is_pending(document):
+                    return document
+                linked_to = document.get('linked_to')
+                if linked_to is not None and linked_to not in subscribed:
+                    subscribed.append(linked_to)
+                    self._subscribe(linked_to, wake)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return document
+                event.wait(self._wait_seconds(remaining))
+                event.clear()
+        finally:
+            for subscribed_id in subscribed:
+                self._unsubscribe(subscribed_id, wake)
+
+
+    async def wait_async(self, request_id: str, fetch: Callable[[], Awaitable[Optional[Dict]]],
+                         is_pending: Callable[[Dict], bool], timeout: float) -> Optional[Dict]:
+        """
+        Same as wait(), for coroutines: waiting does not block the event loop.
+        :param fetch: coroutine function reading the job document
+        """
+        self._ensure_watcher()
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        # Notified from the change stream thread or from a job queue thread
+        wake = lambda: loop.call_soon_threadsafe(event.set)
+        subscribed = [request_id]
+        self._subscribe(request_id, wake)
+        deadline = time.time() + timeout
+        try:
+            while True:
+                document = await fetch()
+                if document is None or not is_pending(document):
+                    return document
+                linked_to = document.get('linked_to')
+                if linked_to is not None and linked_to not in subscribed:
+                    subscribed.append(linked_to)
+                    self._subscribe(linked_to, wake)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return document
+                try:
+                    await asyncio.wait_for(event.wait(), self._wait_seconds(remaining))
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        finally:
+            for subscribed_id in subscribed:
+                self._unsubscribe(subscribed_id, wake)
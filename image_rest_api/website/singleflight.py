@@ -0,0 +1,158 @@
+import os
+import time
+import socket
+import datetime
+import threading
+from typing import Optional, Callable, Tuple, Dict, Any
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+from shared.utils import get_logger
+
+logger = get_logger()
+
+# Result of a flight that ended without producing a classification (e.g. an exception or a timeout)
+MISSING = object()
+
+LEADER = 'leader'
+FOLLOWER = 'follower'
+REMOTE = 'remote'
+
+
+class Flight:
+    """
+    One in-flight classification of a given content hash inside this worker.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = MISSING
+        self.has_lease = False
+
+
+class SingleFlight:
+    """
+    Coalesce identical classifications that are in flight at the same moment.
+    Inside a worker, the first caller of a content hash becomes the leader of its flight and later
+    callers wait for the leader's result. Across workers, the leader also holds a lease document in
+    request_track; the first caller of another worker that finds the lease taken waits until the
+    leader's result shows up in the shared result cache, or takes over if the lease expires.
+    """
+    def __init__(self, collection: Collection, lease_seconds: float, poll_seconds: float, wait_seconds: float):
+        """
+        :param collection: Mongo collection holding the leases (request_track)
+        :param lease_seconds: seconds after which a lease of a dead leader can be taken over
+        :param poll_seconds: initial interval between two checks of a lease held by another worker
+        :param wait_seconds: maximum seconds to wait for a leader before classifying on our own
+        """
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.wait_seconds = wait_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+
+    def _lease_id(self, key: str) -> str:
+        return f"lease:{key}"
+
+
+    def _acquire_lease(self, key: str) -> bool:
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(seconds=self.lease_seconds)
+        # expires_at lets the request_track TTL index remove the leases of dead leaders
+        lease = {'request_id': self._lease_id(key), 'status': 'lease', 'lease_owner': self.owner,
+                 'lease_expires': expires, 'expires_at': expires}
+        try:
+            self.collection.insert_one({'_id': self._lease_id(key), **lease})
+            return True
+        except DuplicateKeyError:
+            taken_over = self.collection.find_one_and_update(
+                {'_id': self._lease_id(key), 'lease_expires': {'$lt': now}},
+                {'$set': lease},
+            )
+            return taken_over is not None
+        except Exception as e:
+            logger.warning(f"Single-flight lease failed, classifying without it: {e}")
+            return True
+
+
+    def _lease_held(self, key: str) -> bool:
+        try:
+            lease = self.collection.find_one({'_id': self._lease_id(key)}, {'lease_expires': 1})
+        except Exception as e:
+            logger.warning(f"Single-flight lease check failed: {e}")
+            return False
+        return lease is not None and lease['lease_expires'] > datetime.datetime.utcnow()
+
+
+    def begin(self, key: str) -> Tuple[str, Flight]:
+        """
+        Join the flight of a content hash, starting it if needed.
+        :param key: content hash of the image
+        :return: LEADER if the caller has to classify the image and then call finish(),
+                 FOLLOWER if the caller has to wait() for a leader of this worker,
+                 REMOTE if the caller has to wait_remote() for a leader of another worker.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return FOLLOWER, flight
+            flight = Flight()
+            self._flights[key] = flight
+        if self._acquire_lease(key):
+            flight.has_lease = True
+            return LEADER, flight
+        return REMOTE, flight
+
+
+    def finish(self, key: str, flight: Flight, result: Any) -> None:
+        """
+        Publish the result of a flight to its followers and release its lease.
+        :param key: content hash of the image
+        :param flight: the flight returned by begin()
+        :param result: the classification, or MISSING if there is none
+        """
+        flight.result = result
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.event.set()
+        if flight.has_lease:
+            try:
+                self.collection.delete_one({'_id': self._lease_id(key), 'lease_owner': self.owner})
+            except Exception as e:
+                logger.warning(f"Single-flight lease release failed: {e}")
+
+
+    def wait(self, flight: Flight) -> Any:
+        """
+        Wait for the leader of this worker.
+        :param flight: the flight returned by begin()
+        :return: the leader's result, or MISSING if it had none in time
+        """
+        flight.event.wait(self.wait_seconds)
+        return flight.result
+
+
+    def wait_remote(self, key: str, flight: Flight, lookup: Callable[[], Optional[Any]]) -> Any:
+        """
+        Wait for the leader of another worker, whose result is found with lookup.
+        If the lease is released or expires without a result, the caller becomes the leader.
+        :param key: content hash of the image
+        :param flight: the flight returned by begin()
+        :param lookup: returns the shared result of the key, or None while there is none
+        :return: the leader's result, or MISSING if the caller is now the leader and has to classify the image
+        """
+        deadline = time.time() + self.wait_seconds
+        interval = self.poll_seconds
+        while time.time() < deadline:
+            result = lookup()
+            if result is not None:
+                self.finish(key, flight, result)
+                return result
+            if not self._lease_held(key) and self._acquire_lease(key):
+                flight.has_lease = True
+                return MISSING
+            time.sleep(interval)
+            interval = min(interval * 2, 2.0)
+        return MISSING
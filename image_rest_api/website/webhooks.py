@@ -0,0 +1,240 @@
+import time
+import heapq
+import random
+import socket
+import ipaddress
+import itertools
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Any, Callable, Collection, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from shared.utils import get_logger
+
+logger = get_logger()
+
+# Statuses meaning the receiver may accept the same delivery later
+RETRYABLE_STATUS_CODES = {408, 425, 429}
+
+
+def is_public_address(address: str) -> bool:
+    """
+    :param address: an IPv4 or IPv6 address
+    :return: False for loopback, private, link-local (e.g. cloud metadata), reserved and multicast addresses
+    """
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def resolve_callback_address(url: str, allowed_hosts: Collection[str] = ()) -> Optional[str]:
+    """
+    A callback URL is POSTed to by the server, it must not reach the internal network: the Mongo host,
+    the other services or the metadata endpoint of the cloud provider.
+    :param url: callback URL given by the client
+    :param allowed_hosts: internal hosts that may receive webhooks anyway
+    :return: the address to connect to, if the URL is an absolute http(s) URL whose host is allowed or resolves
+        to public addresses only, None otherwise
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return None
+    try:
+        port = parsed.port
+        addresses = [address[4][0] for address in socket.getaddrinfo(parsed.hostname, port, proto=socket.IPPROTO_TCP)]
+    except (ValueError, OSError):
+        return None
+    if not addresses:
+        return None
+    if parsed.hostname not in allowed_hosts and not all(is_public_address(address) for address in addresses):
+        return None
+    return addresses[0]
+
+
+def is_valid_callback_url(url: str, allowed_hosts: Collection[str] = ()) -> bool:
+    """
+    :return: True if webhooks may be POSTed to the URL, see resolve_callback_address
+    """
+    return resolve_callback_address(url, allowed_hosts) is not None
+
+
+class PinnedAddressAdapter(HTTPAdapter):
+    """
+    Transport adapter connecting to an address resolved and checked beforehand, rather than resolving the host
+    of the URL again: the host cannot resolve to an internal address between its check and the connection
+    (DNS rebinding). The Host header, the TLS server name and the certificate check still use the host name.
+    """
+    def __init__(self):
+        super().__init__()
+        self.address: Optional[str] = None
+
+
+    def build_connection_pool_key_attributes(self, request: requests.PreparedRequest, verify: Any,
+                                             cert: Any = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+        hostname = host_params['host']
+        host_params['host'] = self.address
+        if host_params['scheme'] == 'https':
+            pool_kwargs['server_hostname'] = hostname
+            pool_kwargs['assert_hostname'] = hostname
+        return host_params, pool_kwargs
+
+
+class Delivery:
+    """
+    One webhook POST, with the number of attempts made so far.
+    """
+    def __init__(self, request_id: str, url: str, payload: Dict[str, Any]):
+        self.request_id = request_id
+        self.url = url
+        self.payload = payload
+        self.attempts = 0
+
+
+class WebhookDispatcher:
+    """
+    Background delivery queue of job completion webhooks.
+    Deliveries are POSTed by dedicated threads, never by the job workers. A failed delivery is
+    scheduled again with exponential backoff and jitter until it succeeds or max_attempts is reached.
+    Client errors other than timeouts and rate limits are not retried.
+    The callback URL is checked again before every attempt, its host may resolve to another address by then,
+    the connection is made to the checked address, and redirects are not followed.
+    Deliveries are only kept in memory: those still queued when the worker stops are lost, their requests
+    keep their result but have no webhook outcome.
+    """
+    def __init__(self, max_workers: int, queue_depth: int, max_attempts: int, backoff_seconds: float,
+                 max_backoff_seconds: float, timeout: float, allowed_hosts: Collection[str] = (),
+                 on_done: Optional[Callable[[Delivery, bool], None]] = None):
+        """
+        :param max_workers: number of delivery threads
+        :param queue_depth: maximum number of deliveries waiting in memory
+        :param max_attempts: attempts of a delivery before it is given up
+        :param backoff_seconds: delay before the first retry, doubled after each failed attempt
+        :param max_backoff_seconds: upper bound of the delay between two attempts
+        :param timeout: seconds allowed to the receiver to answer
+        :param allowed_hosts: internal hosts that may receive webhooks anyway
+        :param on_done: called with (delivery, delivered) once a delivery succeeded or was given up
+        """
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.timeout = timeout
+        self.allowed_hosts = allowed_hosts
+        self.on_done = on_done
+        self._queue: List[Tuple[float, int, Delivery]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._local = threading.local()
+
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+
+    def _ensure_threads(self) -> None:
+        # Started lazily so the threads belong to the gunicorn worker, not to the master process
+        while len(self._threads) < self.max_workers:
+            thread = threading.Thread(target=self._work, daemon=True, name=f'webhook-{len(self._threads)}')
+            thread.start()
+            self._threads.append(thread)
+
+
+    def enqueue(self, request_id: str, url: str, payload: Dict[str, Any]) -> bool:
+        """
+        Queue a webhook delivery.
+        :param request_id: id of the job the webhook reports
+        :param url: callback URL of the job
+        :param payload: JSON body to POST
+        :return: False if the queue is full and the delivery was dropped
+        """
+        with self._condition:
+            self._ensure_threads()
+            if len(self._queue) >= self.queue_depth:
+                logger.warning(f"Webhook queue is full, dropping the delivery of request {request_id}")
+                return False
+            self._schedule(Delivery(request_id, url, payload), time.time())
+        return True
+
+
+    def _schedule(self, delivery: Delivery, due: float) -> None:
+        heapq.heappush(self._queue, (due, next(self._sequence), delivery))
+        self._condition.notify()
+
+
+    def _next_delivery(self) -> Delivery:
+        with self._condition:
+            while True:
+                if self._queue:
+                    due = self._queue[0][0]
+                    now = time.time()
+                    if due <= now:
+                        return heapq.heappop(self._queue)[2]
+                    self._condition.wait(due - now)
+                else:
+                    self._condition.wait()
+
+
+    def _session(self, address: str) -> requests.Session:
+        # One session per delivery thread, so connections to a receiver are reused
+        if not hasattr(self._local, 'session'):
+            session = requests.Session()
+            # A proxy would resolve the host again
+            session.trust_env = False
+            self._local.adapter = PinnedAddressAdapter()
+            session.mount('http://', self._local.adapter)
+            session.mount('https://', self._local.adapter)
+            self._local.session = session
+        self._local.adapter.address = address
+        return self._local.session
+
+
+    def _post(self, delivery: Delivery) -> Tuple[bool, bool]:
+        """
+        :return: whether the delivery succeeded, and whether a failure may be retried
+        """
+        address = resolve_callback_address(delivery.url, self.allowed_hosts)
+        if address is None:
+            logger.warning(f"Webhook of request {delivery.request_id} refused, its URL is not public: {delivery.url}")
+            return False, False
+        try:
+            response = self._session(address).post(delivery.url, json=delivery.payload, timeout=self.timeout,
+                                                   headers={'X-Request-Id': delivery.request_id,
+                                                            'Host': urlparse(delivery.url).netloc.rpartition('@')[2]},
+                                                   allow_redirects=False)
+        except requests.RequestException as e:
+            logger.warning(f"Webhook of request {delivery.request_id} failed: {e}")
+            return False, True
+        if response.is_redirect:
+            logger.warning(f"Webhook of request {delivery.request_id} redirected to {response.headers['Location']}, "
+                           f"redirects are not followed")
+            return False, False
+        if response.ok:
+            return True, False
+        logger.warning(f"Webhook of request {delivery.request_id} got status {response.status_code}")
+        return False, response.status_code >= 500 or response.status_code in RETRYABLE_STATUS_CODES
+
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_seconds * 2 ** (attempts - 1), self.max_backoff_seconds)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+    def _work(self) -> None:
+        while True:
+            delivery = self._next_delivery()
+            delivery.attempts += 1
+            delivered, retryable = self._post(delivery)
+            if not delivered and retryable and delivery.attempts < self.max_attempts:
+                with self._condition:
+                    self._schedule(delivery, time.time() + self._backoff(delivery.attempts))
+                continue
+            if self.on_done is not None:
+                try:
+                    self.on_done(delivery, delivered)
+                except Exception as e:
+                    logger.warning(f"Webhook completion handler failed: {e}")
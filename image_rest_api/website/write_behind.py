@@ -0,0 +1,157 @@
+import time
+import atexit
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from pymongo import UpdateMany
+from pymongo.collection import Collection
+from pymongo.errors import AutoReconnect, BulkWriteError, NetworkTimeout
+from pymongo.write_concern import WriteConcern
+from shared.utils import get_logger
+
+logger = get_logger()
+
+
+class WriteBehindWriter:
+    """
+    Write-behind of request_track writes that no caller has to wait for, and that can be lost with the worker,
+    e.g. the outcome of a webhook delivery. Writes a client was answered about, such as an accepted job or
+    its result, are not written behind.
+    Writes are queued in memory and sent by a background thread as ordered bulk_write batches of at most
+    max_batch operations, at most max_delay_seconds after the first of them was queued. Operations are applied
+    in the order they were queued; an operation that fails is logged and skipped. Network errors are retried,
+    other errors drop the rest of the batch.
+    """
+    def __init__(self, collection: Collection, max_batch: int, max_delay_seconds: float, write_concern: WriteConcern):
+        """
+        :param collection: Mongo collection written to (request_track)
+        :param max_batch: maximum number of operations per bulk_write
+        :param max_delay_seconds: maximum seconds an operation waits for its batch
+        :param write_concern: write concern of the batches
+        """
+        self.collection = collection.with_options(write_concern=write_concern)
+        self.max_batch = max_batch
+        self.max_delay_seconds = max_delay_seconds
+        self.written = 0
+        self.batches = 0
+        self._pending: List[Tuple[Any, Optional[Callable[[], None]]]] = []
+        self._first_queued_at = 0.0
+        self._in_progress = 0
+        self._condition = threading.Condition()
+        self._writer: Optional[threading.Thread] = None
+
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending) + self._in_progress
+
+
+    def _ensure_writer(self) -> None:
+        # Started lazily so the thread belongs to the gunicorn worker, not to the master process
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_forever, daemon=True, name='write-behind')
+            self._writer.start()
+            atexit.register(self.flush)
+
+
+    def _queue(self, operation: Any, on_written: Optional[Callable[[], None]]) -> None:
+        with self._condition:
+            self._ensure_writer()
+            if not self._pending:
+                self._first_queued_at = time.time()
+            self._pending.append((operation, on_written))
+            self._condition.notify_all()
+
+
+    def update(self, requests_filter: Dict[str, Any], fields: Dict[str, Any],
+               on_written: Optional[Callable[[], None]] = None) -> None:
+        """
+        Queue a $set of fields on the documents matching a filter.
+        :param requests_filter: Mongo filter of the documents to update
+        :param fields: fields set on the documents
+        :param on_written: called once the documents are updated
+        """
+        self._queue(UpdateMany(requests_filter, {'$set': fields}), on_written)
+
+
+    def _take_batch(self) -> List[Tuple[Any, Optional[Callable[[], None]]]]:
+        with self._condition:
+            while True:
+                if self._pending:
+                    remaining = self._first_queued_at + self.max_delay_seconds - time.time()
+                    if remaining <= 0 or len(self._pending) >= self.max_batch:
+                        break
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait()
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            # What is left is at least a full batch, sent without waiting
+            self._first_queued_at = 0.0 if self._pending else time.time()
+            self._in_progress = len(batch)
+            return batch
+
+
+    def _write(self, batch: List[Tuple[Any, Optional[Callable[[], None]]]]) -> None:
+        operations = [operation for operation, _ in batch]
+        backoff = 0.1
+        while operations:
+            try:
+                self.collection.bulk_write(operations, ordered=True)
+                break
+            except BulkWriteError as e:
+                # A failed operation (e.g. a document grown too large) would fail again, the ones after it are not
+                # written yet
+                error = e.details['writeErrors'][0]
+                logger.warning(f"Write-behind operation failed: {error.get('errmsg')}")
+                operations = operations[error['index'] + 1:]
+            except (AutoReconnect, NetworkTimeout) as e:
+                logger.warning(f"Write-behind batch failed, retrying: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 5.0)
+            except Exception as e:
+                # e.g. an invalid document, it would fail forever
+                logger.error(f"Write-behind batch failed, dropping {len(operations)} operations: {e}")
+                break
+
+        with self._condition:
+            self.written += len(batch)
+            self.batches += 1
+            self._in_progress = 0
+            self._condition.notify_all()
+        for _, on_written in batch:
+            if on_written is not None:
+                try:
+                    on_written()
+                except Exception as e:
+                    logger.warning(f"Write-behind callback failed: {e}")
+
+
+    def _write_forever(self) -> None:
+        while True:
+            self._write(self._take_batch())
+
+
+    def flush(self, timeout: float = 30.0) -> bool:
+        """
+        Wait until every queued write is written, e.g. before the worker exits.
+        :param timeout: maximum seconds to wait
+        :return: True if everything was written in time
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            # The writer does not wait for max_delay_seconds while a flush is waiting
+            self._first_queued_at = 0.0
+            self._condition.notify_all()
+            while self._pending or self._in_progress:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._writer is None:
+                    return False
+                self._condition.wait(remaining)
+                self._first_queued_at = 0.0
+        return True
+
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: the writes waiting for their batch, and the writes and batches written, for /status
+        """
+        return {'pending': self.pending, 'written': self.written, 'batches': self.batches}
@@ -1,9 +1,11 @@
 import json
 import pandas as pd
 from pymongo import MongoClient
+from shared.metrics import MongoLatencyListener
 
 
-MONGO_CLIENT = MongoClient('mongodb://10.0.0.7:27017/')
+MONGO_URL = 'mongodb://10.0.0.7:27017/'
+MONGO_CLIENT = MongoClient(MONGO_URL, event_listeners=[MongoLatencyListener()])
 
 BOOKS_DF = pd.read_csv('./shared/books_data.csv')
 
@@ -31,6 +33,87 @@ with open('./shared/config.json', 'r') as file:
     STORY_API_PORT = config['STORY_API_PORT']
     WEB_SERVER_PORT = config['WEB_SERVER_PORT']
     TEST_PREFIX_UPLOADS_PATH = config['TEST_PREFIX_UPLOADS_PATH']
+    CACHE_MAX_ENTRIES = config['CACHE_MAX_ENTRIES']
+    CACHE_TTL_SECONDS = config['CACHE_TTL_SECONDS']
+    CACHE_NEGATIVE_TTL_SECONDS = config['CACHE_NEGATIVE_TTL_SECONDS']
+    PHASH_ALGORITHM = config['PHASH_ALGORITHM']
+    PHASH_MAX_DISTANCE = config['PHASH_MAX_DISTANCE']
+    PHASH_REFRESH_SECONDS = config['PHASH_REFRESH_SECONDS']
+    ASYNC_WORKERS = config['ASYNC_WORKERS']
+    ASYNC_RETRY_AFTER_SECONDS = config['ASYNC_RETRY_AFTER_SECONDS']
+    BATCH_MAX_IMAGES = config['BATCH_MAX_IMAGES']
+    BATCH_MAX_FILES = config['BATCH_MAX_FILES']
+    SINGLEFLIGHT_LEASE_SECONDS = config['SINGLEFLIGHT_LEASE_SECONDS']
+    SINGLEFLIGHT_POLL_SECONDS = config['SINGLEFLIGHT_POLL_SECONDS']
+    SINGLEFLIGHT_WAIT_SECONDS = config['SINGLEFLIGHT_WAIT_SECONDS']
+    PREPROCESS_ENABLED = config['PREPROCESS_ENABLED']
+    PREPROCESS_MAX_EDGE = config['PREPROCESS_MAX_EDGE']
+    PREPROCESS_TARGET_BYTES = config['PREPROCESS_TARGET_BYTES']
+    PREPROCESS_JPEG_QUALITY = config['PREPROCESS_JPEG_QUALITY']
+    MAX_UPLOAD_BYTES = config['MAX_UPLOAD_BYTES']
+    UPLOAD_SPOOL_BYTES = config['UPLOAD_SPOOL_BYTES']
+    MAX_IMAGE_PIXELS = config['MAX_IMAGE_PIXELS']
+    RESULT_MAX_WAIT_SECONDS = config['RESULT_MAX_WAIT_SECONDS']
+    RESULT_WAIT_RECHECK_SECONDS = config['RESULT_WAIT_RECHECK_SECONDS']
+    RESULT_EVENTS_MAX_SECONDS = config['RESULT_EVENTS_MAX_SECONDS']
+    RESULT_EVENTS_KEEPALIVE_SECONDS = config['RESULT_EVENTS_KEEPALIVE_SECONDS']
+    WEBHOOK_WORKERS = config['WEBHOOK_WORKERS']
+    WEBHOOK_QUEUE_DEPTH = config['WEBHOOK_QUEUE_DEPTH']
+    WEBHOOK_MAX_ATTEMPTS = config['WEBHOOK_MAX_ATTEMPTS']
+    WEBHOOK_BACKOFF_SECONDS = config['WEBHOOK_BACKOFF_SECONDS']
+    WEBHOOK_MAX_BACKOFF_SECONDS = config['WEBHOOK_MAX_BACKOFF_SECONDS']
+    WEBHOOK_TIMEOUT_SECONDS = config['WEBHOOK_TIMEOUT_SECONDS']
+    WEBHOOK_ALLOWED_HOSTS = config['WEBHOOK_ALLOWED_HOSTS']
+    REQUEST_TTL_SECONDS = config['REQUEST_TTL_SECONDS']
+    REQUEST_PENDING_TTL_SECONDS = config['REQUEST_PENDING_TTL_SECONDS']
+    MONITOR_FLUSH_SECONDS = config['MONITOR_FLUSH_SECONDS']
+    MONITOR_STALE_SECONDS = config['MONITOR_STALE_SECONDS']
+    LIMITER_INITIAL_LIMIT = config['LIMITER_INITIAL_LIMIT']
+    LIMITER_MIN_LIMIT = config['LIMITER_MIN_LIMIT']
+    LIMITER_MAX_LIMIT = config['LIMITER_MAX_LIMIT']
+    LIMITER_TARGET_LATENCY_SECONDS = config['LIMITER_TARGET_LATENCY_SECONDS']
+    LIMITER_BACKOFF_RATIO = config['LIMITER_BACKOFF_RATIO']
+    LIMITER_MAX_QUEUE = config['LIMITER_MAX_QUEUE']
+    LIMITER_QUEUE_TIMEOUT_SECONDS = config['LIMITER_QUEUE_TIMEOUT_SECONDS']
+    BREAKER_FAILURE_THRESHOLD = config['BREAKER_FAILURE_THRESHOLD']
+    BREAKER_OPEN_SECONDS = config['BREAKER_OPEN_SECONDS']
+    CLASSIFIER_BACKEND = config['CLASSIFIER_BACKEND']
+    CLASSIFIER_FALLBACK_BACKEND = config['CLASSIFIER_FALLBACK_BACKEND']
+    LOCAL_MODEL_PATH = config['LOCAL_MODEL_PATH']
+    LOCAL_LABELS_PATH = config['LOCAL_LABELS_PATH']
+    LOCAL_TOP_K = config['LOCAL_TOP_K']
+    FAKE_LATENCY_SECONDS = config['FAKE_LATENCY_SECONDS']
+    FAKE_LATENCY_JITTER_SECONDS = config['FAKE_LATENCY_JITTER_SECONDS']
+    FAKE_ERROR_RATE = config['FAKE_ERROR_RATE']
+    FAKE_SEED = config['FAKE_SEED']
+    ASGI_JOB_WORKERS = config['ASGI_JOB_WORKERS']
+    PRIORITY_INTERACTIVE_WEIGHT = config['PRIORITY_INTERACTIVE_WEIGHT']
+    PRIORITY_BATCH_WEIGHT = config['PRIORITY_BATCH_WEIGHT']
+    PRIORITY_INTERACTIVE_RESERVED_SHARE = config['PRIORITY_INTERACTIVE_RESERVED_SHARE']
+    PRIORITY_BATCH_QUEUE_TIMEOUT_SECONDS = config['PRIORITY_BATCH_QUEUE_TIMEOUT_SECONDS']
+    JOB_QUEUE_MAX_DEPTH = config['JOB_QUEUE_MAX_DEPTH']
+    JOB_LEASE_SECONDS = config['JOB_LEASE_SECONDS']
+    JOB_HEARTBEAT_SECONDS = config['JOB_HEARTBEAT_SECONDS']
+    JOB_MAX_ATTEMPTS = config['JOB_MAX_ATTEMPTS']
+    JOB_RETRY_BACKOFF_SECONDS = config['JOB_RETRY_BACKOFF_SECONDS']
+    JOB_POLL_SECONDS = config['JOB_POLL_SECONDS']
+    JOB_INLINE_IMAGE_BYTES = config['JOB_INLINE_IMAGE_BYTES']
+    RESULTS_MAX_IDS = config['RESULTS_MAX_IDS']
+    WRITE_BEHIND_MAX_BATCH = config['WRITE_BEHIND_MAX_BATCH']
+    WRITE_BEHIND_MAX_DELAY_SECONDS = config['WRITE_BEHIND_MAX_DELAY_SECONDS']
+    REQUEST_WRITE_CONCERN_W = config['REQUEST_WRITE_CONCERN_W']
+    REQUEST_WRITE_CONCERN_J = config['REQUEST_WRITE_CONCERN_J']
+    DECODE_POOL_WORKERS = config['DECODE_POOL_WORKERS']
+    IDEMPOTENCY_TTL_SECONDS = config['IDEMPOTENCY_TTL_SECONDS']
+    IDEMPOTENCY_LEASE_SECONDS = config['IDEMPOTENCY_LEASE_SECONDS']
+    IDEMPOTENCY_POLL_SECONDS = config['IDEMPOTENCY_POLL_SECONDS']
+    IDEMPOTENCY_WAIT_SECONDS = config['IDEMPOTENCY_WAIT_SECONDS']
+    IDEMPOTENCY_KEY_MAX_LENGTH = config['IDEMPOTENCY_KEY_MAX_LENGTH']
+    MICRO_BATCH_MAX_IMAGES = config['MICRO_BATCH_MAX_IMAGES']
+    MICRO_BATCH_MAX_WINDOW_SECONDS = config['MICRO_BATCH_MAX_WINDOW_SECONDS']
+    WEB_SYNC_DEADLINE_SECONDS = config['WEB_SYNC_DEADLINE_SECONDS']
+    WEB_ASYNC_DEADLINE_SECONDS = config['WEB_ASYNC_DEADLINE_SECONDS']
+    WEB_STORY_DEADLINE_SECONDS = config['WEB_STORY_DEADLINE_SECONDS']
     IMAGE_API_BASE_URL = f"http://image_rest_api:{IMAGE_API_PORT}/"
     STORY_API_BASE_URL = f"http://story_api:{STORY_API_PORT}/"
     WEB_SERVER_URL = f"http://{PUBLIC_IP}:{WEB_SERVER_PORT}/"
\ No newline at end of file
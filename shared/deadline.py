@@ -0,0 +1,221 @@
+import math
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional
+from flask import Flask, Response, request, jsonify
+
+# Unix time in seconds after which nobody waits for the response of a request anymore
+DEADLINE_HEADER = 'X-Request-Deadline'
+# Milliseconds the client waits for the response, from when the request is received. Preferred to
+# DEADLINE_HEADER, which is only right when the clocks of the client and the server agree
+DEADLINE_MS_HEADER = 'X-Request-Deadline-Ms'
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('request_deadline', default=None)
+_cancellation: contextvars.ContextVar[Optional['Cancellation']] = contextvars.ContextVar('cancellation', default=None)
+
+
+class DeadlineExceededError(Exception):
+    """
+    Raised when the deadline of a request passed before its work started or finished.
+    """
+    def __init__(self, message: str = 'The deadline of the request passed'):
+        super().__init__(message)
+
+
+class Cancellation:
+    """
+    Cancellation of work by another thread, e.g. of a running job cancelled through the API.
+    Work running under a cancelled Cancellation is past its deadline: it stops at the same points as work
+    whose deadline passed, and waits for the model are woken up by the callbacks.
+    """
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+    def add_callback(self, callback: Callable[[], None]) -> None:
+        """
+        :param callback: called once when the work is cancelled, at once if it already is
+        """
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+
+def parse_deadline(value: Optional[str], relative: bool = False) -> Optional[float]:
+    """
+    :param value: the X-Request-Deadline header, or the X-Request-Deadline-Ms header if relative
+    :param relative: whether the value is milliseconds from now rather than a Unix time in seconds
+    :return: the deadline as a Unix time in seconds, None if the header is missing or not a number
+    """
+    if not value:
+        return None
+    try:
+        deadline = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(deadline):
+        return None
+    return time.time() + deadline / 1000 if relative else deadline
+
+
+def current_deadline() -> Optional[float]:
+    """
+    :return: the deadline of the request being served by this thread or task, None if it has none
+    """
+    return _deadline.get()
+
+
+def current_cancellation() -> Optional[Cancellation]:
+    """
+    :return: the cancellation of the work being run by this thread or task, None if it cannot be cancelled
+    """
+    return _cancellation.get()
+
+
+def remaining_seconds() -> Optional[float]:
+    """
+    :return: seconds left before the deadline of the current request, 0 if it was cancelled, None if it has none
+    """
+    cancellation = _cancellation.get()
+    if cancellation is not None and cancellation.cancelled:
+        return 0.0
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+
+def deadline_passed() -> bool:
+    remaining = remaining_seconds()
+    return remaining is not None and remaining <= 0
+
+
+def check_cancelled(cancellation: Optional[Cancellation]) -> None:
+    """
+    :param cancellation: the cancellation of some work, None if it cannot be cancelled
+    :raises DeadlineExceededError: if the work was cancelled
+    """
+    if cancellation is not None and cancellation.cancelled:
+        raise DeadlineExceededError('The request was cancelled')
+
+
+def check_deadline() -> None:
+    """
+    :raises DeadlineExceededError: if the deadline of the current request passed, or it was cancelled
+    """
+    check_cancelled(_cancellation.get())
+    if deadline_passed():
+        raise DeadlineExceededError()
+
+
+@contextmanager
+def use_deadline(deadline: Optional[float]) -> Iterator[None]:
+    """
+    Run the body of the with statement under a deadline, e.g. the one of a queued job or of a batch.
+    :param deadline: Unix time in seconds, None for no deadline
+    """
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def use_cancellation(cancellation: Optional[Cancellation]) -> Iterator[None]:
+    """
+    Run the body of the with statement so that cancel() stops it.
+    :param cancellation: the cancellation of the work, None for work that cannot be cancelled
+    """
+    token = _cancellation.set(cancellation)
+    try:
+        yield
+    finally:
+        _cancellation.reset(token)
+
+
+def begin_request(headers: Mapping[str, str]) -> None:
+    """
+    Read the deadline of an incoming request, for the rest of its handling.
+    The relative X-Request-Deadline-Ms header is used when the request has both.
+    :param headers: the request headers
+    :raises DeadlineExceededError: if the deadline already passed, the request is not worth starting
+    """
+    deadline = parse_deadline(headers.get(DEADLINE_MS_HEADER), relative=True)
+    _deadline.set(deadline if deadline is not None else parse_deadline(headers.get(DEADLINE_HEADER)))
+    check_deadline()
+
+
+def outgoing_request_options(timeout: float) -> Dict[str, Any]:
+    """
+    Keyword arguments of a requests call to another service, which then works under the same deadline.
+    The deadline is sent as the time left rather than as a Unix time, so that it does not depend on the clocks
+    of both hosts agreeing; the time the request spends in transit is not accounted for.
+    :param timeout: seconds the caller waits for the call
+    :return: the deadline header, the earlier of timeout from now and the current deadline, and the matching timeout
+    """
+    deadline = time.time() + timeout
+    if _deadline.get() is not None:
+        deadline = min(deadline, _deadline.get())
+    remaining = max(deadline - time.time(), 0.001)
+    return {'headers': {DEADLINE_MS_HEADER: f'{remaining * 1000:.0f}'}, 'timeout': remaining}
+
+
+def model_request_options() -> Dict[str, Any]:
+    """
+    Keyword arguments of a generate_content call, so that the model call is cut at the deadline of the request.
+    :return: the request_options timeout, or nothing for a request without deadline
+    :raises DeadlineExceededError: if the deadline already passed
+    """
+    check_deadline()
+    remaining = remaining_seconds()
+    if remaining is None:
+        return {}
+    return {'request_options': {'timeout': max(remaining, 0.001)}}
+
+
+def deadline_exceeded_body(e: DeadlineExceededError) -> Dict[str, Any]:
+    return {'error': {'code': 504, 'message': str(e)}}
+
+
+def _before_request() -> None:
+    begin_request(request.headers)
+
+
+def _teardown_request(exception) -> None:
+    # The threads of the WSGI server are reused, the next request starts without deadline
+    _deadline.set(None)
+
+
+def _deadline_exceeded(e: DeadlineExceededError) -> Response:
+    response = jsonify(deadline_exceeded_body(e))
+    response.status_code = 504
+    return response
+
+
+def init_deadlines(app: Flask) -> None:
+    """
+    Serve the requests of a Flask app under the deadline of their X-Request-Deadline-Ms or X-Request-Deadline header.
+    A request arriving after its deadline is answered 504 at once, as is one whose deadline passes while it waits.
+    :param app: the Flask app
+    """
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    app.register_error_handler(DeadlineExceededError, _deadline_exceeded)
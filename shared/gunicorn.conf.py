@@ -0,0 +1,20 @@
+import os
+import shutil
+from prometheus_client import multiprocess
+
+
+def on_starting(server):
+    """
+    Empty the Prometheus multiprocess directory, the files of a previous run would be summed with the new ones.
+    """
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """
+    Drop the live gauges of a worker that exited.
+    """
+    multiprocess.mark_process_dead(worker.pid)
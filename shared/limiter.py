@@ -0,0 +1,440 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional, Type
+from shared.metrics import LIMITER_LIMIT, LIMITER_IN_FLIGHT, LIMITER_CIRCUIT, LIMITER_SHED
+from shared.deadline import (DeadlineExceededError, check_deadline, current_cancellation, current_deadline,
+                             deadline_passed)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+CIRCUIT_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Lane:
+    """
+    A class of calls sharing an AdaptiveLimiter, with its own queue.
+    Waiting calls are served across lanes in proportion to their weights, and a lane never holds more than
+    max_share of the concurrency limit, so that the rest of it stays reserved for the other lanes. A lane with
+    a max_share below 1 always leaves at least one slot to the others, however low the limit gets.
+    """
+    def __init__(self, name: str, weight: float, max_share: float = 1.0, queue_timeout: Optional[float] = None):
+        """
+        :param name: name of the lane in /status
+        :param weight: share of the slots given to the lane while several lanes are waiting
+        :param max_share: highest share of the concurrency limit used by the lane
+        :param queue_timeout: maximum seconds a call waits for a slot, the limiter's by default
+        """
+        self.name = name
+        self.weight = weight
+        self.max_share = max_share
+        self.queue_timeout = queue_timeout
+        self.waiters: Deque['_Waiter'] = deque()
+        self.in_flight = 0
+        self.served = 0
+        self.shed = 0
+        self.expired = 0
+        self.total_wait = 0.0
+        self.virtual_time = 0.0
+
+
+class _Waiter:
+    def __init__(self, wake: Callable[[], None]):
+        self.wake = wake
+        self.enqueued_at = time.time()
+        self.started: Optional[float] = None
+        self.error: Optional[Exception] = None
+
+
+class OverloadedError(Exception):
+    """
+    Raised when a call is shed by an AdaptiveLimiter instead of waiting for the dependency.
+    """
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(OverloadedError):
+    """
+    Raised when a call is shed because the circuit of an AdaptiveLimiter is open, or while its probe call runs.
+    """
+
+
+def is_dependency_failure(error: BaseException) -> bool:
+    """
+    :param error: exception raised by a call to the dependency
+    :return: True for a timeout, a connection error or a 5xx answer. Any other error, e.g. an input the dependency
+        rejects or an answer that does not parse, says nothing about the health of the dependency.
+    """
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    response = getattr(error, 'response', None)
+    # The HTTP status of the errors of the Google API clients and of requests
+    statuses = (getattr(error, 'code', None), getattr(error, 'status_code', None), getattr(response, 'status_code', None))
+    return any(isinstance(status, int) and 500 <= status < 600 for status in statuses)
+
+
+class AdaptiveLimiter:
+    """
+    Adaptive concurrency limit and circuit breaker around calls to a slow dependency.
+    The limit follows AIMD: it grows by about one per limit's worth of calls answered within
+    target_latency, and is multiplied by backoff_ratio when a call is slower or fails, at most once per
+    round of calls in flight. Calls beyond the limit wait in the queue of their lane up to queue_timeout,
+    with at most max_queue of them waiting per lane; the others are shed with OverloadedError.
+    Free slots go to the waiting lane with the lowest virtual time, which advances by 1 / weight per call
+    served (weighted fair queueing), and within a lane in arrival order.
+    A new call waits behind the calls already queued in any lane, so that free slots are only ever handed out
+    by the fair queueing.
+    Only timeouts, connection errors and 5xx answers count as failures, see is_dependency_failure.
+    After failure_threshold failures in a row the circuit opens: the waiting calls and every new call are shed
+    with CircuitOpenError for open_seconds, then a single probe call is let through to decide whether to close
+    it again.
+    A call waits no longer than the deadline of its request: it leaves the queue with DeadlineExceededError
+    once nobody waits for its result anymore, or as soon as its work is cancelled.
+    """
+    def __init__(self, name: str, initial_limit: int, min_limit: int, max_limit: int, target_latency: float,
+                 backoff_ratio: float, max_queue: int, queue_timeout: float, failure_threshold: int,
+                 open_seconds: float, lanes: Optional[List[Lane]] = None):
+        """
+        :param name: name of the dependency in /status and /metrics
+        :param initial_limit: concurrency limit at start
+        :param min_limit: lowest concurrency limit, at least 2 with a lane reserving slots for the others
+        :param max_limit: highest concurrency limit
+        :param target_latency: seconds above which a call is a congestion signal
+        :param backoff_ratio: factor applied to the limit on congestion
+        :param max_queue: maximum number of calls waiting for a slot, per lane
+        :param queue_timeout: maximum seconds a call waits for a slot
+        :param failure_threshold: failures in a row that open the circuit
+        :param open_seconds: seconds the circuit stays open before a probe call
+        :param lanes: the lanes of the calls, the first one being the default, a single interactive lane if None
+        """
+        self.name = name
+        self.lanes = {lane.name: lane for lane in (lanes or [Lane(INTERACTIVE, 1)])}
+        self.default_lane = next(iter(self.lanes))
+        if any(lane.max_share < 1 for lane in self.lanes.values()):
+            # One slot for the lane and one reserved for the others, or the lane could never run
+            min_limit = max(min_limit, 2)
+        self.limit = float(max(initial_limit, min_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff_ratio = backoff_ratio
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.in_flight = 0
+        self.shed = 0
+        self.expired = 0
+        self.circuit = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._last_decrease = 0.0
+        self._probing = False
+        self._virtual_time = 0.0
+        self._average_latency = target_latency
+        self._lock = threading.Lock()
+        LIMITER_LIMIT.labels(name).set(self.limit)
+
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(lane.waiters) for lane in self.lanes.values())
+
+
+    def _lane(self, name: Optional[str]) -> Lane:
+        if name is None:
+            return self.lanes[self.default_lane]
+        if name not in self.lanes:
+            raise ValueError(f"Unknown lane '{name}' for {self.name}, expected one of {sorted(self.lanes)}")
+        return self.lanes[name]
+
+
+    def _retry_after(self) -> float:
+        if self.circuit == OPEN:
+            return max(self._opened_at + self.open_seconds - time.time(), 1)
+        return max(self._average_latency, 1)
+
+
+    def _shed(self, lane: Lane, message: str, error_class: Type[OverloadedError] = OverloadedError) -> OverloadedError:
+        self.shed += 1
+        lane.shed += 1
+        LIMITER_SHED.labels(self.name).inc()
+        return error_class(message, self._retry_after())
+
+
+    def _expire(self, lane: Lane) -> DeadlineExceededError:
+        self.expired += 1
+        lane.expired += 1
+        return DeadlineExceededError(f'The deadline of the request passed while it waited for {self.name}')
+
+
+    def _wake_on_cancel(self, waiter: _Waiter) -> None:
+        cancellation = current_cancellation()
+        if cancellation is not None:
+            cancellation.add_callback(waiter.wake)
+
+
+    def _wait_seconds(self, shed_at: float) -> float:
+        """
+        :param shed_at: the time after which the call is shed
+        :return: seconds a queued call waits for a slot, until it is shed or its request deadline passes
+        """
+        deadline = current_deadline()
+        return max((shed_at if deadline is None else min(shed_at, deadline)) - time.time(), 0)
+
+
+    def _set_circuit(self, circuit: str) -> None:
+        self.circuit = circuit
+        LIMITER_CIRCUIT.labels(self.name).set(CIRCUIT_STATES[circuit])
+
+
+    def _open_circuit(self) -> None:
+        """
+        Called with the lock held: open the circuit and shed the waiting calls at once, rather than when they time out.
+        """
+        self._opened_at = time.time()
+        self._set_circuit(OPEN)
+        for lane in self.lanes.values():
+            while lane.waiters:
+                waiter = lane.waiters.popleft()
+                waiter.error = self._shed(lane, f'{self.name} is failing, try again later', CircuitOpenError)
+                waiter.wake()
+
+
+    def _lane_limit(self, lane: Lane) -> int:
+        limit = max(1, int(self.limit * lane.max_share))
+        if lane.max_share < 1:
+            # The reservation of the other lanes matters most when congestion shrank the limit to a few calls
+            limit = min(limit, int(self.limit) - 1)
+        return limit
+
+
+    def _has_slot(self, lane: Lane) -> bool:
+        return self.in_flight < int(self.limit) and lane.in_flight < self._lane_limit(lane)
+
+
+    def _admit(self, lane: Lane) -> bool:
+        """
+        Called with the lock held.
+        :return: True if a call may start now, False if it has to wait for a slot
+        :raises CircuitOpenError: if the circuit sheds the call
+        """
+        if self.circuit == OPEN:
+            if time.time() - self._opened_at < self.open_seconds:
+                raise self._shed(lane, f'{self.name} is failing, try again later', CircuitOpenError)
+            self._set_circuit(HALF_OPEN)
+        if self.circuit == HALF_OPEN:
+            if self._probing:
+                raise self._shed(lane, f'{self.name} is recovering, try again later', CircuitOpenError)
+            self._probing = True
+            return True
+        # Calls already waiting in any lane go first, the queueing decides whether the call starts right away
+        return not self.waiting and self._has_slot(lane)
+
+
+    def _start(self, lane: Lane) -> float:
+        self.in_flight += 1
+        lane.in_flight += 1
+        lane.served += 1
+        LIMITER_IN_FLIGHT.labels(self.name).inc()
+        return time.time()
+
+
+    def _enqueue(self, lane: Lane, waiter: _Waiter) -> float:
+        """
+        Called with the lock held, by a call that has to wait for a slot.
+        :return: the time after which the call is shed
+        """
+        if len(lane.waiters) >= self.max_queue:
+            raise self._shed(lane, f'Too many pending {self.name} calls, try again later')
+        if not lane.waiters:
+            # A lane coming back from idle does not get credit for the time it was idle
+            lane.virtual_time = max(lane.virtual_time, self._virtual_time)
+        lane.waiters.append(waiter)
+        self._dispatch()
+        return waiter.enqueued_at + (lane.queue_timeout if lane.queue_timeout is not None else self.queue_timeout)
+
+
+    def _dispatch(self) -> None:
+        """
+        Called with the lock held: start waiting calls while there are free slots, fairly across lanes.
+        """
+        while self.circuit == CLOSED:
+            ready = [lane for lane in self.lanes.values() if lane.waiters and self._has_slot(lane)]
+            if not ready:
+                return
+            lane = min(ready, key=lambda ready_lane: ready_lane.virtual_time)
+            self._virtual_time = lane.virtual_time
+            lane.virtual_time += 1 / lane.weight
+            waiter = lane.waiters.popleft()
+            waiter.started = self._start(lane)
+            lane.total_wait += waiter.started - waiter.enqueued_at
+            waiter.wake()
+
+
+    def _leave(self, lane: Lane, waiter: _Waiter) -> Optional[float]:
+        """
+        Take a call out of its queue once it stops waiting.
+        :return: the time the call started, None if it never got a slot
+        """
+        with self._lock:
+            if waiter.started is None and waiter.error is None:
+                lane.waiters.remove(waiter)
+            return waiter.started
+
+
+    def _not_started(self, lane: Lane) -> Exception:
+        with self._lock:
+            if deadline_passed():
+                return self._expire(lane)
+            return self._shed(lane, f'Too many pending {self.name} calls, try again later')
+
+
+    def _acquire(self, lane: Lane) -> float:
+        check_deadline()
+        event = threading.Event()
+        waiter = _Waiter(event.set)
+        with self._lock:
+            if self._admit(lane):
+                return self._start(lane)
+            shed_at = self._enqueue(lane, waiter)
+        self._wake_on_cancel(waiter)
+        event.wait(self._wait_seconds(shed_at))
+        started = self._leave(lane, waiter)
+        if started is None:
+            raise waiter.error or self._not_started(lane)
+        return started
+
+
+    async def _acquire_async(self, lane: Lane) -> float:
+        check_deadline()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = _Waiter(lambda: loop.call_soon_threadsafe(_wake, future))
+        with self._lock:
+            if self._admit(lane):
+                return self._start(lane)
+            shed_at = self._enqueue(lane, waiter)
+        self._wake_on_cancel(waiter)
+        try:
+            await asyncio.wait_for(future, self._wait_seconds(shed_at))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if self._leave(lane, waiter) is not None:
+                self._cancel(lane)
+            raise
+        started = self._leave(lane, waiter)
+        if started is None:
+            raise waiter.error or self._not_started(lane)
+        return started
+
+
+    def _cancel(self, lane: Lane) -> None:
+        # A slot given to a call that was cancelled before using it
+        with self._lock:
+            self.in_flight -= 1
+            lane.in_flight -= 1
+            LIMITER_IN_FLIGHT.labels(self.name).dec()
+            self._dispatch()
+
+
+    def _release(self, lane: Lane, started: float, failed: bool) -> None:
+        latency = time.time() - started
+        with self._lock:
+            self.in_flight -= 1
+            lane.in_flight -= 1
+            LIMITER_IN_FLIGHT.labels(self.name).dec()
+            self._average_latency = 0.9 * self._average_latency + 0.1 * latency
+            if self.circuit == HALF_OPEN:
+                self._probing = False
+                if failed:
+                    self._open_circuit()
+                else:
+                    self._failures = 0
+                    self._set_circuit(CLOSED)
+            elif failed:
+                self._failures += 1
+                if self._failures >= self.failure_threshold and self.circuit == CLOSED:
+                    self._open_circuit()
+            else:
+                self._failures = 0
+
+            if failed or latency > self.target_latency:
+                # Calls started before the last decrease already saw the congestion that caused it
+                if started >= self._last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                    self._last_decrease = time.time()
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            LIMITER_LIMIT.labels(self.name).set(self.limit)
+            self._dispatch()
+
+
+    @contextmanager
+    def call(self, lane: Optional[str] = None) -> Iterator[None]:
+        """
+        Run the body of the with statement within the concurrency limit.
+        A timeout, connection error or 5xx error raised by the body counts as a failure of the dependency, unless
+        the deadline of the request passed: a call cut short by its deadline says nothing about its health.
+        :param lane: name of the lane of the call, the default lane if None
+        :raises OverloadedError: if the call is shed, CircuitOpenError if it is shed by the circuit breaker
+        :raises DeadlineExceededError: if the deadline of the request passes before the call gets a slot
+        """
+        call_lane = self._lane(lane)
+        started = self._acquire(call_lane)
+        failed = False
+        try:
+            yield
+        except BaseException as e:
+            failed = is_dependency_failure(e) and not deadline_passed()
+            raise
+        finally:
+            self._release(call_lane, started, failed)
+
+
+    @asynccontextmanager
+    async def call_async(self, lane: Optional[str] = None) -> AsyncIterator[None]:
+        """
+        Same as call(), for coroutines: waiting for a slot does not block the event loop.
+        :raises OverloadedError: if the call is shed, CircuitOpenError if it is shed by the circuit breaker
+        :raises DeadlineExceededError: if the deadline of the request passes before the call gets a slot
+        """
+        call_lane = self._lane(lane)
+        started = await self._acquire_async(call_lane)
+        failed = False
+        try:
+            yield
+        except BaseException as e:
+            failed = is_dependency_failure(e) and not deadline_passed()
+            raise
+        finally:
+            self._release(call_lane, started, failed)
+
+
+    def state(self) -> Dict[str, Any]:
+        """
+        :return: the current limit, load and circuit state, with the queue of every lane, for /status
+        """
+        with self._lock:
+            lanes = {lane.name: {'weight': lane.weight, 'limit': self._lane_limit(lane), 'in_flight': lane.in_flight,
+                                 'waiting': len(lane.waiters), 'served': lane.served, 'shed': lane.shed,
+                                 'expired': lane.expired,
+                                 'avg_wait_ms': 1000 * lane.total_wait / lane.served if lane.served else 0.0}
+                     for lane in self.lanes.values()}
+            return {'limit': int(self.limit), 'in_flight': self.in_flight, 'waiting': self.waiting,
+                    'circuit': self.circuit, 'shed': self.shed, 'expired': self.expired, 'lanes': lanes}
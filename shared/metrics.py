@@ -0,0 +1,241 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from flask import Flask, Response, g, request
+from pymongo import monitoring
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, Summary,
+                               generate_latest, multiprocess)
+
+# Name of the service in the metric labels, set by init_metrics()
+SERVICE = 'unknown'
+
+# The metrics of a multiprocess server are written there as soon as they are touched, e.g. when a module
+# creating a limiter is imported. gunicorn empties it on start, but it has to exist under any server
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+REQUESTS = Counter('http_requests_total', 'HTTP requests handled',
+                   ['service', 'route', 'method', 'status'])
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time spent handling an HTTP request',
+                            ['service', 'route'], buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests being handled',
+                           ['service'], multiprocess_mode='livesum')
+RESPONSE_SIZE = Summary('http_response_size_bytes', 'Size of the HTTP response bodies',
+                        ['service', 'route'])
+DEPENDENCY_LATENCY = Histogram('dependency_duration_seconds', 'Time spent in a dependency (model, mongo, decode)',
+                               ['service', 'dependency'], buckets=LATENCY_BUCKETS)
+LIMITER_LIMIT = Gauge('limiter_concurrency_limit', 'Adaptive concurrency limit of a dependency',
+                      ['dependency'], multiprocess_mode='livesum')
+LIMITER_IN_FLIGHT = Gauge('limiter_in_flight', 'Calls in flight to a dependency',
+                          ['dependency'], multiprocess_mode='livesum')
+LIMITER_CIRCUIT = Gauge('limiter_circuit_state', 'Circuit breaker state of a dependency (0 closed, 1 half open, 2 open)',
+                        ['dependency'], multiprocess_mode='livemax')
+LIMITER_SHED = Counter('limiter_shed_total', 'Calls to a dependency shed by its limiter',
+                       ['dependency'])
+MICRO_BATCH_SIZE = Histogram('micro_batch_size', 'Images per model call of the micro-batched requests',
+                             ['service', 'lane'], buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+MICRO_BATCH_WAIT = Histogram('micro_batch_wait_seconds', 'Time an image waited for its micro-batch to be sent',
+                             ['service', 'lane'], buckets=LATENCY_BUCKETS)
+
+
+def observe_latency(dependency: str, seconds: float) -> None:
+    """
+    Record the time spent in a dependency.
+    :param dependency: 'model', 'mongo', 'decode' or 'decode_queue'
+    :param seconds: time spent
+    """
+    DEPENDENCY_LATENCY.labels(SERVICE, dependency).observe(seconds)
+
+
+def observe_micro_batch(lane: str, size: int, waits: List[float]) -> None:
+    """
+    Record the size of a micro-batch and the time its images waited for it.
+    :param lane: priority lane of the batch
+    :param size: number of images of the batch
+    :param waits: seconds every image waited
+    """
+    MICRO_BATCH_SIZE.labels(SERVICE, lane).observe(size)
+    for seconds in waits:
+        MICRO_BATCH_WAIT.labels(SERVICE, lane).observe(seconds)
+
+
+@contextmanager
+def track_latency(dependency: str) -> Iterator[None]:
+    """
+    Record the time spent in the body of the with statement as time spent in a dependency.
+    :param dependency: 'model', 'mongo', 'decode' or 'decode_queue'
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_latency(dependency, time.perf_counter() - start)
+
+
+class MongoLatencyListener(monitoring.CommandListener):
+    """
+    Record the duration of the Mongo commands, measured by the driver.
+    The getMore commands of change streams and tailable cursors are left out: they wait on the server for
+    new documents, up to a second each, which is not the latency of a query.
+    """
+    def __init__(self):
+        # Cursors whose getMore commands wait for new documents
+        self._awaiting_cursors: Set[int] = set()
+        # Commands opening such a cursor, and the cursor of the getMore commands left out, by connection and request
+        self._opening: Set[Tuple[Any, int]] = set()
+        self._skipped: Dict[Tuple[Any, int], int] = {}
+        self._lock = threading.Lock()
+
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        command = event.command
+        key = (event.connection_id, event.request_id)
+        with self._lock:
+            if event.command_name == 'getMore' and command.get('getMore') in self._awaiting_cursors:
+                self._skipped[key] = command['getMore']
+            elif event.command_name == 'killCursors':
+                self._awaiting_cursors.difference_update(command.get('cursors', []))
+            elif (event.command_name == 'find' and command.get('tailable')) or (
+                    event.command_name == 'aggregate' and '$changeStream' in (command.get('pipeline') or [{}])[0]):
+                self._opening.add(key)
+
+
+    def _is_query(self, event, reply: Optional[Dict[str, Any]]) -> bool:
+        """
+        :param event: the succeeded or failed event of a command
+        :param reply: the reply of the command, None if it failed
+        :return: False for the getMore commands left out
+        """
+        key = (event.connection_id, event.request_id)
+        cursor_id = ((reply or {}).get('cursor') or {}).get('id')
+        with self._lock:
+            if key in self._opening:
+                self._opening.discard(key)
+                if cursor_id:
+                    self._awaiting_cursors.add(cursor_id)
+            skipped = self._skipped.pop(key, None)
+            if skipped is not None and not cursor_id:
+                # The cursor is exhausted or failed
+                self._awaiting_cursors.discard(skipped)
+        return skipped is None
+
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        if self._is_query(event, event.reply):
+            observe_latency('mongo', event.duration_micros / 1e6)
+
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        if self._is_query(event, None):
+            observe_latency('mongo', event.duration_micros / 1e6)
+
+
+def _route(url_rule) -> str:
+    # The rule template, so that /result/<request_id> is one series and not one per id
+    return url_rule.rule if url_rule is not None else 'unmatched'
+
+
+def _start_request(request_globals) -> None:
+    request_globals.metrics_start = time.perf_counter()
+    REQUESTS_IN_FLIGHT.labels(SERVICE).inc()
+
+
+def _record_response(request_globals, url_rule, status_code: int, content_length: Optional[int]) -> None:
+    if 'metrics_start' not in request_globals:
+        return
+    request_globals.metrics_status = status_code
+    if content_length is not None:
+        RESPONSE_SIZE.labels(SERVICE, _route(url_rule)).observe(content_length)
+
+
+def _end_request(request_globals, url_rule, method: str) -> None:
+    # Runs after unhandled exceptions and after streamed responses end, unlike after_request
+    start = request_globals.pop('metrics_start', None)
+    if start is None:
+        return
+    route = _route(url_rule)
+    REQUESTS_IN_FLIGHT.labels(SERVICE).dec()
+    REQUEST_LATENCY.labels(SERVICE, route).observe(time.perf_counter() - start)
+    REQUESTS.labels(SERVICE, route, method, request_globals.pop('metrics_status', 500)).inc()
+
+
+def _after_request(response: Response) -> Response:
+    _record_response(g, request.url_rule, response.status_code, response.content_length)
+    return response
+
+
+def _teardown_request(exception) -> None:
+    _end_request(g, request.url_rule, request.method)
+
+
+def metrics_text() -> bytes:
+    """
+    :return: the metrics of all the workers of the service, in the Prometheus text format
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def metrics() -> Response:
+    return Response(metrics_text(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+def init_metrics(app: Flask, service: str) -> None:
+    """
+    Record the request metrics of a Flask app and expose them on GET /metrics.
+    Under gunicorn, PROMETHEUS_MULTIPROC_DIR has to point to a directory shared by the workers,
+    so that /metrics reports the sum of all of them.
+    :param app: the Flask app
+    :param service: name of the service in the metric labels
+    """
+    global SERVICE
+    SERVICE = service
+    app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
+
+    @app.before_request
+    def before_request() -> None:
+        if request.endpoint != 'metrics':
+            _start_request(g)
+
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+
+def init_async_metrics(app, service: str) -> None:
+    """
+    Same as init_metrics() for the Quart app of the async serving mode, under uvicorn.
+    :param app: the Quart app
+    :param service: name of the service in the metric labels
+    """
+    # Imported here, the Flask services do not depend on Quart
+    from quart import Response as AsyncResponse, g as async_g, request as async_request
+
+    global SERVICE
+    SERVICE = service
+
+    async def async_metrics() -> AsyncResponse:
+        return AsyncResponse(metrics_text(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+    async def before_request() -> None:
+        if async_request.endpoint != 'metrics':
+            _start_request(async_g)
+
+    async def after_request(response: AsyncResponse) -> AsyncResponse:
+        _record_response(async_g, async_request.url_rule, response.status_code, response.content_length)
+        return response
+
+    async def teardown_request(exception) -> None:
+        _end_request(async_g, async_request.url_rule, async_request.method)
+
+    app.add_url_rule('/metrics', 'metrics', async_metrics, methods=['GET'])
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
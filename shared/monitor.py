@@ -0,0 +1,222 @@
+import os
+import time
+import atexit
+import socket
+import datetime
+import threading
+from typing import Any, Dict, List, Tuple
+from pymongo.collection import Collection
+from shared.utils import get_logger
+
+logger = get_logger()
+
+# Counters reported by /status even before any request incremented them
+DEFAULT_COUNTERS = ('success', 'fail', 'running', 'queued')
+# Counters of the work in progress, which only make sense summed over the live workers
+GAUGES = ('running',)
+# Document of the totals of every worker that ever ran, kept across worker restarts
+CUMULATIVE_ID = 'cumulative'
+
+
+def _add_nested(total: Dict[str, Any], counters: Dict[str, Any]) -> None:
+    for name, value in counters.items():
+        if isinstance(value, dict):
+            _add_nested(total.setdefault(name, {}), value)
+        elif isinstance(value, (int, float)):
+            total[name] = total.get(name, 0) + value
+
+
+def _nest(flat: Dict[str, float]) -> Dict[str, Any]:
+    nested: Dict[str, Any] = {}
+    for name, value in flat.items():
+        *parents, leaf = name.split('.')
+        node = nested
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = value
+    return nested
+
+
+class MonitorCounters:
+    """
+    In-process monitor counters, flushed to Mongo in the background.
+    Each thread increments its own shard without any lock or I/O. Every flush_seconds, the worker writes
+    the totals of its shards to its own document of the monitor collection, and adds what they grew by since
+    its previous flush to the cumulative document, with a single $inc.
+    snapshot() reads the counters from the cumulative document, so they do not drop when a worker restarts,
+    and the gauges (e.g. 'running') from the documents of the live workers. A worker that stops flushing
+    is dropped from the gauges after stale_seconds and its document expires through a TTL index.
+    The counters of the other workers are up to flush_seconds late.
+    Counter names may contain dots (e.g. 'preprocess.bytes_in') to group counters in nested documents.
+    """
+    def __init__(self, collection: Collection, flush_seconds: float, stale_seconds: float):
+        """
+        :param collection: Mongo collection of the worker documents (monitor_health)
+        :param flush_seconds: interval between two flushes of this worker
+        :param stale_seconds: seconds without a flush after which a worker is considered dead
+        """
+        self.collection = collection
+        self.flush_seconds = flush_seconds
+        self.stale_seconds = stale_seconds
+        self.start_time = time.time()
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, Dict[str, float]]] = []
+        self._retired: Dict[str, float] = {}
+        # Totals already added to the cumulative document
+        self._flushed: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self.detached = False
+
+
+    @property
+    def worker_id(self) -> str:
+        # Read at each use, the counters may be created before gunicorn forks the workers
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+
+    def ensure_indexes(self) -> None:
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+        # The single shared document of the former $inc counters
+        self.collection.delete_many({'worker': {'$exists': False}, '_id': {'$ne': CUMULATIVE_ID}})
+
+
+    def detach(self) -> None:
+        """
+        Keep the counters in this process, for a process that uses the service code without being one of its
+        workers (e.g. the bulk classification CLI): they are never flushed, so they do not show up in /status.
+        """
+        self.detached = True
+
+
+    def _shard(self) -> Dict[str, float]:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            self._ensure_flusher()
+        return shard
+
+
+    def _ensure_flusher(self) -> None:
+        # Started lazily so the thread belongs to the gunicorn worker, not to the master process
+        with self._lock:
+            if self._flusher is None and not self.detached:
+                self._flusher = threading.Thread(target=self._flush_forever, daemon=True, name='monitor-flush')
+                self._flusher.start()
+                atexit.register(self.flush)
+
+
+    def increment(self, **increments: float) -> None:
+        """
+        Increment counters of the calling thread's shard.
+        :param increments: counter name to increment mapping
+        """
+        shard = self._shard()
+        for name, value in increments.items():
+            shard[name] = shard.get(name, 0) + value
+
+
+    def totals(self) -> Dict[str, float]:
+        """
+        :return: the flat totals of this worker's counters
+        """
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    # Nothing writes to the shard of a finished thread anymore
+                    for name, value in shard.items():
+                        self._retired[name] = self._retired.get(name, 0) + value
+            self._shards = live
+            totals = dict(self._retired)
+        for _, shard in live:
+            # dict() copies atomically under the GIL while the owner thread keeps writing
+            for name, value in dict(shard).items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+
+    def _document(self, totals: Dict[str, float]) -> Dict[str, Any]:
+        now = datetime.datetime.utcnow()
+        return {'worker': self.worker_id, 'start_time': self.start_time, 'updated_at': time.time(),
+                'expires_at': now + datetime.timedelta(seconds=self.stale_seconds),
+                'counters': _nest(totals)}
+
+
+    def _unflushed(self, totals: Dict[str, float]) -> Dict[str, float]:
+        """
+        :return: how much the counters other than the gauges grew since they were last added to the cumulative document
+        """
+        return {name: value - self._flushed.get(name, 0) for name, value in totals.items()
+                if name not in GAUGES and value != self._flushed.get(name, 0)}
+
+
+    def flush(self) -> None:
+        """
+        Write this worker's totals to its monitor document, and their growth to the cumulative document.
+        The totals replace the previous ones and the growth is only marked as added once the $inc succeeded,
+        so a failed flush loses nothing and is caught up by the next one.
+        """
+        if self.detached:
+            return
+        with self._flush_lock:
+            totals = self.totals()
+            try:
+                self.collection.replace_one({'_id': self.worker_id}, self._document(totals), upsert=True)
+            except Exception as e:
+                logger.warning(f"Failed to flush monitor counters: {e}")
+            growth = self._unflushed(totals)
+            if not growth:
+                return
+            try:
+                self.collection.update_one({'_id': CUMULATIVE_ID},
+                                           {'$inc': {f'counters.{name}': value for name, value in growth.items()}},
+                                           upsert=True)
+            except Exception as e:
+                logger.warning(f"Failed to flush cumulative monitor counters: {e}")
+                return
+            for name, value in growth.items():
+                self._flushed[name] = self._flushed.get(name, 0) + value
+
+
+    def _flush_forever(self) -> None:
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Read the cumulative counters, with what this worker did not flush yet, and sum the gauges of all
+        live workers, using the current totals of this worker.
+        :return: nested counters, with 'start_time' set to the start of the oldest live worker
+        """
+        with self._flush_lock:
+            totals = self.totals()
+            unflushed = self._unflushed(totals)
+        documents = [self._document(totals)]
+        cumulative: Dict[str, Any] = {}
+        try:
+            for document in self.collection.find(
+                    {'$or': [{'_id': CUMULATIVE_ID},
+                             {'_id': {'$ne': self.worker_id}, 'updated_at': {'$gt': time.time() - self.stale_seconds}}]},
+                    {'start_time': 1, 'counters': 1}):
+                if document['_id'] == CUMULATIVE_ID:
+                    cumulative = document.get('counters', {})
+                else:
+                    documents.append(document)
+        except Exception as e:
+            logger.warning(f"Failed to read the monitor counters of the other workers: {e}")
+        total: Dict[str, Any] = {name: 0 for name in DEFAULT_COUNTERS}
+        _add_nested(total, {name: value for name, value in cumulative.items() if name not in GAUGES})
+        _add_nested(total, _nest(unflushed))
+        for document in documents:
+            counters = document.get('counters', {})
+            _add_nested(total, {name: counters[name] for name in GAUGES if name in counters})
+        total['start_time'] = min(document['start_time'] for document in documents)
+        return total
@@ -10,9 +10,15 @@ import google.generativeai as genai
 from typing import List, Dict, Union
 from flask import jsonify, Response
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '.', '..')))
-from shared.constants import API_KEY
+from shared.constants import (API_KEY, LIMITER_INITIAL_LIMIT, LIMITER_MIN_LIMIT, LIMITER_MAX_LIMIT,
+                              LIMITER_TARGET_LATENCY_SECONDS, LIMITER_BACKOFF_RATIO, LIMITER_MAX_QUEUE,
+                              LIMITER_QUEUE_TIMEOUT_SECONDS, BREAKER_FAILURE_THRESHOLD, BREAKER_OPEN_SECONDS,
+                              PRIORITY_INTERACTIVE_WEIGHT, PRIORITY_BATCH_WEIGHT, PRIORITY_INTERACTIVE_RESERVED_SHARE,
+                              PRIORITY_BATCH_QUEUE_TIMEOUT_SECONDS)
+from shared.limiter import AdaptiveLimiter, Lane, INTERACTIVE, BATCH
 
 MODEL = None
+MODEL_LIMITERS: Dict[str, AdaptiveLimiter] = {}
 
 
 def create_json_response(data: Union[List, Dict], status_code: int) -> Response:
@@ -35,6 +41,18 @@ def create_json_response(data: Union[List, Dict], status_code: int) -> Response:
     return response
 
 
+def create_retry_after_response(message: str, retry_after: float) -> Response:
+    """
+    Creates a 503 JSON error response telling the client when to retry.
+    :param message: error message
+    :param retry_after: seconds the client should wait before retrying
+    :return: response (Response): The Flask response object with the Retry-After header set.
+    """
+    response = create_json_response({'error': {'code': 503, 'message': message}}, 503)
+    response.headers['Retry-After'] = str(max(1, int(round(retry_after))))
+    return response
+
+
 def get_LLM_model():
     """
     Get the LLM model from the generative AI API.
@@ -48,6 +66,26 @@ def get_LLM_model():
     return MODEL
 
 
+def get_model_limiter(name: str = 'gemini') -> AdaptiveLimiter:
+    """
+    Get the concurrency limiter and circuit breaker of the calls to a model.
+    Calls made while a user waits (the default lane) are served before batch calls, and batch calls
+    never take the share of the limit reserved for interactive ones.
+    :param name: name of the model backend
+    :return: The limiter shared by all the calls of the process to that model.
+    """
+    if name not in MODEL_LIMITERS:
+        MODEL_LIMITERS[name] = AdaptiveLimiter(name, LIMITER_INITIAL_LIMIT, LIMITER_MIN_LIMIT, LIMITER_MAX_LIMIT,
+                                               LIMITER_TARGET_LATENCY_SECONDS, LIMITER_BACKOFF_RATIO, LIMITER_MAX_QUEUE,
+                                               LIMITER_QUEUE_TIMEOUT_SECONDS, BREAKER_FAILURE_THRESHOLD,
+                                               BREAKER_OPEN_SECONDS,
+                                               [Lane(INTERACTIVE, PRIORITY_INTERACTIVE_WEIGHT),
+                                                Lane(BATCH, PRIORITY_BATCH_WEIGHT, 1 - PRIORITY_INTERACTIVE_RESERVED_SHARE,
+                                                     PRIORITY_BATCH_QUEUE_TIMEOUT_SECONDS)])
+
+    return MODEL_LIMITERS[name]
+
+
 def generate_unique_code(length: int, rooms: List[str]) -> str:
     """
     Generate a unique code for a room.
@@ -66,45 +104,49 @@ def generate_unique_code(length: int, rooms: List[str]) -> str:
     return code
 
 
-def update_monitor_status(db, success_inc=0, fail_inc=0, running_inc=0, queued_inc=0) -> None:
+def update_monitor_status(monitor, success_inc=0, fail_inc=0, running_inc=0, queued_inc=0) -> None:
     """
-    Update the monitor status in the database.
-    :param db: MongoDB database collection
+    Update the monitor status counters.
+    :param monitor: MonitorCounters of the service
     :param success_inc: increment of success
     :param fail_inc: increment of fail
     :param running_inc: increment of running
     :param queued_inc: increment of queued
     :return: None
     """
-    try:
-        db.update_one(
-            {},
-            {'$inc': {
-                'success': success_inc,
-                'fail': fail_inc,
-                'running': running_inc,
-                'queued': queued_inc
-            }}
-        )
-    except Exception as e:
-        raise Exception(f"Failed to update monitor status: {e}")
+    monitor.increment(success=success_inc, fail=fail_inc, running=running_inc, queued=queued_inc)
+
+
+def increment_monitor_counters(monitor, **increments) -> None:
+    """
+    Increment arbitrary monitor counters.
+    :param monitor: MonitorCounters of the service
+    :param increments: counter name to increment mapping
+    :return: None
+    """
+    monitor.increment(**increments)
 
 
-def monitor_status(db):
+def monitor_status(monitor):
     """
     Increment the running status of the monitor before running the function and update the status after running.
-    :param db: MongoDB database collection
+    A function that raises is counted as failed.
+    :param monitor: MonitorCounters of the service
     :return: decorator function
     """
     def decorator_status(func):
         def wrapper(*args, **kwargs):
-            update_monitor_status(db, running_inc=1)
-            json_response = func(*args, **kwargs)
+            update_monitor_status(monitor, running_inc=1)
+            try:
+                json_response = func(*args, **kwargs)
+            except Exception:
+                update_monitor_status(monitor, fail_inc=1, running_inc=-1)
+                raise
             status_code = json_response.status_code
             if status_code >= 400:
-                update_monitor_status(db, fail_inc=1, running_inc=-1)
+                update_monitor_status(monitor, fail_inc=1, running_inc=-1)
             else:
-                update_monitor_status(db, success_inc=1, running_inc=-1)
+                update_monitor_status(monitor, success_inc=1, running_inc=-1)
             return json_response
         
         wrapper.__name__ = func.__name__
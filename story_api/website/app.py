@@ -1,6 +1,8 @@
 import time
 from flask import Flask
 from .story_api import story_api
+from shared.metrics import init_metrics
+from shared.deadline import init_deadlines
 
 
 def create_app() -> Flask:
@@ -19,5 +21,7 @@ def create_app() -> Flask:
     app.config['process_dict'] = {}
     
     app.register_blueprint(story_api, url_prefix='/')
+    init_metrics(app, 'story_api')
+    init_deadlines(app)
 
     return app
\ No newline at end of file
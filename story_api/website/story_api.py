@@ -4,13 +4,25 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 from shared.utils import *
 from shared.constants import BOOKS_DF
+from shared.metrics import track_latency
+from shared.limiter import OverloadedError
+from shared.deadline import check_deadline, model_request_options
 from flask import Blueprint, request, Response
 
 model = get_LLM_model()
+model_limiter = get_model_limiter()
 
 # Define Blueprint for views
 story_api = Blueprint('story_api', __name__)
 
+@story_api.errorhandler(OverloadedError)
+def model_overloaded(e: OverloadedError) -> Response:
+    """
+    Shed the request with a 503 when the model is too slow or failing, instead of queueing it.
+    """
+    return create_retry_after_response(str(e), e.retry_after)
+
+
 @story_api.route("/get_story", methods=['POST'])
 def get_story() -> Response:
     """
@@ -65,8 +77,14 @@ def get_story() -> Response:
               """
 
     
-    response = model.generate_content([prompt], stream=True)
-    response.resolve()
+    try:
+        with model_limiter.call(), track_latency('model'):
+            # Cut at the deadline of the request, the web server does not wait for the story any longer
+            response = model.generate_content([prompt], stream=True, **model_request_options())
+            response.resolve()
+    except Exception:
+        check_deadline()
+        raise
     story_dict = json.loads(response.text)
     
     return create_json_response({"title":story_dict['title'],
@@ -0,0 +1,84 @@
+import io
+import time
+import unittest
+import PIL.Image
+from werkzeug.datastructures import FileStorage
+from in_process import image_api, create_test_async_app
+
+
+def encode_image(color):
+    """
+    :return: the content of a new PNG image of a single color
+    """
+    image = io.BytesIO()
+    PIL.Image.new('RGB', (64, 48), color).save(image, format='PNG')
+    return image.getvalue()
+
+
+class AsyncAppTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Test suite for the async serving mode, through the test client of its Quart app.
+    The app runs in-process, on mongomock and the fake classifier backend.
+    """
+    async def asyncSetUp(self):
+        self.app = create_test_async_app()
+        self.serving = self.app.test_app()
+        await self.serving.startup()
+        self.client = self.app.test_client()
+
+
+    async def asyncTearDown(self):
+        await self.serving.shutdown()
+
+
+    async def _upload(self, endpoint, data, **kwargs):
+        files = {'image': FileStorage(io.BytesIO(data), 'image.png', content_type='image/png')}
+        return await self.client.post(f'/{endpoint}', files=files, **kwargs)
+
+
+    async def test_status(self):
+        """
+        Test the status endpoint.
+        Verifies the app reports the asgi serving mode.
+        """
+        response = await self.client.get('/status')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('asgi', (await response.get_json())['status']['serving_mode'])
+
+
+    async def test_upload_image(self):
+        """
+        Test a sync upload, then one whose deadline already passed.
+        Verifies the first is classified and the second answered with 504.
+        """
+        response = await self._upload('upload_image', encode_image((30, 60, 90)))
+        self.assertEqual(200, response.status_code)
+        self.assertIn('matches', await response.get_json())
+
+        response = await self._upload('upload_image', encode_image((30, 60, 91)),
+                                      headers={'X-Request-Deadline-Ms': '-1'})
+        self.assertEqual(504, response.status_code)
+
+
+    async def test_async_upload_and_wait_for_result(self):
+        """
+        Test an async upload, then a long poll of its result.
+        Verifies the job is written before the 202, and the long poll answers with its result once it ran.
+        """
+        response = await self._upload('async_upload', encode_image((90, 60, 30)))
+        self.assertEqual(202, response.status_code)
+        request_id = (await response.get_json())['request_id']
+        self.assertIsNotNone(image_api.request_collection.find_one({'request_id': request_id}))
+
+        started = time.time()
+        response = await self.client.get(f'/result/{request_id}', query_string={'wait': 10})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('completed', (await response.get_json())['status'])
+        self.assertLess(time.time() - started, 10)
+
+        response = await self.client.get('/result/unknown')
+        self.assertEqual(404, response.status_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import time
+import asyncio
+import unittest
+from unittest import mock
+import PIL.Image
+from in_process import image_api
+from website import classifiers
+from website.classifiers import ClassifierBackend, FakeClassifier, FAKE_LABELS, create_classifier
+from shared.deadline import DeadlineExceededError, use_deadline
+from shared.limiter import AdaptiveLimiter, OverloadedError, OPEN
+
+
+def create_image(color):
+    """
+    :return: a small image of a single color
+    """
+    return PIL.Image.new('RGB', (32, 32), color)
+
+
+class BrokenClassifier(ClassifierBackend):
+    """
+    Backend failing to load, as the local backend does without its model file.
+    """
+    name = 'broken'
+
+    def __init__(self):
+        raise FileNotFoundError('The broken classifier backend is missing its model')
+
+    def classify(self, img):
+        return None
+
+
+class FakeClassifierTest(unittest.TestCase):
+    """
+    Test suite for the fake classifier backend used by benchmarks and the no-server test suites.
+    """
+    def test_labels_follow_content(self):
+        """
+        Test classifying the same images twice, alone and in a batch, with two backends of different seeds.
+        Verifies the label only depends on the image content.
+        """
+        images = [create_image(color) for color in ((255, 0, 0), (0, 255, 0), (0, 0, 255))]
+        backend = FakeClassifier(latency=0, jitter=0, error_rate=0, seed=1)
+        results = backend.classify_batch(images)
+        self.assertEqual(results, [backend.classify(image) for image in images])
+        self.assertEqual(results, FakeClassifier(latency=0, jitter=0, error_rate=0, seed=2).classify_batch(images))
+        for result in results:
+            self.assertIn(result['matches'][0]['name'], FAKE_LABELS)
+        blob = {'mime_type': 'image/png', 'data': b'same bytes'}
+        self.assertEqual(backend.classify(blob), asyncio.run(backend.classify_async(dict(blob))))
+
+
+    def test_failures_are_connection_errors(self):
+        """
+        Test a backend whose every call fails.
+        Verifies the failures are ConnectionError, which the model limiter counts against the dependency.
+        """
+        backend = FakeClassifier(latency=0, jitter=0, error_rate=1)
+        with self.assertRaises(ConnectionError):
+            backend.classify(create_image((0, 0, 0)))
+        with self.assertRaises(ConnectionError):
+            asyncio.run(backend.classify_batch_async([create_image((0, 0, 0))]))
+
+
+    def test_call_is_cut_at_deadline(self):
+        """
+        Test a call slower than the time left before the deadline of its request.
+        Verifies it times out at the deadline rather than after its latency.
+        """
+        backend = FakeClassifier(latency=5, jitter=0, error_rate=0)
+        started = time.time()
+        with use_deadline(started + 0.1), self.assertRaises(DeadlineExceededError):
+            backend.classify(create_image((0, 0, 0)))
+        self.assertLess(time.time() - started, 1)
+
+
+class BackendSelectionTest(unittest.TestCase):
+    """
+    Test suite for the selection of the classifier backends by name.
+    """
+    def test_backend_is_created_by_name(self):
+        """
+        Test creating the fake backend and an unknown one.
+        Verifies the fake backend is created, and the unknown name rejected with the list of backends.
+        """
+        self.assertIsInstance(create_classifier('fake'), FakeClassifier)
+        with self.assertRaisesRegex(ValueError, "Unknown classifier backend 'resnet'"):
+            create_classifier('resnet')
+
+
+    def test_backend_must_classify(self):
+        """
+        Test instantiating the base class, and a backend that does not implement classify().
+        Verifies both are refused.
+        """
+        class BatchOnlyClassifier(ClassifierBackend):
+            def classify_batch(self, imgs):
+                return [None for _ in imgs]
+
+        for backend in (ClassifierBackend, BatchOnlyClassifier):
+            with self.assertRaises(TypeError):
+                backend()
+
+
+    def test_fallback_that_cannot_load_is_disabled(self):
+        """
+        Test creating no fallback backend, one that fails to load and the fake one.
+        Verifies a fallback that fails to load disables the failover instead of failing the startup.
+        """
+        self.assertIsNone(image_api.create_fallback_classifier(''))
+        with mock.patch.dict(classifiers.BACKENDS, {BrokenClassifier.name: BrokenClassifier}):
+            self.assertIsNone(image_api.create_fallback_classifier(BrokenClassifier.name))
+        self.assertIsInstance(image_api.create_fallback_classifier('fake'), FakeClassifier)
+
+
+class FallbackTest(unittest.TestCase):
+    """
+    Test suite for the failover of model calls shed by the limiter of the main backend.
+    """
+    def setUp(self):
+        limiter = AdaptiveLimiter(name='test', initial_limit=1, min_limit=1, max_limit=1, target_latency=10,
+                                  backoff_ratio=0.5, max_queue=1, queue_timeout=1, failure_threshold=1,
+                                  open_seconds=60)
+        with self.assertRaises(ConnectionError):
+            with limiter.call():
+                raise ConnectionError('Connection refused')
+        self.assertEqual(OPEN, limiter.circuit)
+        patcher = mock.patch.object(image_api, 'model_limiter', limiter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_shed_call_fails_over(self):
+        """
+        Test a model call shed by the open circuit of the main backend, with a fallback backend.
+        Verifies the fallback answers it.
+        """
+        fallback = FakeClassifier(latency=0, jitter=0, error_rate=0)
+        with mock.patch.object(image_api, 'fallback_classifier', fallback):
+            self.assertIs(fallback, image_api.call_classifier(lambda backend: backend))
+            result = image_api.classify_image(create_image((10, 20, 30)))
+        self.assertEqual(fallback.classify(create_image((10, 20, 30))), result)
+
+
+    def test_shed_call_without_fallback(self):
+        """
+        Test a model call shed by the open circuit of the main backend, without a fallback backend.
+        Verifies the call is shed with OverloadedError rather than classified as failed.
+        """
+        with mock.patch.object(image_api, 'fallback_classifier', None):
+            with self.assertRaises(OverloadedError):
+                image_api.classify_image(create_image((10, 20, 30)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import os
+import json
+import random
+import tempfile
+import unittest
+import PIL.Image
+from in_process import image_api
+import classify_folder
+from classify_folder import Progress, read_manifest, run, walk_directory
+
+
+def write_image(path, format='PNG'):
+    """
+    Write an image classified by no previous test.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    PIL.Image.effect_noise((32, 32), random.randint(100, 10 ** 9)).convert('RGB').save(path, format=format)
+
+
+class ClassifyFolderTest(unittest.TestCase):
+    """
+    Test suite for the bulk classification CLI.
+    It runs on mongomock and the fake classifier backend, through the in-process image API.
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.images = os.path.join(self.directory, 'images')
+        self.output = os.path.join(self.directory, 'results.jsonl')
+        write_image(os.path.join(self.images, 'b.png'))
+        write_image(os.path.join(self.images, 'a', 'c.jpg'), 'JPEG')
+        os.makedirs(os.path.join(self.images, 'a'), exist_ok=True)
+        with open(os.path.join(self.images, 'a', 'notes.txt'), 'w') as file:
+            file.write('not an image')
+        with open(os.path.join(self.images, 'broken.png'), 'w') as file:
+            file.write('not an image either')
+
+
+    def _records(self):
+        with open(self.output) as file:
+            return [json.loads(line) for line in file]
+
+
+    def _run(self, paths=None):
+        return run(walk_directory(self.images) if paths is None else paths, self.output, concurrency=2,
+                   report_seconds=60)
+
+
+    def test_directory_is_classified(self):
+        """
+        Test a run over a directory with images, a non-image with an image extension and a text file.
+        Verifies the images are walked in a stable order, classified or found invalid, and summarized.
+        """
+        images = [os.path.join(self.images, 'b.png'), os.path.join(self.images, 'a', 'c.jpg')]
+        broken = os.path.join(self.images, 'broken.png')
+        self.assertEqual([images[0], broken, images[1]], list(walk_directory(self.images)))
+
+        summary = self._run()
+        records = {record['path']: record for record in self._records()}
+        self.assertEqual({*images, broken}, set(records))
+        for path in images:
+            self.assertEqual('completed', records[path]['status'])
+            self.assertIn('matches', records[path])
+        self.assertEqual('invalid', records[broken]['status'])
+        self.assertEqual((2, 1, 0, 0), (summary['completed'], summary['invalid'], summary['failed'], summary['skipped']))
+        self.assertIn('p99_ms', summary)
+
+
+    def test_run_resumes_from_output(self):
+        """
+        Test a run over an output left by a crashed run: a record of a classified image, one of a failed
+        image and a partial line.
+        Verifies the partial line is dropped, the classified image skipped and the failed one classified again.
+        """
+        classified, failed = os.path.join(self.images, 'b.png'), os.path.join(self.images, 'a', 'c.jpg')
+        with open(self.output, 'w') as file:
+            file.write(json.dumps({'path': classified, 'status': 'completed', 'matches': []}) + '\n')
+            file.write(json.dumps({'path': failed, 'status': 'failed', 'error': 'Classification failed'}) + '\n')
+            file.write('{"path": "' + classified[:5])
+
+        summary = self._run()
+        records = self._records()
+        self.assertEqual(1, summary['skipped'])
+        self.assertEqual([classified, failed], [record['path'] for record in records[:2]])
+        new_records = {record['path']: record['status'] for record in records[2:]}
+        self.assertEqual({failed: 'completed', os.path.join(self.images, 'broken.png'): 'invalid'}, new_records)
+
+        summary = self._run()
+        self.assertEqual(3, summary['skipped'])
+        self.assertEqual(len(records), len(self._records()))
+
+
+    def test_manifest_paths(self):
+        """
+        Test a manifest with a relative path, an absolute path, a comment and a blank line.
+        Verifies relative paths are relative to the manifest, and that only the listed images are classified.
+        """
+        manifest = os.path.join(self.directory, 'images.txt')
+        with open(manifest, 'w') as file:
+            file.write(f"# images to classify\nimages/b.png\n\n{os.path.join(self.images, 'a', 'c.jpg')}\n")
+        paths = list(read_manifest(manifest))
+        self.assertEqual([os.path.join(self.images, 'b.png'), os.path.join(self.images, 'a', 'c.jpg')], paths)
+
+        summary = self._run(iter(paths))
+        self.assertEqual(2, summary['completed'])
+        self.assertEqual(paths, sorted({record['path'] for record in self._records()}, key=paths.index))
+
+
+    def test_run_is_not_counted_in_status(self):
+        """
+        Test the monitor of the API after a run of the CLI.
+        Verifies main() detaches it, so that the run does not show up as a worker in /status.
+        """
+        monitor = image_api.monitor
+        self.addCleanup(setattr, monitor, 'detached', False)
+        classify_folder.main([self.images, self.output, '--concurrency', '2'])
+        self.assertEqual(3, len(self._records()))
+
+        self.assertTrue(monitor.detached)
+        # The document a previous test suite of this process may have flushed
+        monitor.collection.delete_one({'_id': monitor.worker_id})
+        monitor.flush()
+        self.assertIsNone(monitor.collection.find_one({'_id': monitor.worker_id}))
+
+
+class ProgressTest(unittest.TestCase):
+    """
+    Test suite for the progress summary of a run.
+    """
+    def test_percentiles_from_buckets(self):
+        """
+        Test the percentiles of latencies from 1 to 1000ms, and of a latency above the highest bucket.
+        Verifies they are reported within the 10% width of a bucket.
+        """
+        progress = Progress()
+        for milliseconds in range(1, 1001):
+            progress.record('completed', milliseconds / 1000)
+        summary = progress.summary()
+        self.assertEqual(1000, summary['completed'])
+        for name, expected in (('p50_ms', 500), ('p90_ms', 900), ('p99_ms', 990)):
+            self.assertGreaterEqual(summary[name], expected)
+            self.assertLessEqual(summary[name], expected * 1.11)
+
+        progress = Progress()
+        progress.record('completed', 3600)
+        self.assertEqual(600000, progress.summary()['p50_ms'])
+
+
+if __name__ == '__main__':
+    unittest.main()
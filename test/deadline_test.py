@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import asyncio
+import contextvars
+import unittest
+import mongomock
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '.', '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'image_rest_api')))
+from shared.deadline import (DEADLINE_HEADER, DEADLINE_MS_HEADER, DeadlineExceededError, begin_request,
+                             current_deadline, outgoing_request_options, use_deadline)
+from website.idempotency import IdempotencyStore, IdempotencyInProgressError
+
+
+class DeadlineHeadersTest(unittest.TestCase):
+    """
+    Test suite for the deadline headers read from incoming requests and sent to other services.
+    """
+    def _deadline_of(self, headers):
+        """
+        :return: the deadline of a request with the given headers, read in a context of its own
+        """
+        def read():
+            begin_request(headers)
+            return current_deadline()
+        return contextvars.copy_context().run(read)
+
+
+    def test_relative_deadline_is_preferred(self):
+        """
+        Test requests with a relative deadline, an absolute one, both, and an invalid relative one.
+        Verifies the relative deadline counts from the arrival of the request and wins over the absolute one,
+        which is used when the relative one is missing or invalid.
+        """
+        now = time.time()
+        self.assertAlmostEqual(now + 2.5, self._deadline_of({DEADLINE_MS_HEADER: '2500'}), delta=0.5)
+        self.assertEqual(now + 60, self._deadline_of({DEADLINE_HEADER: str(now + 60)}))
+        self.assertAlmostEqual(now + 2.5, self._deadline_of({DEADLINE_MS_HEADER: '2500',
+                                                             DEADLINE_HEADER: str(now + 60)}), delta=0.5)
+        self.assertEqual(now + 60, self._deadline_of({DEADLINE_MS_HEADER: 'soon', DEADLINE_HEADER: str(now + 60)}))
+        self.assertIsNone(self._deadline_of({}))
+        with self.assertRaises(DeadlineExceededError):
+            self._deadline_of({DEADLINE_MS_HEADER: '-1'})
+
+
+    def test_outgoing_deadline_is_relative(self):
+        """
+        Test the options of a call to another service, without and with a closer deadline of the current request.
+        Verifies the time left is sent in milliseconds, whatever the clock of the other service.
+        """
+        options = outgoing_request_options(30)
+        self.assertEqual({DEADLINE_MS_HEADER}, set(options['headers']))
+        self.assertAlmostEqual(30000, int(options['headers'][DEADLINE_MS_HEADER]), delta=100)
+        with use_deadline(time.time() + 2):
+            options = outgoing_request_options(30)
+        self.assertAlmostEqual(2000, int(options['headers'][DEADLINE_MS_HEADER]), delta=100)
+        self.assertAlmostEqual(2, options['timeout'], delta=0.1)
+
+
+class IdempotencyWaitTest(unittest.TestCase):
+    """
+    Test suite for a retry waiting for the first request of its Idempotency-Key, on mongomock.
+    """
+    def setUp(self):
+        self.store = IdempotencyStore(mongomock.MongoClient().db.idempotency, ttl_seconds=60, lease_seconds=60,
+                                      poll_seconds=0.05, wait_seconds=60)
+        self.assertIsNone(self.store.begin('upload_image', 'key', 'fingerprint'))
+
+
+    def test_wait_ends_at_deadline(self):
+        """
+        Test a retry with a deadline much closer than wait_seconds, sent while the first request runs.
+        Verifies it gives up at its deadline with DeadlineExceededError rather than after wait_seconds.
+        """
+        started = time.time()
+        with use_deadline(started + 0.3), self.assertRaises(DeadlineExceededError):
+            self.store.begin('upload_image', 'key', 'fingerprint')
+        self.assertLess(time.time() - started, 1)
+
+        started = time.time()
+        with use_deadline(started + 0.3), self.assertRaises(DeadlineExceededError):
+            asyncio.run(self.store.begin_async('upload_image', 'key', 'fingerprint'))
+        self.assertLess(time.time() - started, 1)
+
+
+    def test_wait_without_deadline(self):
+        """
+        Test a retry without deadline, sent while the first request runs longer than wait_seconds.
+        Verifies it gives up after wait_seconds with IdempotencyInProgressError.
+        """
+        self.store.wait_seconds = 0.2
+        with self.assertRaises(IdempotencyInProgressError):
+            self.store.begin('upload_image', 'key', 'fingerprint')
+
+
+if __name__ == '__main__':
+    unittest.main()
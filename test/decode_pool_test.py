@@ -0,0 +1,88 @@
+import io
+import time
+import asyncio
+import unittest
+import PIL.Image
+from in_process import image_api
+from website.ingestion import IngestedImage, spool_upload
+from website.decode_pool import DecodePool, decode_upload
+from shared.deadline import DeadlineExceededError, use_deadline
+
+ALGORITHM = image_api.decode_pool.algorithm
+
+
+def encode_image(format, size):
+    """
+    :return: the content of a new noise image file in the given format
+    """
+    image = io.BytesIO()
+    PIL.Image.effect_noise(size, 60).convert('RGB').save(image, format=format)
+    return image.getvalue()
+
+
+class DecodePoolTest(unittest.TestCase):
+    """
+    Test suite for the pool of processes decoding the uploaded images.
+    A single spawned process decodes the images of the suite.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = DecodePool(1, ALGORITHM)
+        cls.pool.start()
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool._executor.shutdown()
+
+
+    def test_pool_matches_in_process_decoding(self):
+        """
+        Test decoding a large JPEG kept in memory, and one spooled to a file handed to the pool as its path.
+        Verifies the pool returns the model input and perceptual hash of preprocessing in the calling process,
+        with the time the image waited in the pool.
+        """
+        data = encode_image('JPEG', (1600, 1200))
+        decoded = self.pool.decoded
+        expected_input, expected_hash, _ = decode_upload(IngestedImage.from_bytes(data), ALGORITHM)
+
+        model_input, image_hash, stats = self.pool.decode(IngestedImage.from_bytes(data))
+        self.assertEqual((expected_input, expected_hash), (model_input, image_hash))
+        self.assertEqual({'bytes_in', 'bytes_out', 'decode_ms', 'resize_ms', 'encode_ms', 'queue_ms'}, set(stats))
+
+        with spool_upload(None, 'multipart/form-data') as stream:
+            stream.write(data)
+            upload = IngestedImage(stream)
+            self.assertIsNotNone(upload.path)
+            self.assertEqual((expected_input, expected_hash), self.pool.decode(upload)[:2])
+            self.assertEqual((expected_input, expected_hash), asyncio.run(self.pool.decode_async(upload))[:2])
+        # The count of a decoded image is updated right after its result is handed over
+        waited = time.time()
+        while self.pool.stats()['pending'] and time.time() - waited < 5:
+            time.sleep(0.01)
+        self.assertEqual({'workers': 1, 'pending': 0, 'decoded': decoded + 3}, self.pool.stats())
+
+
+    def test_image_past_deadline_is_dropped(self):
+        """
+        Test decoding an image whose request deadline already passed.
+        Verifies the pool drops it with DeadlineExceededError instead of decoding it.
+        """
+        with use_deadline(time.time() - 1), self.assertRaises(DeadlineExceededError):
+            self.pool.decode(IngestedImage.from_bytes(encode_image('PNG', (64, 64))))
+
+
+    def test_decoding_in_calling_thread(self):
+        """
+        Test a pool without processes.
+        Verifies it decodes in the calling thread to the same result as the processes.
+        """
+        upload = IngestedImage.from_bytes(encode_image('PNG', (640, 480)))
+        pool = DecodePool(0, ALGORITHM)
+        self.assertEqual(self.pool.decode(upload)[:2], pool.decode(upload)[:2])
+        self.assertIsNone(pool._executor)
+        self.assertEqual(1, pool.decoded)
+
+
+if __name__ == '__main__':
+    unittest.main()
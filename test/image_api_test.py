@@ -5,8 +5,10 @@ import time
 import random
 import unittest
 import requests
+import PIL.Image
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '.', '..')))
-from shared.constants import LOCAL_IP, IMAGE_API_PORT, TEST_PREFIX_UPLOADS_PATH
+from shared.constants import LOCAL_IP, IMAGE_API_PORT, TEST_PREFIX_UPLOADS_PATH, MONITOR_FLUSH_SECONDS
 
 
 class ImageUploadAPITest(unittest.TestCase):
@@ -116,6 +118,121 @@ class ImageUploadAPITest(unittest.TestCase):
             self.fail("Asynchronous classification did not complete in time.")
 
 
+    def test_async_result_visible_right_after_upload(self):
+        """
+        Test reading an asynchronous job right after its upload.
+        Verifies that the job is found, it is written before the upload is answered.
+        """
+        with open(self.valid_image_file, "rb") as file:
+            request_id = requests.post(self.image_api_base_url + "async_upload", files={"image": file}).json()['request_id']
+        result_response = requests.get(self.image_api_base_url + f'result/{str(request_id)}')
+        self.assertEqual(200, result_response.status_code)
+        self.assertIn(result_response.json()['status'], ['running', 'completed', 'error'])
+
+
+    def test_async_upload_idempotency_key(self):
+        """
+        Test retrying an asynchronous upload with the same Idempotency-Key, then reusing the key for another image.
+        Verifies that the retry gets the request id of the first upload, and that the reuse is rejected.
+        """
+        headers = {'Idempotency-Key': f'test-{random.getrandbits(64):x}'}
+        request_ids = []
+        for _ in range(2):
+            with open(self.valid_image_file, "rb") as file:
+                async_response = requests.post(self.image_api_base_url + "async_upload", files={"image": file},
+                                               headers=headers)
+            self.assertEqual(202, async_response.status_code)
+            request_ids.append(async_response.json()['request_id'])
+        self.assertEqual(request_ids[0], request_ids[1])
+        self.assertEqual('true', async_response.headers.get('Idempotent-Replayed'))
+
+        image = io.BytesIO()
+        PIL.Image.new('RGB', (32, 32), (0, 90, 0)).save(image, format='PNG')
+        image.seek(0)
+        conflict_response = requests.post(self.image_api_base_url + "async_upload",
+                                          files={"image": ('other.png', image, 'image/png')}, headers=headers)
+        self.assertEqual(422, conflict_response.status_code)
+        self._check_error_structure(conflict_response.json())
+
+
+    def test_duplicate_async_uploads_resolve_together(self):
+        """
+        Test uploading the same image asynchronously twice in a row.
+        Verifies that both request ids complete with the same classification.
+        """
+        request_ids = []
+        for _ in range(2):
+            with open(self.valid_image_file, "rb") as file:
+                async_response = requests.post(self.image_api_base_url + "async_upload",
+                                               files={"image": file})
+            self.assertEqual(202, async_response.status_code)
+            request_ids.append(async_response.json()['request_id'])
+        self.assertNotEqual(request_ids[0], request_ids[1])
+
+        results = {}
+        for _ in range(10):
+            time.sleep(2)
+            for request_id in request_ids:
+                result_data = requests.get(self.image_api_base_url + f'result/{str(request_id)}').json()
+                if result_data['status'] == 'completed':
+                    results[request_id] = result_data
+            if len(results) == len(request_ids):
+                break
+        else:
+            self.fail("Asynchronous classification did not complete in time.")
+        self.assertEqual(results[request_ids[0]]['matches'], results[request_ids[1]]['matches'])
+
+
+    def test_long_poll_result(self):
+        """
+        Test waiting for an asynchronous result with a single long-poll request.
+        Verifies that the result is returned as soon as the classification completes.
+        """
+        with open(self.valid_image_file, "rb") as file:
+            async_response = requests.post(self.image_api_base_url + "async_upload", files={"image": file})
+        self.assertEqual(202, async_response.status_code)
+        request_id = async_response.json()['request_id']
+
+        result_response = requests.get(self.image_api_base_url + f'result/{str(request_id)}', params={'wait': 30})
+        self._resp_is_json(result_response)
+        self.assertEqual(200, result_response.status_code)
+        result_data = result_response.json()
+        self.assertEqual('completed', result_data['status'])
+        self._check_match_structure(result_data['matches'])
+
+
+    def test_result_events(self):
+        """
+        Test following an asynchronous result as Server-Sent Events.
+        Verifies that the stream ends with the completed classification.
+        """
+        with open(self.valid_image_file, "rb") as file:
+            async_response = requests.post(self.image_api_base_url + "async_upload", files={"image": file})
+        request_id = async_response.json()['request_id']
+
+        events_response = requests.get(self.image_api_base_url + f'result/{str(request_id)}/events', timeout=60)
+        self.assertEqual(200, events_response.status_code)
+        self.assertTrue(events_response.headers['Content-Type'].startswith('text/event-stream'))
+        data_lines = [line for line in events_response.text.splitlines() if line.startswith('data: ')]
+        self.assertIn('"completed"', data_lines[-1])
+
+
+    def test_async_upload_invalid_callback_url(self):
+        """
+        Test asynchronous uploads with a callback URL that is not an http(s) URL, or that points to the
+        internal network.
+        Verifies the server returns a 400 status code.
+        """
+        for callback_url in ["ftp://example.com/hook", "http://127.0.0.1:6000/status", "http://10.0.0.1/hook",
+                             "http://169.254.169.254/latest/meta-data/", "http://[::1]/hook"]:
+            with open(self.valid_image_file, "rb") as file:
+                response = requests.post(self.image_api_base_url + "async_upload", files={"image": file},
+                                         data={"callback_url": callback_url})
+            self._resp_is_json(response)
+            self.assertEqual(400, response.status_code)
+            self._check_error_structure(response.json())
+
+
     def test_invalid_image_upload(self):
         """
         Test case for uploading an invalid file format (non-image file).
@@ -145,6 +262,20 @@ class ImageUploadAPITest(unittest.TestCase):
             self._check_error_structure(response.json())
 
 
+    def test_upload_past_deadline(self):
+        """
+        Test uploading an image with an X-Request-Deadline that already passed.
+        Verifies the server gives up on the request with a 504 instead of classifying the image.
+        """
+        for endpoint in ['upload_image', 'async_upload']:
+            with open(self.valid_image_file, "rb") as file:
+                response = requests.post(self.image_api_base_url + endpoint, files={"image": file},
+                                         headers={'X-Request-Deadline': str(time.time() - 1)})
+            self._resp_is_json(response)
+            self.assertEqual(504, response.status_code)
+            self._check_error_structure(response.json())
+
+
     def test_status(self):
         """
         Test checking the status endpoint.
@@ -175,6 +306,145 @@ class ImageUploadAPITest(unittest.TestCase):
         self.assertIsInstance(status_data['api_version'], (int, float))
 
 
+    def test_metrics(self):
+        """
+        Test the Prometheus metrics endpoint.
+        Verifies that it reports the requests per route and the latency histograms.
+        """
+        requests.get(self.image_api_base_url + "status")
+        response = requests.get(self.image_api_base_url + "metrics")
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        self.assertIn('http_requests_total{', response.text)
+        self.assertIn('route="/status"', response.text)
+        self.assertIn('http_request_duration_seconds_bucket{', response.text)
+
+
+    def test_status_priority_lanes(self):
+        """
+        Test the per-lane queue stats of the status endpoint.
+        Verifies that the interactive and batch lanes both report their model call queues.
+        """
+        with open(self.valid_image_file, "rb") as file:
+            requests.post(self.image_api_base_url + "upload_image", files={"image": file})
+        lanes = requests.get(self.image_api_base_url + "status").json()['status']['lanes']
+        for lane in ['interactive', 'batch']:
+            self.assertIn(lane, lanes)
+            for key in ['in_flight', 'waiting', 'served', 'avg_wait_ms']:
+                self.assertIn(key, lanes[lane])
+        self.assertIn('jobs_queued', lanes['batch'])
+
+
+    def test_status_job_queue(self):
+        """
+        Test the durable job queue stats of the status endpoint.
+        Verifies that a finished async job is neither queued nor leased anymore.
+        """
+        with open(self.valid_image_file, "rb") as file:
+            async_response = requests.post(self.image_api_base_url + "async_upload", files={"image": file})
+        request_id = async_response.json()['request_id']
+        requests.get(self.image_api_base_url + f'result/{str(request_id)}', params={'wait': 30})
+
+        jobs = requests.get(self.image_api_base_url + "status").json()['status']['jobs']
+        for key in ['queued', 'leased', 'dead_lettered']:
+            self.assertIn(key, jobs)
+            self.assertIsInstance(jobs[key], int)
+
+
+    def test_status_micro_batching(self):
+        """
+        Test the micro-batching stats of the status endpoint, after concurrent uploads of distinct images.
+        Verifies that every image sent to the model was counted in a batch of some size.
+        """
+        def upload(index):
+            image = io.BytesIO()
+            PIL.Image.effect_noise((64, 64), 20 + index).convert('RGB').save(image, format='PNG')
+            image.seek(0)
+            return requests.post(self.image_api_base_url + "upload_image",
+                                 files={"image": (f'noise_{index}.png', image, 'image/png')})
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(upload, range(4)))
+
+        micro_batching = requests.get(self.image_api_base_url + "status").json()['status']['micro_batching']
+        self.assertGreaterEqual(micro_batching['images'], micro_batching['batches'])
+        self.assertEqual(micro_batching['images'],
+                         sum(int(size) * count for size, count in micro_batching['sizes'].items()))
+        self.assertIn('avg_wait_ms', micro_batching)
+
+
+    def test_repeated_upload_hits_cache(self):
+        """
+        Test uploading the same image twice.
+        Verifies that the second upload is answered from the result cache with the same classification,
+        counted as a cache hit and not as a miss.
+        """
+        results, caches = [], []
+        for _ in range(2):
+            with open(self.valid_image_file, "rb") as file:
+                response = requests.post(self.image_api_base_url + "upload_image",
+                                         files={"image": file})
+            self.assertEqual(200, response.status_code)
+            results.append(response.json())
+            # The counters of the other workers are in /status once they flushed them
+            time.sleep(2 * MONITOR_FLUSH_SECONDS)
+            caches.append(requests.get(self.image_api_base_url + "status").json()['status']['cache'])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(caches[0]['hits'] + 1, caches[1]['hits'])
+        self.assertEqual(caches[0]['misses'], caches[1]['misses'])
+
+
+    def test_reencoded_upload_reuses_classification(self):
+        """
+        Test uploading a resized, re-encoded copy of an already classified image.
+        Verifies that the copy gets the classification of the original through the perceptual hash index.
+        """
+        with open(self.valid_image_file, "rb") as file:
+            original = requests.post(self.image_api_base_url + "upload_image", files={"image": file})
+        self.assertEqual(200, original.status_code)
+
+        image = PIL.Image.open(self.valid_image_file)
+        reencoded = io.BytesIO()
+        image.resize((image.width // 2, image.height // 2)).save(reencoded, format='JPEG', quality=70)
+        reencoded.seek(0)
+        response = requests.post(self.image_api_base_url + "upload_image",
+                                 files={'image': ('reencoded_dog.jpg', reencoded, 'image/jpeg')})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(original.json(), response.json())
+
+        cache_data = requests.get(self.image_api_base_url + "status").json()['status']['cache']
+        self.assertGreaterEqual(cache_data['near_duplicate_hits'], 1)
+
+
+    def test_batch_upload_images(self):
+        """
+        Test uploading several images in one request.
+        Verifies that every file gets its own result, in order, with per-file errors for invalid files.
+        """
+        with open(self.valid_image_file, "rb") as valid_file, open(self.invalid_image_file, "rb") as invalid_file:
+            response = requests.post(self.image_api_base_url + "upload_images",
+                                     files=[("images", valid_file), ("images", invalid_file)])
+        self._resp_is_json(response)
+        self.assertEqual(200, response.status_code)
+
+        results = response.json()['results']
+        self.assertEqual(2, len(results))
+        self.assertIn("matches", results[0])
+        self._check_match_structure(results[0]["matches"])
+        self._check_error_structure(results[1])
+
+
+    def test_batch_upload_without_images(self):
+        """
+        Test sending a batch request without any image.
+        Verifies the server returns a 400 status code.
+        """
+        response = requests.post(self.image_api_base_url + "upload_images", files={"images": None})
+        self._resp_is_json(response)
+        self.assertEqual(400, response.status_code)
+        self._check_error_structure(response.json())
+
+
     def test_result_not_found(self):
         """
         Test case for retrieving the result with an unknown request ID.
@@ -188,6 +458,48 @@ class ImageUploadAPITest(unittest.TestCase):
         self.assertEqual(result_response.json()['error']['message'], 'ID not found')
 
 
+    def test_cancel_unknown_request(self):
+        """
+        Test cancelling a request with an unknown request ID.
+        Verifies that the server returns a 404 status code.
+        """
+        random_request_id = str(random.randint(10000, 1000000))
+        response = requests.delete(self.image_api_base_url + f'result/{random_request_id}')
+
+        self.assertEqual(404, response.status_code)
+        self._check_error_structure(response.json())
+
+
+    def test_bulk_results(self):
+        """
+        Test retrieving many results in one request, with GET and with POST.
+        Verifies that the results follow the order of the ids and that unknown ids get a 404 error body.
+        """
+        with open(self.valid_image_file, "rb") as file:
+            request_id = requests.post(self.image_api_base_url + "async_upload", files={"image": file}).json()['request_id']
+        random_request_id = str(random.randint(10000, 1000000))
+
+        get_response = requests.get(self.image_api_base_url + "results", params={'ids': f'{request_id},{random_request_id}'})
+        post_response = requests.post(self.image_api_base_url + "results", json={'ids': [request_id, random_request_id]})
+        for response in [get_response, post_response]:
+            self._resp_is_json(response)
+            self.assertEqual(200, response.status_code)
+            results = response.json()['results']
+            self.assertEqual([request_id, random_request_id], [result['request_id'] for result in results])
+            self.assertIn(results[0]['status'], ['running', 'completed', 'error'])
+            self._check_error_structure(results[1])
+
+
+    def test_bulk_results_without_ids(self):
+        """
+        Test retrieving many results without any id.
+        Verifies the server returns a 400 status code.
+        """
+        response = requests.get(self.image_api_base_url + "results")
+        self.assertEqual(400, response.status_code)
+        self._check_error_structure(response.json())
+
+
     def test_upload_sync_empty_file(self):
         """
         Test case for uploading empty image (sync mode)
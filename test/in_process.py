@@ -0,0 +1,62 @@
+"""
+In-process image API for the test suites that need no running server.
+Mongo is replaced by mongomock and the model by the deterministic fake classifier backend.
+Import this module before any module of the API, e.g. `from in_process import image_api, create_test_app`.
+"""
+import os
+import sys
+import mongomock
+import mongomock.gridfs
+import pymongo
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '.', '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'image_rest_api')))
+
+mongomock.gridfs.enable_gridfs_integration()
+pymongo.MongoClient = mongomock.MongoClient
+import shared.constants
+if not isinstance(shared.constants.MONGO_CLIENT, mongomock.MongoClient):
+    # shared.constants was imported by another test suite, with the real client
+    shared.constants.MONGO_CLIENT = mongomock.MongoClient()
+
+from website import image_api
+from website.app import create_app
+from website.classifiers import FakeClassifier
+
+image_api.classifier = FakeClassifier(latency=0, jitter=0, error_rate=0)
+# Images are decoded in the calling thread, without spawning decoding processes
+image_api.decode_pool.workers = 0
+
+
+def create_test_app():
+    """
+    :return: a test client of the Flask app, on mongomock and the fake classifier
+    """
+    app = create_app()
+    app.config['TESTING'] = True
+    return app.test_client()
+
+
+class AsyncCollection:
+    """
+    Awaitable view of a mongomock collection, standing for the motor collection of the async serving mode.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+def create_test_async_app():
+    """
+    :return: the Quart app of the async serving mode, whose request_track is the mongomock one of the Flask app
+    """
+    from website import async_api
+    from website.async_app import create_async_app
+    async_api.request_collection = AsyncCollection(image_api.request_collection)
+    app = create_async_app()
+    app.config['TESTING'] = True
+    return app
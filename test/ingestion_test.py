@@ -0,0 +1,155 @@
+import io
+import hashlib
+import unittest
+from unittest import mock
+import PIL.Image
+from in_process import image_api, create_test_app
+from website import ingestion
+from website.ingestion import IngestedImage, InvalidImageError, SUPPORTED_FORMATS_MESSAGE, spool_upload
+
+
+def encode_image(format, size=(64, 48), noise=False):
+    """
+    :param noise: whether the image is random noise, which does not compress, rather than a single color
+    :return: the content of a new image file in the given format
+    """
+    image = io.BytesIO()
+    pixels = PIL.Image.effect_noise(size, 100).convert('RGB') if noise else PIL.Image.new('RGB', size, (200, 120, 40))
+    pixels.save(image, format=format)
+    return image.getvalue()
+
+
+class IngestedImageTest(unittest.TestCase):
+    """
+    Test suite for the validation of an uploaded file before it is decoded.
+    """
+    def test_format_is_sniffed_from_content(self):
+        """
+        Test ingesting PNG and JPEG files.
+        Verifies their format is read from the magic bytes, and their size and hash from the whole content.
+        """
+        for format in ('PNG', 'JPEG'):
+            data = encode_image(format)
+            upload = IngestedImage.from_bytes(data)
+            self.assertEqual(format, upload.format)
+            self.assertEqual((64, 48), (upload.width, upload.height))
+            self.assertEqual(len(data), upload.size)
+            self.assertEqual(hashlib.sha256(data).hexdigest(), upload.digest)
+            self.assertEqual(data, upload.read())
+
+
+    def test_unsupported_content_is_rejected(self):
+        """
+        Test ingesting an empty file, a text file and an image in an unsupported format.
+        Verifies each is rejected with its message.
+        """
+        with self.assertRaisesRegex(InvalidImageError, 'The uploaded image is empty'):
+            IngestedImage.from_bytes(b'')
+        for data in (b'This is not an image, whatever its name is', encode_image('GIF')):
+            with self.assertRaises(InvalidImageError) as error:
+                IngestedImage.from_bytes(data)
+            self.assertEqual(SUPPORTED_FORMATS_MESSAGE, str(error.exception))
+
+
+    def test_corrupted_image_is_rejected(self):
+        """
+        Test ingesting a file with a PNG signature followed by garbage.
+        Verifies it is rejected as corrupted rather than failing when it is decoded.
+        """
+        with self.assertRaisesRegex(InvalidImageError, 'The uploaded image is corrupted'):
+            IngestedImage.from_bytes(b'\x89PNG\r\n\x1a\n' + b'\x00' * 100)
+
+
+    def test_too_many_pixels_is_rejected(self):
+        """
+        Test ingesting images with one pixel less and one pixel more than MAX_IMAGE_PIXELS.
+        Verifies only the larger one is rejected, from its header.
+        """
+        with mock.patch.object(ingestion, 'MAX_IMAGE_PIXELS', 64 * 48):
+            IngestedImage.from_bytes(encode_image('PNG', (64, 48)))
+            with self.assertRaisesRegex(InvalidImageError, f'The image has more than {64 * 48} pixels'):
+                IngestedImage.from_bytes(encode_image('PNG', (64, 49)))
+
+
+    def test_spooled_upload_has_a_path(self):
+        """
+        Test the streams spool_upload stores small and large uploads in.
+        Verifies a small upload stays in memory, and a large one, or one of unknown length, goes to a file
+        whose path the ingested image exposes.
+        """
+        self.assertIsInstance(spool_upload(ingestion.UPLOAD_SPOOL_BYTES, 'multipart/form-data'), io.BytesIO)
+        self.assertIsNone(IngestedImage.from_bytes(encode_image('PNG')).path)
+        for total_content_length in (ingestion.UPLOAD_SPOOL_BYTES + 1, None):
+            with spool_upload(total_content_length, 'multipart/form-data') as stream:
+                self.assertIsInstance(stream.name, str)
+                stream.write(encode_image('JPEG'))
+                self.assertEqual(stream.name, IngestedImage(stream).path)
+
+
+class UploadLimitsTest(unittest.TestCase):
+    """
+    Test suite for the rejection of uploads by /upload_image.
+    The image API runs in-process, on mongomock and the fake classifier backend.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.client = create_test_app()
+
+
+    def _upload(self, data, filename, **kwargs):
+        return self.client.post('/upload_image', data={'image': (io.BytesIO(data), filename)}, **kwargs)
+
+
+    def test_oversized_content_length(self):
+        """
+        Test an upload whose Content-Length is larger than MAX_UPLOAD_BYTES.
+        Verifies it is rejected with a 413 before its body is read.
+        """
+        with mock.patch.object(image_api, 'MAX_UPLOAD_BYTES', 1000):
+            response = self._upload(encode_image('PNG', (256, 256), noise=True), 'large.png')
+        self.assertEqual(413, response.status_code)
+        self.assertEqual({'error': {'code': 413, 'message': 'The upload is larger than 1000 bytes'}}, response.json)
+
+
+    def test_oversized_body_without_content_length(self):
+        """
+        Test a chunked upload, without Content-Length, whose body is larger than MAX_CONTENT_LENGTH.
+        Verifies it is rejected with a 413 JSON error while it is read.
+        """
+        body = (b'--boundary\r\nContent-Disposition: form-data; name="image"; filename="large.png"\r\n'
+                b'Content-Type: image/png\r\n\r\n' + encode_image('PNG', (256, 256), noise=True) + b'\r\n--boundary--\r\n')
+        with mock.patch.dict(self.client.application.config, {'MAX_CONTENT_LENGTH': 1000}):
+            response = self.client.post('/upload_image', input_stream=io.BytesIO(body),
+                                        content_type='multipart/form-data; boundary=boundary',
+                                        environ_overrides={'wsgi.input_terminated': True, 'CONTENT_LENGTH': ''})
+        self.assertEqual(413, response.status_code)
+        self.assertEqual(413, response.json['error']['code'])
+
+
+    def test_format_is_not_taken_from_filename(self):
+        """
+        Test a PNG image named .jpg and a text file named .png.
+        Verifies the image is classified and the text file rejected, whatever their extension.
+        """
+        response = self._upload(encode_image('PNG'), 'image.jpg')
+        self.assertEqual(200, response.status_code)
+        self.assertIn('matches', response.json)
+
+        response = self._upload(b'This is not an image, whatever its name is', 'image.png')
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(SUPPORTED_FORMATS_MESSAGE, response.json['error']['message'])
+
+
+    def test_too_many_pixels(self):
+        """
+        Test an upload with more pixels than MAX_IMAGE_PIXELS.
+        Verifies it is rejected with a 400 before it is decoded.
+        """
+        with mock.patch.object(ingestion, 'MAX_IMAGE_PIXELS', 1000):
+            response = self._upload(encode_image('JPEG', (64, 48)), 'image.jpg')
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('The image has more than 1000 pixels', response.json['error']['message'])
+
+
+if __name__ == '__main__':
+    unittest.main()
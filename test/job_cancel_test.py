@@ -0,0 +1,155 @@
+import os
+import io
+import sys
+import time
+import random
+import threading
+import unittest
+import PIL.Image
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '.', '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'image_rest_api')))
+from shared.constants import ASYNC_WORKERS
+from shared.deadline import Cancellation, DeadlineExceededError, check_deadline, use_cancellation
+from website import image_api
+from website.app import create_app
+from website.classifiers import FakeClassifier
+from website.micro_batching import MicroBatcher
+
+# Seconds every model call takes, long enough to cancel a job while it runs
+SLOW_MODEL_SECONDS = 2
+
+
+class JobCancellationTest(unittest.TestCase):
+    """
+    Test suite for DELETE /result/<request_id>.
+    The image API runs in-process with the fake classifier backend, slow enough for a job to be cancelled
+    while it is queued or running. It needs the Mongo server, as the other test suites do.
+    """
+    @classmethod
+    def setUpClass(cls):
+        """
+        Create the app once, with its model replaced by a slow fake classifier.
+        """
+        image_api.classifier = FakeClassifier(latency=SLOW_MODEL_SECONDS, jitter=0, error_rate=0)
+        cls.client = create_app().test_client()
+
+
+    def _upload_distinct_image(self):
+        """
+        Helper method to queue the async job of an image classified by no previous test.
+        :return: the request id of the job
+        """
+        image = io.BytesIO()
+        PIL.Image.effect_noise((64, 64), random.randint(100, 10 ** 9)).convert('RGB').save(image, format='PNG')
+        image.seek(0)
+        response = self.client.post('/async_upload', data={'image': (image, 'noise.png', 'image/png')})
+        self.assertEqual(202, response.status_code)
+        return response.json['request_id']
+
+
+    def _job_state(self, request_id):
+        job = image_api.request_collection.find_one({'request_id': request_id}, {'job_state': 1})
+        return job.get('job_state') if job is not None else None
+
+
+    def _wait_for_job_state(self, request_id, state, timeout):
+        """
+        Helper method to wait until a job is in a given state.
+        """
+        deadline = time.time() + timeout
+        while self._job_state(request_id) != state:
+            if time.time() > deadline:
+                self.fail(f"Job {request_id} is {self._job_state(request_id)}, not {state}")
+            time.sleep(0.05)
+
+
+    def test_cancel_running_job(self):
+        """
+        Test cancelling a job while its model call runs.
+        Verifies the request is cancelled at once, and that the end of the job does not overwrite it.
+        """
+        request_id = self._upload_distinct_image()
+        self._wait_for_job_state(request_id, 'leased', 5)
+
+        response = self.client.delete(f'/result/{request_id}')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'request_id': request_id, 'status': 'cancelled'}, response.json)
+        self.assertEqual({'status': 'cancelled'}, self.client.get(f'/result/{request_id}').json)
+
+        self._wait_for_job_state(request_id, 'cancelled', SLOW_MODEL_SECONDS + 5)
+        self.assertEqual({'status': 'cancelled'}, self.client.get(f'/result/{request_id}').json)
+        self.assertEqual(200, self.client.delete(f'/result/{request_id}').status_code)
+
+
+    def test_cancel_queued_job(self):
+        """
+        Test cancelling a job still waiting for a worker, all of them busy with slow jobs.
+        Verifies the job is removed from the queue without running.
+        """
+        request_ids = [self._upload_distinct_image() for _ in range(ASYNC_WORKERS + 1)]
+        self._wait_for_job_state(request_ids[0], 'leased', 5)
+        queued = [request_id for request_id in request_ids if self._job_state(request_id) == 'queued']
+        self.assertTrue(queued)
+
+        response = self.client.delete(f'/result/{queued[0]}')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('cancelled', self._job_state(queued[0]))
+        self.assertEqual({'status': 'cancelled'}, self.client.get(f'/result/{queued[0]}').json)
+        for request_id in request_ids:
+            self.client.delete(f'/result/{request_id}')
+
+
+    def test_cancel_finished_job(self):
+        """
+        Test cancelling a job that already finished.
+        Verifies the server returns 409 and keeps the result.
+        """
+        request_id = self._upload_distinct_image()
+        result = self.client.get(f'/result/{request_id}', query_string={'wait': SLOW_MODEL_SECONDS + 10}).json
+        self.assertEqual('completed', result['status'])
+
+        response = self.client.delete(f'/result/{request_id}')
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(409, response.json['error']['code'])
+        self.assertEqual(result, self.client.get(f'/result/{request_id}').json)
+
+
+    def test_cancelled_job_does_not_fail_its_micro_batch(self):
+        """
+        Test cancelling the job whose thread sends a micro-batch shared with another job.
+        Verifies only the cancelled job stops, the other one gets its classification.
+        """
+        def classify_batch(model_inputs, lane):
+            time.sleep(0.3)
+            # As the model backends do once their call answered
+            check_deadline()
+            return [{'matches': [{'name': model_input, 'score': 0.9}]} for model_input in model_inputs]
+
+        micro_batcher = MicroBatcher(classify_batch, max_batch=8, max_window_seconds=0.2)
+        micro_batcher.window.gap = 0.05
+        cancellations = {name: Cancellation() for name in ('leader', 'follower')}
+        outcomes = {}
+
+        def classify(name):
+            with use_cancellation(cancellations[name]):
+                try:
+                    outcomes[name] = micro_batcher.classify(name, 'batch')
+                except DeadlineExceededError as e:
+                    outcomes[name] = e
+
+        threads = {name: threading.Thread(target=classify, args=(name,)) for name in cancellations}
+        threads['leader'].start()
+        time.sleep(0.02)
+        threads['follower'].start()
+        # The batch is sent after its 0.2s window, the leader is cancelled during the model call
+        time.sleep(0.3)
+        cancellations['leader'].cancel()
+        for thread in threads.values():
+            thread.join()
+
+        self.assertIsInstance(outcomes['leader'], DeadlineExceededError)
+        self.assertEqual({'matches': [{'name': 'follower', 'score': 0.9}]}, outcomes['follower'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+import os
+import sys
+import time
+import threading
+import unittest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '.', '..')))
+from shared.limiter import (AdaptiveLimiter, Lane, OverloadedError, CircuitOpenError, CLOSED, OPEN, HALF_OPEN,
+                            INTERACTIVE, BATCH)
+
+
+def create_limiter(**kwargs):
+    """
+    :return: a limiter with a high target latency, a circuit that never opens and no queue timeout,
+        unless overridden by kwargs
+    """
+    options = dict(name='test', initial_limit=4, min_limit=1, max_limit=10, target_latency=10, backoff_ratio=0.5,
+                   max_queue=100, queue_timeout=10, failure_threshold=100, open_seconds=10)
+    options.update(kwargs)
+    return AdaptiveLimiter(**options)
+
+
+def call(limiter, error=None, lane=None):
+    """
+    Helper function making one call through the limiter.
+    :param error: exception raised by the call, None for a call that succeeds
+    :return: the exception the call ended with, None if it succeeded
+    """
+    try:
+        with limiter.call(lane):
+            if error is not None:
+                raise error
+    except Exception as e:
+        return e
+    return None
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+    """
+    Test suite for the AIMD concurrency limit of AdaptiveLimiter.
+    """
+    def test_limit_grows_with_fast_calls(self):
+        """
+        Test calls answered within the target latency.
+        Verifies the limit grows by 1 / limit per call, up to max_limit.
+        """
+        limiter = create_limiter(initial_limit=2, max_limit=4)
+        expected = 2.0
+        for _ in range(3):
+            call(limiter)
+            expected += 1 / expected
+        self.assertAlmostEqual(expected, limiter.limit)
+        for _ in range(20):
+            call(limiter)
+        self.assertEqual(4, limiter.limit)
+
+
+    def test_limit_shrinks_with_slow_and_failed_calls(self):
+        """
+        Test a call slower than the target latency, then calls failing with a connection error.
+        Verifies each multiplies the limit by backoff_ratio, down to min_limit.
+        """
+        limiter = create_limiter(initial_limit=8, min_limit=2, target_latency=0.01)
+        with limiter.call():
+            time.sleep(0.02)
+        self.assertEqual(4, limiter.limit)
+        call(limiter, ConnectionError('Connection refused'))
+        self.assertEqual(2, limiter.limit)
+        call(limiter, ConnectionError('Connection refused'))
+        self.assertEqual(2, limiter.limit)
+
+
+    def test_limit_shrinks_once_per_round(self):
+        """
+        Test two calls in flight together, both failing.
+        Verifies the limit is decreased once, the second call started before the first decrease.
+        """
+        limiter = create_limiter(initial_limit=8)
+        with self.assertRaises(TimeoutError):
+            with limiter.call():
+                call(limiter, TimeoutError('Read timed out'))
+                self.assertEqual(4, limiter.limit)
+                raise TimeoutError('Read timed out')
+        self.assertEqual(4, limiter.limit)
+
+
+    def test_errors_of_the_call_are_not_failures(self):
+        """
+        Test calls raising errors unrelated to the health of the dependency, and one answered with a 5xx status.
+        Verifies only the 5xx answer counts as a failure.
+        """
+        class ServerError(Exception):
+            code = 503
+
+        limiter = create_limiter(initial_limit=4, failure_threshold=1)
+        self.assertIsInstance(call(limiter, ValueError('Expected 1 classifications, got: dog, cat')), ValueError)
+        self.assertGreater(limiter.limit, 4)
+        self.assertEqual(CLOSED, limiter.circuit)
+        self.assertIsInstance(call(limiter, ServerError('Service unavailable')), ServerError)
+        self.assertEqual(OPEN, limiter.circuit)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """
+    Test suite for the circuit breaker of AdaptiveLimiter.
+    """
+    def setUp(self):
+        self.limiter = create_limiter(failure_threshold=2, open_seconds=0.1)
+
+
+    def _open(self):
+        for _ in range(self.limiter.failure_threshold):
+            call(self.limiter, ConnectionError('Connection refused'))
+        self.assertEqual(OPEN, self.limiter.circuit)
+
+
+    def test_circuit_opens_after_failures_in_a_row(self):
+        """
+        Test failures interrupted by a success, then failure_threshold failures in a row.
+        Verifies only the failures in a row open the circuit, which then sheds every call.
+        """
+        call(self.limiter, ConnectionError('Connection refused'))
+        call(self.limiter)
+        call(self.limiter, ConnectionError('Connection refused'))
+        self.assertEqual(CLOSED, self.limiter.circuit)
+        call(self.limiter, ConnectionError('Connection refused'))
+        self.assertEqual(OPEN, self.limiter.circuit)
+
+        error = call(self.limiter)
+        self.assertIsInstance(error, CircuitOpenError)
+        self.assertGreaterEqual(error.retry_after, 1)
+
+
+    def test_probe_closes_circuit(self):
+        """
+        Test the circuit once open_seconds passed.
+        Verifies a single probe call is let through, the others are shed while it runs, and its success
+        closes the circuit.
+        """
+        self._open()
+        time.sleep(self.limiter.open_seconds)
+        with self.limiter.call():
+            self.assertEqual(HALF_OPEN, self.limiter.circuit)
+            self.assertIsInstance(call(self.limiter), CircuitOpenError)
+        self.assertEqual(CLOSED, self.limiter.circuit)
+        self.assertIsNone(call(self.limiter))
+
+
+    def test_failed_probe_opens_circuit_again(self):
+        """
+        Test a probe call failing.
+        Verifies the circuit opens again for open_seconds.
+        """
+        self._open()
+        time.sleep(self.limiter.open_seconds)
+        call(self.limiter, ConnectionError('Connection refused'))
+        self.assertEqual(OPEN, self.limiter.circuit)
+        self.assertIsInstance(call(self.limiter), CircuitOpenError)
+
+
+    def test_waiting_calls_are_shed_when_circuit_opens(self):
+        """
+        Test calls queued behind a call whose failure opens the circuit.
+        Verifies they are shed with CircuitOpenError as soon as it opens, rather than after their queue timeout.
+        """
+        limiter = create_limiter(initial_limit=1, failure_threshold=1)
+        errors = []
+        with self.assertRaises(ConnectionError):
+            with limiter.call():
+                waiters = [threading.Thread(target=lambda: errors.append(call(limiter))) for _ in range(3)]
+                for waiter in waiters:
+                    waiter.start()
+                while limiter.waiting < len(waiters):
+                    time.sleep(0.01)
+                raise ConnectionError('Connection reset by peer')
+        started = time.time()
+        for waiter in waiters:
+            waiter.join()
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(3, len(errors))
+        self.assertTrue(all(isinstance(error, CircuitOpenError) for error in errors))
+        self.assertEqual(0, limiter.waiting)
+
+
+class LanesTest(unittest.TestCase):
+    """
+    Test suite for the interactive and batch lanes of AdaptiveLimiter.
+    """
+    def _lanes(self, batch_share=0.5, batch_weight=1, batch_queue_timeout=None):
+        return [Lane(INTERACTIVE, 3), Lane(BATCH, batch_weight, max_share=batch_share, queue_timeout=batch_queue_timeout)]
+
+
+    def test_batch_lane_leaves_slots_to_interactive_calls(self):
+        """
+        Test the batch lane holding its share of the limit.
+        Verifies another batch call waits and is shed, while an interactive call starts at once.
+        """
+        limiter = create_limiter(initial_limit=4, lanes=self._lanes(batch_queue_timeout=0.05))
+        self.assertEqual(2, limiter.state()['lanes'][BATCH]['limit'])
+        with limiter.call(BATCH), limiter.call(BATCH):
+            self.assertIsInstance(call(limiter, lane=BATCH), OverloadedError)
+            started = time.time()
+            self.assertIsNone(call(limiter, lane=INTERACTIVE))
+            self.assertLess(time.time() - started, 0.05)
+        self.assertEqual(1, limiter.state()['lanes'][BATCH]['shed'])
+
+
+    def test_interactive_slot_kept_at_lowest_limit(self):
+        """
+        Test a limiter whose min_limit is 1, with a batch lane that may use the whole limit but one slot.
+        Verifies the limit never gets below 2, so that one slot is always left to interactive calls.
+        """
+        limiter = create_limiter(initial_limit=1, min_limit=1, lanes=self._lanes(batch_share=0.9,
+                                                                               batch_queue_timeout=0.05))
+        self.assertEqual(2, limiter.limit)
+        for _ in range(5):
+            call(limiter, ConnectionError('Connection refused'), lane=BATCH)
+        self.assertEqual(2, limiter.limit)
+        self.assertEqual(1, limiter.state()['lanes'][BATCH]['limit'])
+        with limiter.call(BATCH):
+            self.assertIsInstance(call(limiter, lane=BATCH), OverloadedError)
+            self.assertIsNone(call(limiter, lane=INTERACTIVE))
+
+
+    def test_slots_shared_by_weight(self):
+        """
+        Test both lanes waiting for a single slot, the interactive lane weighing 3 times the batch lane.
+        Verifies the slots go to 3 interactive calls for each batch call, in arrival order within a lane.
+        """
+        limiter = create_limiter(initial_limit=1, max_limit=1, lanes=self._lanes(batch_share=1))
+        served = []
+        def wait(lane, index):
+            with limiter.call(lane):
+                served.append((lane, index))
+
+        waiters = []
+        with limiter.call(INTERACTIVE):
+            for index in range(8):
+                for lane in (BATCH, INTERACTIVE):
+                    waiters.append(threading.Thread(target=wait, args=(lane, index)))
+                    waiters[-1].start()
+                    while limiter.waiting < len(waiters):
+                        time.sleep(0.005)
+        for waiter in waiters:
+            waiter.join()
+
+        lanes = [lane for lane, _ in served]
+        self.assertEqual((6, 2), (lanes[:8].count(INTERACTIVE), lanes[:8].count(BATCH)))
+        for lane in (INTERACTIVE, BATCH):
+            self.assertEqual(list(range(8)), [index for served_lane, index in served if served_lane == lane])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import io
+import unittest
+from unittest import mock
+import PIL.Image
+from in_process import image_api, create_test_app
+from website import preprocessing
+from website.ingestion import IngestedImage
+from website.preprocessing import preprocess_image
+from shared.constants import PREPROCESS_MAX_EDGE, PREPROCESS_TARGET_BYTES
+
+
+def encode_image(format, size, mode='RGB', color=None):
+    """
+    :param color: fill color of the image, None for random noise, which does not compress
+    :return: the content of a new image file in the given format
+    """
+    if color is None:
+        image = PIL.Image.effect_noise(size, 60).convert(mode)
+    else:
+        image = PIL.Image.new(mode, size, color)
+    data = io.BytesIO()
+    image.save(data, format=format)
+    return data.getvalue()
+
+
+def decode(model_input):
+    """
+    :return: the image of a model input blob
+    """
+    return PIL.Image.open(io.BytesIO(model_input['data']))
+
+
+class PreprocessImageTest(unittest.TestCase):
+    """
+    Test suite for the shrinking of uploaded images before the model call.
+    """
+    def test_large_image_is_shrunk(self):
+        """
+        Test preprocessing a JPEG and a PNG larger than PREPROCESS_MAX_EDGE.
+        Verifies they are sent as JPEG files within the byte budget, with their longest edge at PREPROCESS_MAX_EDGE
+        and their aspect ratio, and that the bytes and time per stage are reported.
+        """
+        for format in ('JPEG', 'PNG'):
+            data = encode_image(format, (3000, 1500))
+            model_input, image, stats = preprocess_image(IngestedImage.from_bytes(data))
+            self.assertEqual('image/jpeg', model_input['mime_type'])
+            self.assertEqual((PREPROCESS_MAX_EDGE, PREPROCESS_MAX_EDGE // 2), decode(model_input).size)
+            self.assertEqual(image.size, decode(model_input).size)
+            self.assertEqual((len(data), len(model_input['data'])), (stats['bytes_in'], stats['bytes_out']))
+            self.assertLessEqual(stats['bytes_out'], PREPROCESS_TARGET_BYTES)
+            for stage in ('decode_ms', 'resize_ms', 'encode_ms'):
+                self.assertGreaterEqual(stats[stage], 0)
+
+
+    def test_small_image_is_sent_as_uploaded(self):
+        """
+        Test preprocessing a small single color PNG, smaller as uploaded than re-encoded.
+        Verifies it is sent as uploaded, with no bytes saved.
+        """
+        data = encode_image('PNG', (200, 100), color=(10, 200, 30))
+        model_input, image, stats = preprocess_image(IngestedImage.from_bytes(data))
+        self.assertEqual({'mime_type': 'image/png', 'data': data}, model_input)
+        self.assertEqual(stats['bytes_in'], stats['bytes_out'])
+
+
+    def test_transparency_is_flattened_on_white(self):
+        """
+        Test preprocessing a large, fully transparent PNG.
+        Verifies it is sent as a white RGB image.
+        """
+        data = encode_image('PNG', (2048, 2048), mode='RGBA', color=(0, 0, 0, 0))
+        model_input, image, _ = preprocess_image(IngestedImage.from_bytes(data))
+        self.assertEqual('RGB', image.mode)
+        self.assertEqual((255, 255, 255), image.getpixel((10, 10)))
+        self.assertEqual('RGB', decode(model_input).mode)
+
+
+    def test_preprocessing_disabled(self):
+        """
+        Test preprocessing a large image with PREPROCESS_ENABLED off.
+        Verifies the decoded image is returned unchanged.
+        """
+        data = encode_image('JPEG', (3000, 2000))
+        with mock.patch.object(preprocessing, 'PREPROCESS_ENABLED', False):
+            model_input, image, stats = preprocess_image(IngestedImage.from_bytes(data))
+        self.assertEqual((3000, 2000), image.size)
+        self.assertEqual({'bytes_in': len(data), 'bytes_out': len(data)}, stats)
+
+
+class PreprocessStatsTest(unittest.TestCase):
+    """
+    Test suite for the preprocessing stats of /status.
+    The image API runs in-process, on mongomock and the fake classifier backend.
+    """
+    def test_summary_of_totals(self):
+        """
+        Test summarizing the totals of two preprocessed images.
+        Verifies the bytes saved and the average time per stage.
+        """
+        totals = {'images': 2, 'bytes_in': 5000, 'bytes_out': 1500, 'queue_ms': 1, 'decode_ms': 30, 'resize_ms': 10,
+                  'encode_ms': 6}
+        self.assertEqual({'images': 2, 'bytes_saved': 3500, 'avg_queue_ms': 0.5, 'avg_decode_ms': 15,
+                          'avg_resize_ms': 5, 'avg_encode_ms': 3}, image_api.preprocess_summary(totals))
+        self.assertEqual(0, image_api.preprocess_summary({})['avg_decode_ms'])
+
+
+    def test_upload_is_counted_in_status(self):
+        """
+        Test uploading a large image.
+        Verifies it is counted in the preprocessing stats of /status, with the bytes it saved.
+        """
+        client = create_test_app()
+        before = client.get('/status').json['status']['preprocessing']
+        data = encode_image('JPEG', (3000, 2000))
+        response = client.post('/upload_image', data={'image': (io.BytesIO(data), 'large.jpg')})
+        self.assertEqual(200, response.status_code)
+
+        after = client.get('/status').json['status']['preprocessing']
+        self.assertEqual(before['images'] + 1, after['images'])
+        self.assertGreater(after['bytes_saved'] - before['bytes_saved'], len(data) / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
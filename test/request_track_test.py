@@ -0,0 +1,87 @@
+import io
+import datetime
+import unittest
+from unittest import mock
+import mongomock
+import PIL.Image
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from in_process import image_api, create_test_app
+from shared.constants import REQUEST_TTL_SECONDS, REQUEST_PENDING_TTL_SECONDS
+
+
+class RequestIndexesTest(unittest.TestCase):
+    """
+    Test suite for the indexes and the expiry of the jobs of request_track, on mongomock.
+    """
+    def setUp(self):
+        self.collection = mongomock.MongoClient().db.request_track
+        patcher = mock.patch.object(image_api, 'request_collection', self.collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_indexes_are_created(self):
+        """
+        Test creating the indexes of request_track, with a job written before the TTL index existed.
+        Verifies request_id is unique, expires_at is a TTL index, and the old job gets an expiry.
+        """
+        self.collection.insert_one({'request_id': 'old', 'status': 'completed'})
+        image_api.ensure_request_indexes()
+
+        indexes = {tuple(index['key']): index for index in self.collection.index_information().values()}
+        self.assertTrue(indexes[(('request_id', 1),)].get('unique'))
+        self.assertEqual(0, indexes[(('expires_at', 1),)]['expireAfterSeconds'])
+        self.assertIn((('digest', 1),), indexes)
+        self.assertIsInstance(self.collection.find_one({'request_id': 'old'})['expires_at'], datetime.datetime)
+        with self.assertRaises(DuplicateKeyError):
+            self.collection.insert_one({'request_id': 'old'})
+
+
+    def test_duplicate_ids_do_not_block_startup(self):
+        """
+        Test creating the indexes of request_track holding two jobs of the same former random id.
+        Verifies the unique index is skipped while the others are still created.
+        """
+        self.collection.insert_many([{'request_id': 'twice'}, {'request_id': 'twice'}])
+        with self.assertLogs(image_api.logger, 'WARNING'):
+            image_api.ensure_request_indexes()
+        indexes = {tuple(index['key']) for index in self.collection.index_information().values()}
+        self.assertIn((('expires_at', 1),), indexes)
+        self.assertEqual(2, self.collection.count_documents({'expires_at': {'$exists': True}}))
+
+
+    def test_expiry_of_pending_and_finished_jobs(self):
+        """
+        Test the expiry of a pending job and of a finished one.
+        Verifies each is REQUEST_PENDING_TTL_SECONDS or REQUEST_TTL_SECONDS away.
+        """
+        for pending, ttl in ((True, REQUEST_PENDING_TTL_SECONDS), (False, REQUEST_TTL_SECONDS)):
+            expected = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+            self.assertAlmostEqual(expected.timestamp(), image_api.request_expiry(pending).timestamp(), delta=5)
+
+
+class AsyncUploadJobTest(unittest.TestCase):
+    """
+    Test suite for the job written by /async_upload.
+    The image API runs in-process, on mongomock and the fake classifier backend.
+    """
+    def test_job_has_object_id_and_expiry(self):
+        """
+        Test uploading an image for async classification.
+        Verifies its request id is an ObjectId and its job expires.
+        """
+        image = io.BytesIO()
+        PIL.Image.new('RGB', (64, 48), (20, 40, 60)).save(image, format='PNG')
+        image.seek(0)
+        response = create_test_app().post('/async_upload', data={'image': (image, 'image.png')})
+        self.assertEqual(202, response.status_code)
+
+        request_id = response.json['request_id']
+        self.assertTrue(ObjectId.is_valid(request_id))
+        job = image_api.request_collection.find_one({'request_id': request_id})
+        self.assertIsInstance(job['expires_at'], datetime.datetime)
+
+
+if __name__ == '__main__':
+    unittest.main()
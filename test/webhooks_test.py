@@ -0,0 +1,109 @@
+import os
+import sys
+import json
+import socket
+import threading
+import unittest
+import http.server
+from unittest import mock
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '.', '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'image_rest_api')))
+from website.webhooks import WebhookDispatcher, is_valid_callback_url
+
+CALLBACK_HOST = 'hooks.example'
+
+
+class Receiver(http.server.BaseHTTPRequestHandler):
+    """
+    Webhook receiver recording the deliveries it gets, /redirect answers with a redirect to the metadata endpoint.
+    """
+    deliveries = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        Receiver.deliveries.append((self.path, self.headers['Host'], json.loads(body)))
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', 'http://169.254.169.254/latest/meta-data/')
+        else:
+            self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookDispatcherTest(unittest.TestCase):
+    """
+    Test suite for the delivery of webhooks to a local receiver.
+    CALLBACK_HOST resolves to the receiver on its first lookup and to an internal address on any later one,
+    as a host rebinding its DNS record would.
+    """
+    def setUp(self):
+        Receiver.deliveries = []
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), Receiver)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        getaddrinfo = socket.getaddrinfo
+        self.lookups = 0
+        def rebinding_getaddrinfo(host, *args, **kwargs):
+            if host == CALLBACK_HOST:
+                self.lookups += 1
+                host = '127.0.0.1' if self.lookups == 1 else '10.0.0.1'
+            return getaddrinfo(host, *args, **kwargs)
+        patcher = mock.patch('socket.getaddrinfo', rebinding_getaddrinfo)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.outcomes = []
+        self.done = threading.Semaphore(0)
+        def on_done(delivery, delivered):
+            self.outcomes.append((delivery.request_id, delivered))
+            self.done.release()
+        self.dispatcher = WebhookDispatcher(max_workers=1, queue_depth=10, max_attempts=1, backoff_seconds=0.1,
+                                            max_backoff_seconds=1, timeout=5, allowed_hosts={CALLBACK_HOST},
+                                            on_done=on_done)
+
+
+    def _deliver(self, path):
+        url = f'http://{CALLBACK_HOST}:{self.server.server_port}{path}'
+        self.assertTrue(self.dispatcher.enqueue('request', url, {'status': 'completed'}))
+        self.assertTrue(self.done.acquire(timeout=10))
+
+
+    def test_connects_to_checked_address(self):
+        """
+        Test delivering a webhook to a host allowed when its URL is checked.
+        Verifies the host is resolved once, the connection goes to the checked address and keeps the host name.
+        """
+        self._deliver('/callback')
+        self.assertEqual(1, self.lookups)
+        self.assertEqual([('request', True)], self.outcomes)
+        self.assertEqual([('/callback', f'{CALLBACK_HOST}:{self.server.server_port}', {'status': 'completed'})],
+                         Receiver.deliveries)
+
+
+    def test_redirect_is_not_followed(self):
+        """
+        Test a receiver redirecting its webhook to the metadata endpoint.
+        Verifies the redirect is not followed and the delivery is given up.
+        """
+        self._deliver('/redirect')
+        self.assertEqual([('request', False)], self.outcomes)
+        self.assertEqual(1, len(Receiver.deliveries))
+
+
+    def test_internal_urls_are_refused(self):
+        """
+        Test the callback URLs of internal services.
+        Verifies loopback, private, link-local and non http(s) URLs are refused.
+        """
+        for url in ('http://127.0.0.1:5000/', 'http://10.0.0.1/', 'http://169.254.169.254/latest/meta-data/',
+                    'http://[::1]/', 'ftp://8.8.8.8/', 'not a url'):
+            self.assertFalse(is_valid_callback_url(url), url)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,6 +14,7 @@ def create_app() -> Flask:
     from .models import User
     from .views import views
     from shared.utils import create_json_response
+    from shared.metrics import init_metrics
     from .story_generation import story_generation
     from .image_classification import image_classification
     
@@ -40,6 +41,7 @@ def create_app() -> Flask:
     app.register_blueprint(auth, url_prefix='/')
     app.register_blueprint(story_generation, url_prefix='/')
     app.register_blueprint(image_classification, url_prefix='/')
+    init_metrics(app, 'web_server')
 
     login_manager = LoginManager()
     login_manager.login_view = 'auth.login'
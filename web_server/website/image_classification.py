@@ -6,6 +6,7 @@ import requests
 from typing import Union
 from shared.utils import *
 from shared.constants import * 
+from shared.deadline import outgoing_request_options
 from flask_login import login_required, current_user
 from flask import Blueprint, render_template, request, Response, current_app
 
@@ -25,17 +26,23 @@ def classify_image() -> Union[Response, str]:
         image_filename = image.filename
         method = request.form.get('method')
 
-        if method == "sync":
-            response = requests.post(IMAGE_API_BASE_URL + "upload_image", files={"image": (image_filename, image)})
-        else:
-            response = requests.post(IMAGE_API_BASE_URL + "async_upload", files={"image": (image_filename, image)})
-            if 'request_id' in response.json():
-                result = response.json()
-                request_id = result['request_id']
-                image.seek(0)
-                image_data = image.read()
-                base64_image = base64.b64encode(image_data).decode('utf-8')
-                current_app.config['image_dict'][str(request_id)] = base64_image
+        # The image API drops the classification once the user stopped waiting for it
+        try:
+            if method == "sync":
+                response = requests.post(IMAGE_API_BASE_URL + "upload_image", files={"image": (image_filename, image)},
+                                         **outgoing_request_options(WEB_SYNC_DEADLINE_SECONDS))
+            else:
+                response = requests.post(IMAGE_API_BASE_URL + "async_upload", files={"image": (image_filename, image)},
+                                         **outgoing_request_options(WEB_ASYNC_DEADLINE_SECONDS))
+        except requests.Timeout:
+            return create_json_response({'error': {'code': 504, 'message': 'The classification took too long'}}, 504)
+        if method != "sync" and 'request_id' in response.json():
+            result = response.json()
+            request_id = result['request_id']
+            image.seek(0)
+            image_data = image.read()
+            base64_image = base64.b64encode(image_data).decode('utf-8')
+            current_app.config['image_dict'][str(request_id)] = base64_image
 
         result = response.json()
 
@@ -54,7 +61,11 @@ def get_result_with_id(request_id) -> Response:
     if str(request_id) not in current_app.config['image_dict']:
         return create_json_response({'error': {'code': 404, 'message': f"Invalid request id: {request_id}"}},404)
     
-    response = requests.get(IMAGE_API_BASE_URL + f"result/{request_id}")
+    try:
+        response = requests.get(IMAGE_API_BASE_URL + f"result/{request_id}",
+                                **outgoing_request_options(WEB_SYNC_DEADLINE_SECONDS))
+    except requests.Timeout:
+        return create_json_response({'error': {'code': 504, 'message': 'The result took too long'}}, 504)
     result = response.json()
     image_storage = current_app.config['image_dict'][str(request_id)]
     
@@ -6,12 +6,15 @@ import requests
 from .app import socketio
 from shared.utils import *
 from shared.constants import *
+from shared.deadline import outgoing_request_options
 from flask_login import current_user, login_required
 from flask_socketio import emit, join_room, leave_room
 from flask import Blueprint, render_template, request, redirect, url_for, current_app, session
 
 story_generation = Blueprint('story_generation', __name__)
 
+logger = get_logger()
+
 
 @login_required
 @story_generation.route('/handle_room_request', methods=["POST", "GET"])
@@ -357,8 +360,15 @@ def generate_story(room_code: str = None):
             "story_inspiration": answers[4]
         }
 
-        response = requests.post(STORY_API_BASE_URL + "get_story", json={"story_details": story_details})
-        story_dict = response.json()
+        try:
+            # The story API stops writing the story once the room stopped waiting for it
+            response = requests.post(STORY_API_BASE_URL + "get_story", json={"story_details": story_details},
+                                     **outgoing_request_options(WEB_STORY_DEADLINE_SECONDS))
+        except requests.Timeout:
+            logger.warning(f"Story generation of room {room_code} timed out")
+            story_dict = {"title": "The story got lost", "story": "Writing the story took too long, please try again."}
+        else:
+            story_dict = response.json()
 
         socketio.emit("story", {"title": story_dict["title"], "story": story_dict["story"]},
                       room=rooms[room_code]['sid_list'])